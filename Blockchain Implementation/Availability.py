@@ -0,0 +1,122 @@
+import struct
+import threading
+
+# Number of bit positions set per image id
+BLOOM_HASHES = 7
+# Bits per image in the filter, about 1% false positives with 7 hashes
+BLOOM_BITS_PER_ITEM = 10
+# Most bit positions per image id a received filter may use
+MAX_BLOOM_HASHES = 32
+
+
+class BloomFilter:
+    """
+    Compact set of image ids with no false negatives, advertised to peers
+    Image ids are sha256 hex strings, so the bit positions are taken straight from the id
+    """
+    def __init__(self, size: int, hashes: int = BLOOM_HASHES, bits: bytearray = None):
+        """
+        :param size: The number of bits in the filter
+        :param hashes: The number of bit positions per image id
+        :param bits: The raw filter bits, an empty filter is created if not given
+        """
+        self.size = max(8, size)
+        self.hashes = hashes
+        self.bits = bits if bits is not None else bytearray((self.size + 7) // 8)
+
+    @staticmethod
+    def from_ids(image_ids):
+        image_ids = list(image_ids)
+        bloom = BloomFilter(max(1024, len(image_ids) * BLOOM_BITS_PER_ITEM))
+        for image_id in image_ids:
+            bloom.add(image_id)
+        return bloom
+
+    def _positions(self, image_id: str):
+        # Double hashing over two 64 bit halves of the id
+        h1 = int(image_id[:16], 16)
+        h2 = int(image_id[16:32], 16) | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, image_id: str):
+        for position in self._positions(image_id):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, image_id: str):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(image_id))
+
+    def to_struct(self):
+        return struct.pack("!IB", self.size, self.hashes) + bytes(self.bits)
+
+    @staticmethod
+    def from_struct(data):
+        """
+        Unpacks a filter received from a peer
+        Raises ValueError if the declared size or hash count does not fit the data
+        """
+        if len(data) < 5:
+            raise ValueError("Bloom filter header is cut short")
+        size, hashes = struct.unpack("!IB", data[:5])
+        if size <= 0 or not 1 <= hashes <= MAX_BLOOM_HASHES or len(data) != 5 + (size + 7) // 8:
+            raise ValueError(f"Bloom filter of {size} bits and {hashes} hashes does not match its {len(data) - 5} bytes")
+        return BloomFilter(size, hashes, bytearray(data[5:]))
+
+
+class AvailabilityMap:
+    """
+    Keeps track of which peers hold which images
+    A peer holds an image for sure if it announced or sent it, and probably if its Bloom filter matches
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # peer -> BloomFilter advertised when the connection was set up
+        self.filters = {}
+        # peer -> set of image ids the peer announced or sent since then
+        self.known = {}
+        # peer -> set of image ids the peer said it did not have, to skip Bloom false positives
+        self.missing = {}
+
+    def set_filter(self, peer, bloom: BloomFilter):
+        with self.lock:
+            self.filters[peer] = bloom
+            self.missing.pop(peer, None)
+
+    def add(self, peer, image_id: str):
+        with self.lock:
+            self.known.setdefault(peer, set()).add(image_id)
+            self.missing.get(peer, set()).discard(image_id)
+
+    def discard(self, peer, image_id: str):
+        """
+        Records that a peer does not have the image after all
+        """
+        with self.lock:
+            self.known.get(peer, set()).discard(image_id)
+            self.missing.setdefault(peer, set()).add(image_id)
+
+    def remove(self, peer):
+        """
+        Forgets a peer that left
+        """
+        with self.lock:
+            self.filters.pop(peer, None)
+            self.known.pop(peer, None)
+            self.missing.pop(peer, None)
+
+    def holders(self, image_id: str, peers, key=None):
+        """
+        Returns the given peers that hold the image, the certain ones first
+        :param key: Orders the certain and the likely holders among themselves if given
+        """
+        with self.lock:
+            certain = [peer for peer in peers if image_id in self.known.get(peer, ())]
+            likely = [
+                peer for peer in peers
+                if peer not in certain
+                and image_id not in self.missing.get(peer, ())
+                and peer in self.filters and image_id in self.filters[peer]
+            ]
+        if key:
+            certain.sort(key=key)
+            likely.sort(key=key)
+        return certain + likely
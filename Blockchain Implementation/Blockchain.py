@@ -3,9 +3,54 @@ from datetime import datetime
 from time import time_ns, sleep
 import struct
 from uuid import uuid4
+from concurrent.futures import Future
+from collections.abc import Sequence
 import threading
 
-LOCK = threading.Lock()
+# Easiest allowed proof of work target (two leading hex zeros in the hash)
+MAX_TARGET = (1 << 248) - 1
+# Default retargeting parameters, they are shipped with the chain so peers agree on them
+BLOCK_INTERVAL = 10 * 10**9 # Aimed time between blocks in nanoseconds
+RETARGET_WINDOW = 25 # Number of block intervals in the moving average
+SNAPSHOT_INTERVAL = 100 # Ownership snapshots are taken every this many blocks
+# The genesis block is fixed, so that separately started networks share it and can converge
+GENESIS_TIMESTAMP = 1735689600 * 10**9 # 2025-01-01 00:00 UTC
+# Pre-mined nonce of the genesis block, its hash has 6 leading hex zeros
+GENESIS_NONCE = "00000000000000000000000002102ca1"
+# Nanoseconds a block timestamp may be ahead of the local clock, so far-future timestamps cannot bend the target
+MAX_FUTURE_DRIFT = 2 * 60 * 10**9
+
+def target_from_difficulty(difficulty: int):
+    """
+    Returns the numeric target equivalent to a number of leading hex zeros
+    """
+    return (1 << (256 - 4 * difficulty)) - 1
+
+def target_to_compact(target: int):
+    """
+    Encodes a 256 bit target into the compact 32 bit form:
+    1 byte exponent (length in bytes) followed by the 3 most significant bytes
+    """
+    size = (target.bit_length() + 7) // 8
+    if size <= 3:
+        mantissa = target << (8 * (3 - size))
+    else:
+        mantissa = target >> (8 * (size - 3))
+    if mantissa & 0x800000:
+        # Keep the mantissa below 0x800000 so that it is never read as a sign bit
+        mantissa >>= 8
+        size += 1
+    return (size << 24) | mantissa
+
+def compact_to_target(bits: int):
+    """
+    Decodes a compact 32 bit target into the 256 bit target
+    """
+    size = bits >> 24
+    mantissa = bits & 0x007fffff
+    if size <= 3:
+        return mantissa >> (8 * (3 - size))
+    return mantissa << (8 * (size - 3))
 
 class Transaction:
     """
@@ -51,6 +96,23 @@ class Transaction:
             self.timestamp
         )
 
+    @staticmethod
+    def list_to_struct(transactions):
+        """
+        Packs a list of transactions into a count followed by the transactions
+        """
+        return struct.pack('!L', len(transactions)) + b''.join([tx.to_struct() for tx in transactions])
+
+    @staticmethod
+    def list_from_struct(data):
+        """
+        Unpacks a list of transactions packed by list_to_struct
+        """
+        count = struct.unpack('!L', data[:4])[0]
+        if len(data) != 4 + count * 136:
+            raise ValueError("Transaction list has the wrong size")
+        return [Transaction.from_struct(data[4 + i * 136:4 + (i + 1) * 136]) for i in range(count)]
+
     def __repr__(self):
         return f"0x{self.sender} -> 0x{self.receiver}: 0x{self.image_id} at {self.trx_time}"
     
@@ -63,11 +125,12 @@ class MerkleTree:
         """
         transactions: list of Transaction objects. Can be empty
         """
-        _transactions = [tx.hash for tx in transactions]
+        # Transaction hashes, kept apart from the tree since an empty tree has the empty hash as its only node
+        self.leaves = [tx.hash for tx in transactions]
         
         # A 2D list where each element is a layer of the tree
         # The first layer is the list of transactions and the last layer is the root 
-        self.tree = self.build_tree(_transactions)
+        self.tree = self.build_tree(self.leaves)
     
     def build_tree(self, transactions):
         """
@@ -94,13 +157,55 @@ class MerkleTree:
             tree.append(new_layer)
         return tree
     
+    @staticmethod
+    def root_of(hashes):
+        """
+        Returns the merkle root of a list of hex hashes
+        """
+        return MerkleTree([]).build_tree(hashes)[-1][0]
+
+    def proof(self, index: int):
+        """
+        Returns the sibling hashes on the path from the transaction at the index to the root
+        """
+        branch = []
+        for layer in self.tree[:-1]:
+            sibling = index ^ 1
+            # The last node of an odd layer is paired with itself
+            branch.append(layer[sibling] if sibling < len(layer) else layer[index])
+            index //= 2
+        return branch
+
+    @staticmethod
+    def verify_proof(leaf: str, index: int, branch: list, root: str):
+        """
+        Checks that the leaf hash is at the index of a tree with the given root
+        """
+        node = leaf
+        for sibling in branch:
+            hasher = sha256()
+            if index % 2:
+                hasher.update(sibling.encode())
+                hasher.update(node.encode())
+            else:
+                hasher.update(node.encode())
+                hasher.update(sibling.encode())
+            node = hasher.hexdigest()
+            index //= 2
+        return index == 0 and node == root
+
     def add_transaction(self, transaction):
         """
         Adds a new transaction to the tree and rebuilds it
         """
-        transactions = self.tree[0].copy()
-        transactions.append(transaction.hash)
-        self.tree = self.build_tree(transactions)
+        self.add_transactions([transaction])
+
+    def add_transactions(self, transactions):
+        """
+        Adds several transactions to the tree and rebuilds it once
+        """
+        self.leaves.extend(tx.hash for tx in transactions)
+        self.tree = self.build_tree(self.leaves)
     
     def __repr__(self):
         str = ""
@@ -126,60 +231,130 @@ class Block:
         self.markle_root = self.tree.tree[-1][0]
         self.nonce = uuid4().hex
         self.hash = None
-        self.stop = False
-        self.mining_thread = None
+        # Proof of work target the block is checked against, set by the blockchain
+        self.target = None
+        # Per-block mining state. The event is shared by all workers of this block
+        # so a single set() cancels every one of them on their next attempt
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self.mining_future = None
+        self.mining_threads = []
+        # Packed form, kept once the block is accepted since it does not change anymore
+        self._encoded = None
 
     @property
     def block_time(self):
         return datetime.fromtimestamp(self.timestamp / 1e9)
+
+    @property
+    def mining(self):
+        """
+        True while there is an unfinished mining job for the block
+        """
+        future = self.mining_future
+        return future is not None and not future.done()
     
-    def hash_str(self):
+    def hash_str(self, nonce: str = None, timestamp: int = None):
+        """
+        The data the block hash is taken over: the header without the hash, and the merkle root
+        The transactions are committed to through the root, so a header and a merkle proof
+        are enough to check that a transaction is in a block
+        """
+        nonce = self.nonce if nonce is None else nonce
+        timestamp = self.timestamp if timestamp is None else timestamp
         trx_num = len(self.transactions) # Transaction count is needed because number of transactions is not fixed
-        header = struct.pack('!64sQ32sL', self.previous_hash.encode(), self.timestamp, self.nonce.encode(), trx_num)
-        transactions = b''.join([tx.to_struct() for tx in self.transactions])
-        return header + transactions
+        header = struct.pack('!64sQ32sL', self.previous_hash.encode(), timestamp, nonce.encode(), trx_num)
+        return header + self.markle_root.encode()
     
-    def _hash(self):
+    def _hash(self, nonce: str = None, timestamp: int = None):
         """
         Hashes the block with a nonce and returns the hash
         """
-        string = self.hash_str()
+        string = self.hash_str(nonce, timestamp)
         hasher = sha256(string)
         return hasher.hexdigest()
     
-    def _mine(self, difficulty: int):
+    def meets_target(self, target: int):
         """
-        Starts mining a block with a given difficulty
+        Checks whether the block hash is at or below the numeric target
         """
-        # Nonce is a random 32 byte hex string
-        # This was used so that all clients do not mine the same numbers
-        self.nonce = uuid4().hex
-        self.timestamp = time_ns()
-        while self._hash()[:difficulty] != '0' * difficulty:
-            self.nonce = uuid4().hex
-            self.timestamp = time_ns()
-            sleep(0.00001) # Sleep for a while to avoid CPU hogging
-            if self.stop:
+        return self.hash is not None and int(self.hash, 16) <= target
+
+    def _mine(self, target: int, future: Future, stop_event: threading.Event):
+        """
+        Mining worker. Tries random nonces until the hash is at or below the target
+        or the stop event is set. Every worker uses its own nonce and timestamp
+        and only the first one to succeed writes them back to the block
+        """
+        # The transactions do not change while mining, so the merkle root is encoded once
+        # and only the header is packed for each attempt
+        previous_hash = self.previous_hash.encode()
+        trx_num = len(self.transactions)
+        markle_root = self.markle_root.encode()
+        from_bytes = int.from_bytes
+        while not stop_event.is_set():
+            # Nonce is a random 32 byte hex string
+            # This was used so that all clients do not mine the same numbers
+            nonce = uuid4().hex
+            timestamp = time_ns()
+            header = struct.pack('!64sQ32sL', previous_hash, timestamp, nonce.encode(), trx_num)
+            digest = sha256(header + markle_root).digest()
+            if from_bytes(digest, 'big') <= target:
+                block_hash = digest.hex()
                 break
+            sleep(0.00001) # Sleep for a while to avoid CPU hogging
         else:
-            # Mining is successful, update the block with the data
-            self.hash = self._hash()
-            LOCK.acquire()
-            self.stop = True
-            self.mining_thread = None
-            LOCK.release()
             return
 
-    
-    def mine(self, difficulty: int):
+        # Mining is successful, update the block with the data
+        with self._lock:
+            if future.done():
+                # Another worker won the race or mining was cancelled meanwhile
+                return
+            self._solved(future, nonce, timestamp, block_hash)
+
+    def _solved(self, future: Future, nonce: str, timestamp: int, block_hash: str):
         """
-        Wrapper function to start the mining thread
+        Writes the winning nonce and timestamp back and resolves the mining future
+        Must be called with the lock held
         """
-        LOCK.acquire()
-        self.mining_thread = threading.Thread(target=self._mine, args=(difficulty,))
-        self.mining_thread.start()
-        self.stop = False
-        LOCK.release()
+        self.nonce = nonce
+        self.timestamp = timestamp
+        self.hash = block_hash
+        self._stop_event.set()
+        future.set_result(self)
+
+    def submit(self, future: Future, nonce: str, timestamp: int, target: int):
+        """
+        Hands in a nonce found outside the mining threads of the block, by a pool worker
+        Returns True if it mined the block. Nonces for an earlier mining job are refused,
+        the transactions may have changed since its future was cancelled
+        """
+        with self._lock:
+            if future is not self.mining_future or future.done():
+                return False
+            block_hash = self._hash(nonce, timestamp)
+            if int(block_hash, 16) > target:
+                return False
+            self._solved(future, nonce, timestamp, block_hash)
+            return True
+
+    def mine(self, target: int, workers: int = 1):
+        """
+        Starts the mining threads and returns a Future that resolves to the block
+        once it is mined, or is cancelled when mining is stopped
+        With no workers, only nonces handed in with submit mine the block
+        """
+        with self._lock:
+            self._stop_event = threading.Event()
+            self.mining_future = Future()
+            self.mining_threads = [
+                threading.Thread(target=self._mine, args=(target, self.mining_future, self._stop_event), daemon=True)
+                for _ in range(max(0, workers))
+            ]
+            for thread in self.mining_threads:
+                thread.start()
+            return self.mining_future
     
     def add_transaction(self, transaction: Transaction):
         """
@@ -189,26 +364,47 @@ class Block:
         self.tree.add_transaction(transaction)
         self.markle_root = self.tree.tree[-1][0]
 
+    def add_transactions(self, transactions):
+        """
+        Adds several transactions, the merkle tree is rebuilt once for all of them
+        """
+        self.transactions.extend(transactions)
+        self.tree.add_transactions(transactions)
+        self.markle_root = self.tree.tree[-1][0]
+
     def to_struct(self):
         """
         Packs the block data into a binary format for sharing over the network
         """
+        if self._encoded is not None:
+            return self._encoded
         trx_num = len(self.transactions) # Transaction count is needed because number of transactions is not fixed
         header = struct.pack('!64sQ64s32sL', self.previous_hash.encode(), self.timestamp, self.hash.encode(), self.nonce.encode(), trx_num)
         transactions = b''.join([tx.to_struct() for tx in self.transactions])
         return header + transactions
     
+    def encoding(self):
+        """
+        Returns the packed block, packed on the first call only
+        Only called on accepted blocks, which are not mined or changed anymore
+        """
+        if self._encoded is None:
+            self._encoded = self.to_struct()
+        return self._encoded
+
     def _stop(self):
         """
-        Stops the mining thread
+        Stops the mining threads and cancels the pending mining future
         """
-        # acquire the lock and set the stop flag to True
-        LOCK.acquire()
-        self.stop = True
-        if self.mining_thread:
-            self.mining_thread.join()
-            self.mining_thread = None
-        LOCK.release()
+        with self._lock:
+            self._stop_event.set()
+            if self.mining_future:
+                self.mining_future.cancel()
+            threads, self.mining_threads = self.mining_threads, []
+        # Join outside the lock so a worker that found a hash can finish up
+        for thread in threads:
+            if thread is not threading.current_thread():
+                thread.join()
     
     @staticmethod
     def from_struct(data):
@@ -239,142 +435,888 @@ class Block:
     def __repr__(self):
         return f"Block: 0x{self.hash}\nTimestamp: {self.block_time}\nNonce: 0x{self.nonce}\nMerkle Root: 0x{self.markle_root}"
 
+class TransactionView:
+    """
+    Read-only transaction over a packed record inside a larger buffer (bytes, memoryview or mmap)
+    Fields are decoded and the hash is computed on first access, then kept
+    """
+    __slots__ = ('_buffer', '_offset', '_fields', '_hash')
+
+    def __init__(self, buffer, offset: int = 0):
+        self._buffer = buffer
+        self._offset = offset
+        self._fields = None
+        self._hash = None
+
+    def _decode(self):
+        if self._fields is None:
+            sender, receiver, image_id, timestamp = struct.unpack_from('!32s32s64sQ', self._buffer, self._offset)
+            self._fields = (sender.decode(), receiver.decode(), image_id.decode(), timestamp)
+        return self._fields
+
+    @property
+    def sender(self):
+        return self._decode()[0]
+
+    @property
+    def receiver(self):
+        return self._decode()[1]
+
+    @property
+    def image_id(self):
+        return self._decode()[2]
+
+    @property
+    def timestamp(self):
+        return self._decode()[3]
+
+    @property
+    def hash(self):
+        if self._hash is None:
+            self._hash = sha256(memoryview(self._buffer)[self._offset:self._offset + 136]).hexdigest()
+        return self._hash
+
+    @property
+    def trx_time(self):
+        return datetime.fromtimestamp(self.timestamp / 1e9)
+
+    def to_struct(self):
+        return bytes(memoryview(self._buffer)[self._offset:self._offset + 136])
+
+    def __repr__(self):
+        return f"0x{self.sender} -> 0x{self.receiver}: 0x{self.image_id} at {self.trx_time}"
+
+class BlockView:
+    """
+    Read-only block over its packed form inside a larger buffer (bytes, memoryview or mmap)
+    Header fields, the hash check and the merkle root are computed on first access, then kept.
+    Transaction views are created when the transactions are asked for and are not kept,
+    so a long chain costs little more than its buffer
+    """
+    __slots__ = ('_buffer', '_offset', '_trx_num', '_header', '_markle_root', 'target')
+
+    def __init__(self, buffer, offset: int = 0):
+        self._buffer = buffer
+        self._offset = offset
+        self._trx_num = struct.unpack_from('!L', buffer, offset + 168)[0]
+        self._header = None
+        self._markle_root = None
+        # Proof of work target the block is checked against, set by the blockchain
+        self.target = None
+
+    @staticmethod
+    def from_struct(buffer, offset: int = 0):
+        """
+        Returns a view of the block packed at the offset of the buffer, the buffer is not copied
+        """
+        return BlockView(buffer, offset)
+
+    @property
+    def size(self):
+        """
+        Number of bytes of the packed block
+        """
+        return 172 + self._trx_num * 136
+
+    def _decode(self):
+        if self._header is None:
+            previous_hash, timestamp, block_hash, nonce, _ = struct.unpack_from('!64sQ64s32sL', self._buffer, self._offset)
+            self._header = (previous_hash.decode(), timestamp, block_hash.decode(), nonce.decode())
+        return self._header
+
+    @property
+    def previous_hash(self):
+        return self._decode()[0]
+
+    @property
+    def timestamp(self):
+        return self._decode()[1]
+
+    @property
+    def hash(self):
+        return self._decode()[2]
+
+    @property
+    def nonce(self):
+        return self._decode()[3]
+
+    @property
+    def block_time(self):
+        return datetime.fromtimestamp(self.timestamp / 1e9)
+
+    @property
+    def mining(self):
+        return False
+
+    @property
+    def transactions(self):
+        start = self._offset + 172
+        return [TransactionView(self._buffer, start + i * 136) for i in range(self._trx_num)]
+
+    @property
+    def markle_root(self):
+        if self._markle_root is None:
+            self._markle_root = MerkleTree.root_of([tx.hash for tx in self.transactions])
+        return self._markle_root
+
+    def _hash(self):
+        """
+        Hashes the packed header without its hash field and the merkle root, the same data Block._hash hashes
+        """
+        view = memoryview(self._buffer)[self._offset:self._offset + 172]
+        hasher = sha256(view[:72])
+        hasher.update(view[136:])
+        hasher.update(self.markle_root.encode())
+        return hasher.hexdigest()
+
+    def meets_target(self, target: int):
+        return int(self.hash, 16) <= target
+
+    def to_struct(self):
+        return bytes(self.encoding())
+
+    def encoding(self):
+        """
+        Returns the packed block as a view of the buffer, without copying it
+        """
+        return memoryview(self._buffer)[self._offset:self._offset + self.size]
+
+    def _stop(self):
+        # A view is never mined
+        pass
+
+    def __repr__(self):
+        return f"Block: 0x{self.hash}\nTimestamp: {self.block_time}\nNonce: 0x{self.nonce}\nMerkle Root: 0x{self.markle_root}"
+
+class BlockHeader:
+    """
+    Read-only block header over its packed form inside a larger buffer: the 172 byte header
+    of the packed block followed by the merkle root of its transactions. This is all a light
+    client keeps of a block, it is enough to check the proof of work and merkle proofs
+    """
+    __slots__ = ('_buffer', '_offset', '_fields', 'target')
+
+    SIZE = 236
+
+    def __init__(self, buffer, offset: int = 0):
+        self._buffer = buffer
+        self._offset = offset
+        self._fields = None
+        # Proof of work target the block is checked against, set by the blockchain
+        self.target = None
+
+    @staticmethod
+    def pack(block):
+        """
+        Packs the header of a block, a block view or a header
+        """
+        return bytes(block.encoding()[:172]) + block.markle_root.encode()
+
+    @staticmethod
+    def of(block):
+        return BlockHeader(BlockHeader.pack(block))
+
+    def _decode(self):
+        if self._fields is None:
+            previous_hash, timestamp, block_hash, nonce, trx_num, markle_root = struct.unpack_from('!64sQ64s32sL64s', self._buffer, self._offset)
+            self._fields = (previous_hash.decode(), timestamp, block_hash.decode(), nonce.decode(), trx_num, markle_root.decode())
+        return self._fields
+
+    @property
+    def previous_hash(self):
+        return self._decode()[0]
+
+    @property
+    def timestamp(self):
+        return self._decode()[1]
+
+    @property
+    def hash(self):
+        return self._decode()[2]
+
+    @property
+    def nonce(self):
+        return self._decode()[3]
+
+    @property
+    def trx_num(self):
+        return self._decode()[4]
+
+    @property
+    def markle_root(self):
+        return self._decode()[5]
+
+    @property
+    def block_time(self):
+        return datetime.fromtimestamp(self.timestamp / 1e9)
+
+    @property
+    def mining(self):
+        return False
+
+    @property
+    def transactions(self):
+        # Only the root of the transactions is kept
+        return []
+
+    def _hash(self):
+        view = memoryview(self._buffer)[self._offset:self._offset + self.SIZE]
+        hasher = sha256(view[:72])
+        hasher.update(view[136:])
+        return hasher.hexdigest()
+
+    def meets_target(self, target: int):
+        return int(self.hash, 16) <= target
+
+    def to_struct(self):
+        return bytes(self.encoding())
+
+    def encoding(self):
+        return memoryview(self._buffer)[self._offset:self._offset + self.SIZE]
+
+    def _stop(self):
+        pass
+
+    def __repr__(self):
+        return f"Block: 0x{self.hash}\nTimestamp: {self.block_time}\nNonce: 0x{self.nonce}\nMerkle Root: 0x{self.markle_root}\nTransactions: {self.trx_num}"
+
+class Snapshot:
+    """
+    The ownership state (image -> owner) after a given block, committed to with a merkle root
+    It also carries the last blocks up to that height so that the chain can be verified
+    and retargeted without the history before them
+    """
+    def __init__(self, height: int, owners: dict, tail: list, initial_target: int,
+                 block_interval: int = BLOCK_INTERVAL, window: int = RETARGET_WINDOW):
+        """
+        height: int, height of the last block folded into the state
+        owners: dict of image_id -> owner id
+        tail: list of Block objects ending at height, with their targets set
+        initial_target, block_interval, window: retarget parameters of the chain
+        """
+        self.height = height
+        self.owners = owners
+        self.tail = tail
+        self.initial_target = initial_target
+        self.block_interval = block_interval
+        self.window = window
+        self.block_hash = tail[-1].hash
+        self.state_root = self.compute_state_root(owners)
+        # Packed form, a snapshot does not change once taken
+        self._encoded = None
+
+    @staticmethod
+    def compute_state_root(owners: dict):
+        """
+        Merkle root over the (image_id, owner) pairs sorted by image id
+        """
+        leaves = [sha256((image_id + owners[image_id]).encode()).hexdigest() for image_id in sorted(owners)]
+        return MerkleTree.root_of(leaves)
+
+    @property
+    def digest(self):
+        """
+        Short commitment to the snapshot used to compare snapshots between peers
+        """
+        hasher = sha256(struct.pack('!L64s64s', self.height, self.block_hash.encode(), self.state_root.encode()))
+        for block in self.tail:
+            hasher.update(struct.pack('!L', target_to_compact(block.target)))
+        return hasher.hexdigest()
+
+    def verify(self):
+        """
+        Checks that the tail blocks are linked, meet their targets and end at the snapshot block,
+        and that the state matches its merkle root
+        """
+        for i, block in enumerate(self.tail):
+            if block._hash() != block.hash or not block.meets_target(block.target):
+                return False
+            if i > 0 and block.previous_hash != self.tail[i - 1].hash:
+                return False
+        if self.tail[-1].hash != self.block_hash or len(self.tail) != min(self.height, self.window) + 1:
+            return False
+        return self.compute_state_root(self.owners) == self.state_root
+
+    def to_struct(self):
+        """
+        Packs the snapshot into a binary format for storing on disk and sharing over the network
+        """
+        if self._encoded is not None:
+            return self._encoded
+        meta = struct.pack(
+            '!LQHL64s64sHL',
+            target_to_compact(self.initial_target),
+            self.block_interval,
+            self.window,
+            self.height,
+            self.block_hash.encode(),
+            self.state_root.encode(),
+            len(self.tail),
+            len(self.owners)
+        )
+        tail = b''.join([struct.pack('!L', target_to_compact(block.target)) + block.to_struct() for block in self.tail])
+        owners = b''.join([struct.pack('!64s32s', image_id.encode(), self.owners[image_id].encode()) for image_id in sorted(self.owners)])
+        self._encoded = meta + tail + owners
+        return self._encoded
+
+    @staticmethod
+    def from_struct(data):
+        """
+        Unpacks binary data and returns a Snapshot object
+        Raises ValueError if the declared roots do not match the data
+        """
+        bits, block_interval, window, height, block_hash, state_root, tail_num, owner_num = struct.unpack_from('!LQHL64s64sHL', data)
+        offset = 152
+        tail = []
+        for _ in range(tail_num):
+            target = compact_to_target(struct.unpack_from('!L', data, offset)[0])
+            block = BlockView.from_struct(data, offset + 4)
+            block.target = target
+            tail.append(block)
+            offset += 4 + block.size
+        owners = {}
+        for image_id, owner in struct.iter_unpack('!64s32s', memoryview(data)[offset:offset + owner_num * 96]):
+            owners[image_id.decode()] = owner.decode()
+        snapshot = Snapshot(height, owners, tail, compact_to_target(bits), block_interval, window)
+        if snapshot.block_hash != block_hash.decode() or snapshot.state_root != state_root.decode():
+            raise ValueError("Snapshot does not match its header")
+        return snapshot
+
+    def __repr__(self):
+        return f"Snapshot at height {self.height}: 0x{self.block_hash}\nImages: {len(self.owners)}\nState Root: 0x{self.state_root}"
+
+def _set_owner(owners: dict, images_by_owner: dict, image_id: str, owner: str, copied: set = None):
+    """
+    Updates an ownership index, owner None removes the image
+    copied: owner ids whose image sets were already copied for the index being built. If given,
+    other sets are shared with a published state and are copied before they are changed
+    """
+    previous = owners.get(image_id)
+    if previous is not None:
+        if copied is not None and previous not in copied:
+            images_by_owner[previous] = set(images_by_owner[previous])
+            copied.add(previous)
+        images_by_owner[previous].discard(image_id)
+        if not images_by_owner[previous]:
+            del images_by_owner[previous]
+    if owner is None:
+        owners.pop(image_id, None)
+        return
+    owners[image_id] = owner
+    if copied is not None and owner not in copied:
+        images_by_owner[owner] = set(images_by_owner.get(owner, ()))
+        copied.add(owner)
+    images_by_owner.setdefault(owner, set()).add(image_id)
+
+
+def _apply(owners: dict, images_by_owner: dict, block: Block, copied: set = None):
+    """
+    Applies the transactions of a block to an ownership index and returns how to undo it
+    """
+    undo = []
+    for trx in block.transactions:
+        undo.append((trx.image_id, owners.get(trx.image_id)))
+        _set_owner(owners, images_by_owner, trx.image_id, trx.receiver, copied)
+    return undo
+
+
+class ChainView(Sequence):
+    """
+    Read-only view of the first `length` blocks of an append-only list
+    Blocks appended to the list after the view was taken are not part of it
+    """
+    __slots__ = ("blocks", "length")
+
+    def __init__(self, blocks: list, length: int):
+        self.blocks = blocks
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            if step < 0:
+                return [self.blocks[i] for i in range(start, stop, step)]
+            return self.blocks[start:stop:step]
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("block index out of range")
+        return self.blocks[index]
+
+
+class ChainState:
+    """
+    The blocks and the ownership index of a blockchain at one tip. A state is never changed
+    once published: the blockchain builds a new one for every block and swaps it in,
+    so a reader that holds a state sees a consistent chain without any lock
+    The block list is shared between states and only appended to, each state sees its first
+    `length` blocks. A replaced tip gets a copy of the list instead
+    """
+    __slots__ = ("blocks", "length", "base_height", "owners", "images_by_owner", "tip_undo", "latest_snapshot")
+
+    def __init__(self, blocks: list, length: int, base_height: int, owners: dict, images_by_owner: dict,
+                 tip_undo: list, latest_snapshot: Snapshot):
+        self.blocks = blocks
+        self.length = length
+        self.base_height = base_height
+        self.owners = owners
+        self.images_by_owner = images_by_owner
+        # (image_id, previous owner) pairs to undo the last block if it gets replaced
+        self.tip_undo = tip_undo
+        self.latest_snapshot = latest_snapshot
+
+    @property
+    def chain(self):
+        return ChainView(self.blocks, self.length)
+
+    @property
+    def height(self):
+        return self.base_height + self.length - 1
+
+    @property
+    def last_hash(self):
+        return self.blocks[self.length - 1].hash
+
+    def blocks_to_segments(self, start: int):
+        """
+        Returns the block count and the cached packed blocks from the given height to the tip
+        """
+        blocks = self.chain[max(0, start - self.base_height):]
+        return [struct.pack('!L', len(blocks))] + [block.encoding() for block in blocks]
+
+    def proofs(self, user_id: str, start: int = 0):
+        """
+        Returns (height, index, transaction, merkle branch) for every transaction from the given
+        height on that the user sent or received, oldest first
+        """
+        proofs = []
+        first = max(start, self.base_height)
+        for height, block in enumerate(self.chain[first - self.base_height:], first):
+            transactions = block.transactions
+            indexes = [i for i, trx in enumerate(transactions) if user_id in (trx.sender, trx.receiver)]
+            if indexes:
+                tree = MerkleTree(transactions)
+                proofs.extend((height, i, transactions[i], tree.proof(i)) for i in indexes)
+        return proofs
+
+    def find_images(self, user_id: str):
+        return list(self.images_by_owner.get(user_id, ()))
+
+    def all_images(self):
+        return list(self.owners)
+
+    def find_owner(self, image_id: str):
+        return self.owners.get(image_id)
+
+
 class Blockchain:
     """
     Representation of the blockchain that holds all the blocks
+    Blocks are added one at a time under a per-chain lock, and every added block publishes
+    a new ChainState. Readers never take the lock, and those needing several consistent
+    reads hold on to `state`
     """
-    def __init__(self, difficulty: int = 4, chain=list()):
+    def __init__(self, initial_target: int = None, chain=None, block_interval: int = BLOCK_INTERVAL,
+                 window: int = RETARGET_WINDOW, snapshot: Snapshot = None, snapshot_interval: int = SNAPSHOT_INTERVAL,
+                 base_height: int = 0):
         """
         Creates a new blockchain object
-        difficulty: int, mining difficulty, default is 4
-        chain: list of Block objects, default is empty
+        initial_target: int, proof of work target of the first blocks, default is 3 leading hex zeros
+        chain: list of Block, BlockView or BlockHeader objects, default is empty
+        block_interval: int, aimed time between blocks in nanoseconds
+        window: int, number of block intervals averaged when retargeting
+        snapshot: Snapshot the chain was bootstrapped from, chain then starts with the snapshot tail
+        snapshot_interval: int, a snapshot of the ownership state is taken every this many blocks
+        base_height: int, height of chain[0] for headers that do not start at the genesis block.
+            The first window + 1 of them keep the targets they come with
         """
-        self.difficulty = difficulty
-        self.chain: list[Block] = chain
-        if not chain:
-            self.create_genesis_block()
+        if initial_target is None:
+            initial_target = target_from_difficulty(3)
+        # Targets always go through the compact form so that every peer rounds them the same way
+        self.initial_target = compact_to_target(target_to_compact(initial_target))
+        self.block_interval = block_interval
+        self.window = window
+        self.snapshot_interval = snapshot_interval
+        # Serializes writers, readers go through the published state
+        self._write_lock = threading.Lock()
+
+        blocks = list(chain) if chain else []
+        # Ownership index, kept up to date as blocks are added
+        owners = {}
+        images_by_owner = {}
+        tip_undo = []
+
+        # Height of chain[0]. It is 0 unless the chain was bootstrapped from a snapshot
+        self.base_height = 0
+        # Height of the snapshot the chain was bootstrapped from. Blocks up to it cannot be replaced
+        self.pruned_height = None
+        if snapshot:
+            self.base_height = snapshot.height - len(snapshot.tail) + 1
+            self.pruned_height = snapshot.height
+            for image_id, owner in snapshot.owners.items():
+                _set_owner(owners, images_by_owner, image_id, owner)
+        elif base_height:
+            self.base_height = base_height
+            self.pruned_height = base_height
+        elif not blocks:
+            blocks.append(self.create_genesis_block())
+        self.state = ChainState(blocks, len(blocks), self.base_height, owners, images_by_owner, tip_undo, snapshot)
+        if chain and not snapshot:
+            # Nothing reads the chain yet, so the index is built in place
+            self.assign_targets()
+            for block in blocks:
+                tip_undo = _apply(owners, images_by_owner, block)
+            self.state.tip_undo = tip_undo
 
     def create_genesis_block(self):
-        genesis = Block([], '0' * 64) # Genesis block cannot have a tranasction or previous hash
-        genesis.mine(3) # Mining difficulty is kept low for the genesis block
-        while not genesis.stop:
-            sleep(0.0001) # Sleep for a while to avoid CPU hogging
-            pass
-        self.chain.append(genesis)
+        """
+        Returns the genesis block, which is the same on every node
+        It comes pre-mined for initial targets up to 6 leading hex zeros. Harder ones try
+        the nonces in counting order, so they also get the same block everywhere
+        """
+        genesis = Block([], '0' * 64, GENESIS_TIMESTAMP) # Genesis block cannot have a tranasction or previous hash
+        genesis.target = self.initial_target
+        genesis.nonce = GENESIS_NONCE
+        genesis.hash = genesis._hash()
+        counter = 0
+        while not genesis.meets_target(genesis.target):
+            genesis.nonce = f"{counter:032x}"
+            genesis.hash = genesis._hash()
+            counter += 1
+        return genesis
+
+    def assign_targets(self):
+        """
+        Recomputes the target of every block from the chain data
+        Blocks whose window reaches before the first block of the chain keep their targets
+        """
+        state = self.state
+        for index, block in enumerate(state.chain):
+            if state.base_height and index <= self.window:
+                continue
+            block.target = self._next_target(state, state.base_height + index)
+
+    def verify(self):
+        """
+        Checks that every block hashes to its hash, meets its target and links to the block before it,
+        and that the timestamps increase and are not ahead of the local clock
+        """
+        previous = None
+        latest = time_ns() + MAX_FUTURE_DRIFT
+        for block in self.state.chain:
+            if block._hash() != block.hash or not block.meets_target(block.target) or block.timestamp > latest:
+                return False
+            if previous is not None and (block.previous_hash != previous.hash or block.timestamp <= previous.timestamp):
+                return False
+            previous = block
+        return True
+
+    @property
+    def chain(self):
+        """
+        Read-only sequence of the blocks at the current tip
+        """
+        return self.state.chain
+
+    @property
+    def owners(self):
+        return self.state.owners
+
+    @property
+    def images_by_owner(self):
+        return self.state.images_by_owner
+
+    @property
+    def latest_snapshot(self):
+        return self.state.latest_snapshot
+
+    @property
+    def height(self):
+        """
+        Height of the last block, the genesis block is at height 0
+        """
+        return self.state.height
+
+    def next_target(self, height: int = None):
+        """
+        Computes the target of the block at the given height (the next block by default)
+        The target is the average target of the `window` blocks before it, scaled by how much
+        the time they took differs from the aimed time. Only chain data is used,
+        so all peers arrive at the same value
+        """
+        return self._next_target(self.state, height)
+
+    def _next_target(self, state: ChainState, height: int = None):
+        height = state.height + 1 if height is None else height
+        # The fixed genesis timestamp says nothing about the hash rate, so no window starts at it
+        if height <= self.window + 1:
+            return self.initial_target
+        index = height - state.base_height
+        recent = state.chain[index - self.window - 1:index]
+        avg_target = sum(block.target for block in recent[1:]) // self.window
+        expected = self.window * self.block_interval
+        actual = recent[-1].timestamp - recent[0].timestamp
+        # Limit the adjustment to 4x in either direction per block
+        actual = min(max(actual, expected // 4), expected * 4)
+        target = min(avg_target * actual // expected, MAX_TARGET)
+        return compact_to_target(target_to_compact(target))
+
+    @property
+    def target(self):
+        """
+        Target of the next block to be mined
+        """
+        return self.next_target()
 
     def add_block(self, block: Block):
         """
         Checks a block and adds it to the chain if it is valid
+        The new tip is published as a new state, readers of the old one are not affected
         """
         block_hash = block._hash()
         if block_hash != block.hash:
             # If the block hash is not the same as the hash generated by the block
             print(block_hash, block.hash)
             return False
-        
-        if len(self.chain) > 1 and block.previous_hash == self.chain[-2].hash:
-            # If the block hash a previous hash that is the block before the last one,
-            # we accept the one that was mined earlier
-            if self.chain[-1].timestamp < block.timestamp:
+
+        if block.timestamp > time_ns() + MAX_FUTURE_DRIFT:
+            # The retargeting takes timestamps as they are, so they have to be plausible
+            return False
+
+        with self._write_lock:
+            state = self.state
+            blocks, length = state.blocks, state.length
+            replace = length > 1 and block.previous_hash == blocks[length - 2].hash
+            parent = blocks[length - 2] if replace else blocks[length - 1]
+            if block.timestamp <= parent.timestamp:
                 return False
-            self.chain[1] = block
+            if replace:
+                # If the block hash a previous hash that is the block before the last one,
+                # we accept the one that was mined earlier
+                if blocks[length - 1].timestamp < block.timestamp or state.height == self.pruned_height:
+                    return False
+                target = self._next_target(state, state.height)
+                if not block.meets_target(target):
+                    return False
+            else:
+                target = self._next_target(state)
+                if block.previous_hash != blocks[length - 1].hash or not block.meets_target(target):
+                    # If the previous hash does not match or the block hash does not meet the target
+                    return False
+            block.target = target
+
+            # The index is copied, and only the owner sets the block touches are copied as well
+            owners = dict(state.owners)
+            images_by_owner = dict(state.images_by_owner)
+            copied = set()
+            if replace:
+                for image_id, owner in reversed(state.tip_undo):
+                    _set_owner(owners, images_by_owner, image_id, owner, copied)
+                # Readers of the current state still see the replaced block, so the list is copied
+                blocks = blocks[:length - 1] + [block]
+            else:
+                # Blocks past length belong to no published state
+                del blocks[length:]
+                blocks.append(block)
+
+            tip_undo = _apply(owners, images_by_owner, block, copied)
+            # The block is final now, so its packed form is kept for every response it goes into
+            block.encoding()
+            new_state = ChainState(blocks, len(blocks), state.base_height, owners, images_by_owner, tip_undo, state.latest_snapshot)
+            new_state.latest_snapshot = self._take_snapshot(new_state) or state.latest_snapshot
+            self.state = new_state
             return True
 
-        if block.previous_hash != self.chain[-1].hash or block.hash[:self.difficulty] != '0' * self.difficulty:
-            # If the previous hash does not match or the block hash does not meet the difficulty requirement
-            return False
-        
-        self.chain.append(block)
-        return True
-    
-    def adjust_difficulty(self):
-        """
-        Helper function to check if the diffculty needs to be adjusted
-        returns True, new_difficulty if the difficulty is adjusted
-        return False, old_difficulty if the difficulty is not adjusted
-        """
-        # check the last 25 blocks
-        # if the average time is less than 5 seconds, increase the difficulty by 1
-        # if the average time is greater than 15 seconds, decrease the difficulty by 1
-        if len(self.chain) < 25:
-            return False, self.difficulty
-        last_25 = self.chain[-25:]
-        times = [block.timestamp for block in last_25]
-        avg_time = (times[-1] - times[0]) / 25
-        diff = self.difficulty
-        if avg_time < 5:
-            diff += 1
-            return True, diff
-        elif avg_time > 15:
-            self.difficulty -= 1
-            return True, diff
-        return False, self.difficulty
+    def _take_snapshot(self, state: ChainState):
+        """
+        Returns a snapshot of the ownership state if the tip is at a snapshot height, None otherwise
+        A replaced tip at the same height replaces the snapshot as well
+        The index of a published state never changes, so the snapshot shares it
+        """
+        if state.height == 0 or state.height % self.snapshot_interval != 0:
+            return None
+        tail = state.chain[max(0, state.length - self.window - 1):]
+        return Snapshot(state.height, state.owners, tail, self.initial_target, self.block_interval, self.window)
+
+    @staticmethod
+    def from_snapshot(snapshot: Snapshot, blocks=None):
+        """
+        Creates a blockchain from a verified snapshot and the blocks that follow it
+        Returns None if the snapshot or any of the blocks is invalid
+        """
+        if not snapshot.verify():
+            return None
+        bc = Blockchain(snapshot.initial_target, list(snapshot.tail), snapshot.block_interval, snapshot.window, snapshot)
+        for block in blocks or []:
+            if not bc.add_block(block):
+                return None
+        return bc
 
     @property
     def last_hash(self):
-        return self.chain[-1].hash
+        return self.state.last_hash
+
+    def blocks_to_struct(self, start: int):
+        """
+        Packs the blocks from the given height to the tip
+        """
+        return b''.join(self.blocks_to_segments(start))
+
+    def blocks_to_segments(self, start: int):
+        """
+        Same as blocks_to_struct, as a list of buffers to be sent with scatter-gather I/O
+        """
+        return self.state.blocks_to_segments(start)
+
+    @staticmethod
+    def blocks_from_struct(data, offset: int = 0):
+        """
+        Unpacks blocks packed by blocks_to_struct as views over the data
+        """
+        block_num = struct.unpack_from('!L', data, offset)[0]
+        offset += 4
+        blocks = []
+        for _ in range(block_num):
+            block = BlockView.from_struct(data, offset)
+            blocks.append(block)
+            offset += block.size
+        return blocks
+
+    def headers_to_struct(self, start: int = 0):
+        """
+        Packs the retarget parameters and the headers from the given height to the tip with their targets,
+        for light clients. A chain bootstrapped from a snapshot has no headers before its first block
+        """
+        state = self.state
+        first = max(start, state.base_height)
+        blocks = state.chain[first - state.base_height:]
+        meta = struct.pack('!LQHLL', target_to_compact(self.initial_target), self.block_interval, self.window, first, len(blocks))
+        return meta + b''.join([struct.pack('!L', target_to_compact(block.target)) + BlockHeader.pack(block) for block in blocks])
+
+    @staticmethod
+    def headers_from_struct(data):
+        """
+        Unpacks headers packed by headers_to_struct into a blockchain of BlockHeader views over the data
+        The chain is not verified. Raises ValueError if the data has the wrong size
+        """
+        bits, block_interval, window, base_height, count = struct.unpack_from('!LQHLL', data)
+        if count == 0 or len(data) != 22 + count * (4 + BlockHeader.SIZE):
+            raise ValueError("Header list has the wrong size")
+        headers = []
+        for offset in range(22, len(data), 4 + BlockHeader.SIZE):
+            header = BlockHeader(data, offset + 4)
+            header.target = compact_to_target(struct.unpack_from('!L', data, offset)[0])
+            headers.append(header)
+        return Blockchain(compact_to_target(bits), headers, block_interval, window, base_height=base_height)
+
+    def proofs_to_struct(self, user_id: str, start: int = 0):
+        """
+        Packs the transactions of a user from the given height on with their merkle proofs
+        """
+        proofs = self.state.proofs(user_id, start)
+        data = [struct.pack('!L', len(proofs))]
+        for height, index, transaction, branch in proofs:
+            data.append(struct.pack('!LLB', height, index, len(branch)) + transaction.to_struct() + ''.join(branch).encode())
+        return b''.join(data)
+
+    @staticmethod
+    def proofs_from_struct(data):
+        """
+        Unpacks proofs packed by proofs_to_struct into (height, index, transaction, branch) tuples
+        """
+        count = struct.unpack_from('!L', data)[0]
+        offset = 4
+        proofs = []
+        for _ in range(count):
+            height, index, depth = struct.unpack_from('!LLB', data, offset)
+            offset += 9
+            transaction = Transaction.from_struct(bytes(data[offset:offset + 136]))
+            offset += 136
+            branch = [bytes(data[offset + i * 64:offset + (i + 1) * 64]).decode() for i in range(depth)]
+            offset += depth * 64
+            proofs.append((height, index, transaction, branch))
+        if offset != len(data):
+            raise ValueError("Proof list has the wrong size")
+        return proofs
+
+    def verify_proof(self, height: int, index: int, transaction: Transaction, branch: list):
+        """
+        Checks a merkle proof against the header at the given height of a header chain
+        The header hash commits to the merkle root, so a header that meets its target
+        is enough to trust the transaction
+        """
+        state = self.state
+        if not state.base_height <= height <= state.height:
+            return False
+        header = state.chain[height - state.base_height]
+        if index >= header.trx_num or len(branch) != (header.trx_num - 1).bit_length():
+            return False
+        return MerkleTree.verify_proof(transaction.hash, index, branch, header.markle_root)
 
     def to_struct(self):
         """
         Packs the blockchain data into a binary format
+        A chain bootstrapped from a snapshot is packed as the snapshot and the blocks after it
+        """
+        return b''.join(self.to_segments())
+
+    def to_segments(self):
         """
-        meta = struct.pack('!HL', self.difficulty, len(self.chain))
-        return meta + b''.join([block.to_struct() for block in self.chain])
+        Same as to_struct, as a list of buffers to be sent with scatter-gather I/O
+        The blocks are not packed again, the list holds their cached packed forms
+        """
+        state = self.state
+        if state.base_height:
+            snapshot = state.latest_snapshot.to_struct()
+            meta = struct.pack('!LQHLL', target_to_compact(self.initial_target), self.block_interval, self.window, len(snapshot), 0)
+            return [meta, snapshot] + state.blocks_to_segments(state.latest_snapshot.height + 1)
+        meta = struct.pack('!LQHLL', target_to_compact(self.initial_target), self.block_interval, self.window, 0, state.length)
+        return [meta] + [block.encoding() for block in state.chain[:]]
     
     @staticmethod
     def from_struct(data):
         """
         Unpacks the binary data and returns a Blockchain object
+        The blocks are views over the data, which can be any buffer such as an mmap'd file,
+        so the history is kept in its packed form and decoded only where it is read
         """
         chain = []
-        difficulty, block_num = struct.unpack('!HL', data[:6])
-        data = data[6:]
+        bits, block_interval, window, snapshot_size, block_num = struct.unpack_from('!LQHLL', data)
+        offset = 22
+        if snapshot_size:
+            snapshot = Snapshot.from_struct(memoryview(data)[offset:offset + snapshot_size])
+            return Blockchain.from_snapshot(snapshot, Blockchain.blocks_from_struct(data, offset + snapshot_size))
         for _ in range(block_num):
-            block_header = data[:172]
-            data = data[172:]
-            trx_num = Block.trx_num_from_struct(block_header)
-            trx_num = int(trx_num)
-            block = Block.from_struct(block_header + data[:trx_num * 136])
-            data = data[trx_num * 136:]
+            block = BlockView.from_struct(data, offset)
             chain.append(block)
-        bc = Blockchain(difficulty, chain)
-        bc.chain = chain
-        return bc
+            offset += block.size
+        return Blockchain(compact_to_target(bits), chain, block_interval, window)
     
     def find_images(self, user_id: str):
         """
         Returns all the images that are owned by a user
         """
-        images = []
-        for block in self.chain:
-            for trx in block.transactions:
-                if trx.receiver == user_id:
-                    images.append(trx.image_id)
-        return images
+        return self.state.find_images(user_id)
     
     def all_images(self):
         """
         Returns all images that are in the blockchain
         """
-        images = set()
-        for block in self.chain:
-            for trx in block.transactions:
-                images.add(trx.image_id)
-        return list(images)
+        return self.state.all_images()
     
     def find_owner(self, image_id: str):
         """
         Given an image id, returns the owner of the image
         """
-        for block in self.chain[::-1]:
-            for trx in block.transactions:
-                if trx.image_id == image_id:
-                    return trx.receiver
-        return None
+        return self.state.find_owner(image_id)
 
     def __repr__(self):
-        string = "Number of Blocks: {}\n".format(len(self.chain))
-        for block in self.chain:
+        state = self.state
+        string = "Number of Blocks: {}\n".format(state.height + 1)
+        for block in state.chain:
             string += f"{block}\n"
         return string
 
@@ -382,19 +1324,12 @@ class Blockchain:
 if __name__ == "__main__":
     txs = [Transaction(uuid4().hex, uuid4().hex, sha256(str(i).encode()).hexdigest()) for i in range(10)]
     print(Transaction.from_struct(txs[0].to_struct()))
-    chain = Blockchain(3)
+    chain = Blockchain()
     block1 = Block(txs, chain.last_hash)
-    block1.mine(3)
-
-    while not block1.stop:
-        sleep(0.001)
-        pass
+    block1.mine(chain.target).result()
     txs = [Transaction(uuid4().hex, uuid4().hex, sha256(str(i).encode()).hexdigest()) for i in range(10)]
     block2 = Block(txs, block1.hash)
-    block2.mine(3)
-    while not block2.stop:
-        sleep(0.001)
-        pass
+    block2.mine(chain.target).result()
     print("Block 1")
     print(block1)
     print("====================================\nBlock 2")
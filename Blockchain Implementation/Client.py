@@ -1,20 +1,29 @@
 import socket
 from uuid import uuid4
 import struct
+import io
 import threading
 import random
-from blockchain import Blockchain, Block, Transaction
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from Blockchain import Blockchain, Block, BlockHeader, Transaction, Snapshot
 import sys
-from time import sleep
+from time import sleep, monotonic, time
 from enum import Enum
-from hashlib import sha256
-import customtkinter
-from PIL import Image, ImageTk
-import tkinter as tk
-from tkinter import filedialog
-import io
 import os
+import shutil
 from argparse import ArgumentParser
+import Compression
+from PerceptualHash import PerceptualIndex
+from ImageStore import ImageStore
+from Thumbnails import ThumbnailCache, MAX_THUMBNAIL_SIZE, IMAGE_ID, bucket
+from Availability import AvailabilityMap, BloomFilter
+from Multiplex import Channel
+from DHT import RoutingTable, lookup, node_key, image_key, REPLICATION
+from PeerScores import PeerScores, REJECTED_BLOCK, BAD_DATA
+from QueryAPI import QueryServer
+from Pool import PoolCoordinator
+from Profiling import Profiler, profiled, dump_on_signal
 
 
 class MessageType(str, Enum):
@@ -24,50 +33,180 @@ class MessageType(str, Enum):
     BLOCKCHAIN_REQUESTED = "SBC"
     NEW_BLOCK = "NBL"
     NEW_TRANSACTION = "NTR"
-    NEW_DIFFICULTY = "NDF"
+    NEW_TRANSACTIONS = "NTS"
     NEW_IMAGE = "SIM"
     GET_IMAGE = "GIM"
+    GET_THUMBNAIL = "GTH"
+    GET_SNAPSHOT = "GSN"
+    GET_BLOCKS = "GBL"
+    GET_HEADERS = "GHD"
+    GET_PROOFS = "GPF"
+    HAVE_IMAGES = "HAV"
+    HAVE_IMAGE = "HIM"
+    DROPPED_IMAGE = "DRP"
+    FIND_NODE = "FND"
+    PING = "PNG"
     ALL_OK = "AOK"
     FAILURE = "FLR"
-    END = "END"
+
+# Messages carrying chains or images. They are sent behind blocks and transactions
+# on a connection and their requests are handled concurrently
+BULK_TYPES = {
+    MessageType.BLOCKCHAIN_REQUESTED.encode(),
+    MessageType.GET_SNAPSHOT.encode(),
+    MessageType.GET_BLOCKS.encode(),
+    MessageType.GET_HEADERS.encode(),
+    MessageType.GET_PROOFS.encode(),
+    MessageType.NEW_IMAGE.encode(),
+    MessageType.GET_IMAGE.encode(),
+    MessageType.GET_THUMBNAIL.encode(),
+}
+
+# Largest image that is minted or accepted from a peer
+MAX_IMAGE_SIZE = 32 * 1024 * 1024
+# Largest block or batch of transactions sent in one message
+MAX_BLOCK_SIZE = 16 * 1024 * 1024
+# Largest chain, snapshot, block range, header or proof response
+MAX_CHAIN_SIZE = 1024 * 1024 * 1024
+# Largest HAVE_IMAGES filter, enough for about 13 million images
+MAX_FILTER_SIZE = 16 * 1024 * 1024
+
+# Largest payload of each message type as (request, response). A peer that sends more is disconnected,
+# and the check is made from the frame headers before the data is read
+MESSAGE_LIMITS = {
+    MessageType.BLOCKCHAIN_REQUESTED.encode(): (0, Compression.framed_size(MAX_CHAIN_SIZE)),
+    MessageType.GET_SNAPSHOT.encode(): (0, 3 + Compression.framed_size(MAX_CHAIN_SIZE)),
+    MessageType.GET_BLOCKS.encode(): (4, Compression.framed_size(MAX_CHAIN_SIZE)),
+    MessageType.GET_HEADERS.encode(): (4, Compression.framed_size(MAX_CHAIN_SIZE)),
+    MessageType.GET_PROOFS.encode(): (36, Compression.framed_size(MAX_CHAIN_SIZE)),
+    MessageType.NEW_TRANSACTION.encode(): (136, 0),
+    MessageType.NEW_TRANSACTIONS.encode(): (MAX_BLOCK_SIZE, 0),
+    MessageType.NEW_BLOCK.encode(): (MAX_BLOCK_SIZE, 3),
+    MessageType.NEW_IMAGE.encode(): (64 + Compression.framed_size(MAX_IMAGE_SIZE), 0),
+    MessageType.GET_IMAGE.encode(): (64, 3 + Compression.framed_size(MAX_IMAGE_SIZE)),
+    MessageType.GET_THUMBNAIL.encode(): (66, 3 + Compression.framed_size(MAX_THUMBNAIL_SIZE)),
+    MessageType.HAVE_IMAGES.encode(): (MAX_FILTER_SIZE, 0),
+    MessageType.HAVE_IMAGE.encode(): (64, 0),
+    MessageType.DROPPED_IMAGE.encode(): (64, 0),
+    MessageType.FIND_NODE.encode(): (17, 255 * 38),
+    MessageType.PING.encode(): (8, 8),
+}
+# Per peer rate limits of the requests it sends: (bytes per second, burst) of bulk requests
+# and their responses, and (messages per second, burst) of control requests
+BULK_RATE = (8 * 1024 * 1024, 32 * 1024 * 1024)
+CONTROL_RATE = (200, 1000)
+
+# Number of likely holders an image is requested from at the same time
+FETCH_FANOUT = 3
+# Thumbnails fetched from the peers at the same time. Each fetch sends at most one request per peer,
+# so this stays well under the bulk requests a peer accepts at once before it drops the connection
+MAX_THUMBNAIL_FETCHES = 4
+# Seconds the gallery waits before asking again for a thumbnail no peer had
+THUMBNAIL_RETRY = 10
+# Seconds over which the clients of a lost tracker spread their first reconnection attempt
+TRACKER_RETRY = 5
+# Longest wait in seconds between two reconnection attempts
+TRACKER_RETRY_MAX = 60
+# Seconds between two rounds of pings to the peers
+PING_INTERVAL = 5
+# Size assumed for a chain or an image when peers are ranked to fetch it from
+TRANSFER_SIZE_HINT = 1024 * 1024
+# Seconds between two checks that the stored images are on the nodes closest to them
+REPUBLISH_INTERVAL = 60
+# Seconds peer arrivals and departures are gathered for before the replicas are checked
+REPLICATION_DELAY = 2
+# Handshake flag of light clients, which keep the block headers only and serve no chain
+LIGHT_CLIENT = 0x01
 
 class Client:
-    def __init__(self, host, port, tracker_host, tracker_port, client_type=""):
+    def __init__(self, host, port, tracker_host, tracker_port, client_type="", username=None, data_dir=".", user_id=None, standby_trackers=(), query_port=None, profile=None, light=False, replication=REPLICATION, pool_port=None):
         """
         Initialize the client
         :param host: The host to bind the client to
         :param port: The port to bind the client to
         :param tracker_host: The host of the tracker
         :param tracker_port: The port of the tracker
+        :param client_type: cli, gui, or headless to return once the client is running
+        :param username: The username to log in with, asked for if not given
+        :param data_dir: The directory the snapshots and images are stored under
+        :param user_id: The user id to log in with together with the username, e.g. from an identity file
+        :param standby_trackers: (host, port) of the trackers to fail over to, in order
+        :param query_port: Local port of the read-only HTTP query API, not served if not given
+        :param profile: Path prefix to write a profile to on SIGUSR1 and at exit, profiling runs from the start if given
+        :param light: Keep the block headers only and check the user's own transactions with merkle proofs
+        :param replication: Number of nodes closest to an image that store it
+        :param pool_port: Port to hand out the block being mined to pool mining workers on, no pool if not given
         """
+        self.host = host
+        self.port = port
+        self.trackers = [(tracker_host, tracker_port)] + list(standby_trackers)
 
-        # Setup the socket to the tracker
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        
         # Setup the listener socket
         self.listener_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.listener_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         
         self.running = True
+        self.light = light
+        # Light clients only: (height, index, transaction) of the proven transactions the user sent or received
+        self.proven = []
+        # Light clients only: held while the headers are fetched again
+        self.header_sync = threading.Lock()
 
         self.listener_sock.bind((host, 0))
         self.listener_sock.listen()
         self.listen_port = self.listener_sock.getsockname()[1]
         
-        # diffs is for a consensus on the difficulty
-        self.diffs = {}
-        # storage stores the image data
-        self.storage = {}
+        # perceptual_index holds the perceptual hashes of the known images for near-duplicate checks
+        self.perceptual_index = PerceptualIndex()
+        # mined_blocks wakes up the mining coordinator. Mining futures push the
+        # mined block here and shutdown pushes None
+        self.mined_blocks = queue.Queue()
+        # block_lock serializes the writers of the chain and of the block being mined,
+        # readers go through the published chain state without it
+        self.block_lock = threading.RLock()
+        # availability tracks which peers hold which images
+        self.availability = AvailabilityMap()
+        # scores estimates how fast and honest each peer is
+        self.scores = PeerScores()
+        self.replication = replication
+        # Set when peers come or go, so that the replicas of the stored images are checked
+        self.replicas_changed = threading.Event()
+        # profiler is off until started from the CLI or with --profile
+        self.profiler = Profiler({
+            "chain_height": lambda: self.blockchain.height,
+            "owned_images": lambda: len(self.blockchain.owners),
+            "stored_images": lambda: len(self.storage),
+            "peers": lambda: len(self.peers),
+        })
+        if profile:
+            self.profiler.start()
+            dump_on_signal(self.profiler, profile)
+        # pool hands the block being mined out to remote workers, full clients only
+        self.pool = None
+        if pool_port is not None and not light:
+            self.pool = PoolCoordinator("", pool_port)
+            self.profiler.probes["pool_hashrate"] = self.pool.hashrate
+            print(f"Pool workers can connect on port {self.pool.port}")
 
         print(f"Listening on {host}:{self.listen_port}")
         
         # Connect to the tracker, login and connect to peers
-        self.sock.bind((host, port))
-        self.sock.connect((tracker_host, tracker_port))
-        self.login()
-        self.get_peers()
+        self.connect_to_tracker()
+        self.login(username, user_id)
+        # routing finds the nodes closest to an image, which store it
+        self.routing = RoutingTable(node_key(self.user_id))
+        # Ownership snapshots are stored per user so that several clients can share a directory
+        self.snapshot_dir = os.path.join(data_dir, "snapshots", self.user_id)
+        # storage stores the image data on disk, also per user
+        self.storage = ImageStore(os.path.join(data_dir, "storage", self.user_id))
+        # thumbnails keeps the previews generated from the stored images and received from peers
+        self.thumbnails = ThumbnailCache(os.path.join(data_dir, "thumbnails", self.user_id))
+        # thumbnail_fetches bounds the thumbnails requested from the peers, for the GUI and the query API alike
+        self.thumbnail_fetches = threading.BoundedSemaphore(MAX_THUMBNAIL_FETCHES)
+        self.peers = self.get_peers()
         self.connect_to_peers()
+        threading.Thread(target=self.watch_tracker, daemon=True).start()
+        threading.Thread(target=self.ping_peers, daemon=True).start()
         
         # Start listening for incoming connections
         threading.Thread(target=self.handle_connections).start()
@@ -75,6 +214,12 @@ class Client:
         # Get the blockchain from the peers
         self.get_blockchain()
         self.current_block = Block([], self.blockchain.last_hash)
+        threading.Thread(target=self.maintain_replicas, daemon=True).start()
+
+        self.query_server = None
+        if query_port is not None:
+            self.query_server = QueryServer(lambda: self.blockchain, "127.0.0.1", query_port, self.fetch_thumbnail)
+            print(f"Query API on http://127.0.0.1:{self.query_server.port}/")
         
         # Start the mining thread (It does not necessarily mine)
         threading.Thread(target=self.mine).start()
@@ -83,6 +228,9 @@ class Client:
             self.frontend()
         elif client_type == "cli":
             self.cli()
+        elif client_type == "headless":
+            # The caller drives the client, e.g. the simulator
+            return
         # elif client_type == "both":
         #     threading.Thread(target=self.frontend).start()
         #     self.cli()
@@ -100,58 +248,174 @@ class Client:
         while True:
             command = input("Enter command: ")
             if command == "exit":
-                self.running = False
+                self.shutdown()
                 sys.exit(0)
             elif command == "create":
                 image_path = input("Enter path to image: ")
-                with open(image_path, "rb") as f:
-                    image_data = f.read()
-                self.create_nft(image_data)
+                self.create_nft(image_path)
             elif command == "transfer":
                 image_id = input("Enter image id: ")
                 recipient_id = input("Enter recipient id: ")
                 self.transfer_nft(image_id, recipient_id)
+            elif command == "create-batch":
+                directory = input("Enter path to image directory: ")
+                paths = sorted(os.path.join(directory, name) for name in os.listdir(directory))
+                created = self.create_nfts([path for path in paths if os.path.isfile(path)])
+                print(f"Created {len(created)} NFTs.")
+            elif command == "transfer-batch":
+                # Each line of the file is an image id and a recipient id separated by whitespace
+                transfers_path = input("Enter path to transfer list: ")
+                with open(transfers_path) as f:
+                    transfers = [tuple(line.split()[:2]) for line in f if len(line.split()) >= 2]
+                transferred = self.transfer_nfts(transfers)
+                print(f"Transferred {len(transferred)} NFTs.")
             elif command == "get":
                 image_id = input("Enter image id: ")
-                image_data = self.get_image(image_id)
-                if image_data:
-                    with open(f"{image_id}", "wb") as f:
-                        f.write(image_data)
+                if self.fetch_image(image_id):
+                    shutil.copyfile(self.storage.path(image_id), f"{image_id}")
                 else:
                     print("Image not found.")
+            elif command == "thumbnail":
+                image_id = input("Enter image id: ")
+                size = bucket(int(input("Enter size in pixels: ") or 128))
+                data = self.fetch_thumbnail(image_id, size)
+                if data:
+                    with open(f"{image_id}-{size}.jpg", "wb") as f:
+                        f.write(data)
+                else:
+                    print("Thumbnail not found.")
+            elif command == "index":
+                count = self.index_images()
+                print(f"Indexed {count} images.")
             elif command == "chain":
                 print(self.blockchain)
             elif command == "images":
-                for image in self.blockchain.all_images():
-                    print(f"Image ID: 0x{image}, Owner: 0x{self.blockchain.find_owner(image)}")
+                state = self.blockchain.state
+                for image in state.all_images():
+                    print(f"Image ID: 0x{image}, Owner: 0x{state.find_owner(image)}")
+            elif command == "peers":
+                # Fastest and most honest peers first
+                for peer in self.scores.rank(list(self.peers), TRANSFER_SIZE_HINT):
+                    rtt, throughput, misbehaviour, missed = self.scores.summary(peer)
+                    rtt = f"{rtt:.1f} ms" if rtt is not None else "unknown"
+                    throughput = f"{throughput:.0f} KiB/s" if throughput is not None else "unknown"
+                    username = self.peers.get(peer, {}).get("username", "")
+                    print(f"{username} ({peer[0]}:{peer[1]}) RTT: {rtt}, Throughput: {throughput}, Misbehaviour: {misbehaviour:.1f}, Missed pings: {missed}")
+            elif command == "pool":
+                if self.pool:
+                    for stat in self.pool.stats():
+                        print(f"{stat['name']} ({stat['address']}) Hashrate: {stat['hashrate'] / 1000:.1f} kH/s, Shares: {stat['accepted']}, Stale: {stat['stale']}, Invalid: {stat['invalid']}, Blocks: {stat['blocks']}")
+                    print(f"Total: {self.pool.hashrate() / 1000:.1f} kH/s")
+                else:
+                    print("Not a pool coordinator, start with --pool-port.")
+            elif command.split()[0:1] == ["profile"]:
+                # profile start|stop|dump [path prefix]
+                args = command.split()[1:] or [input("Enter start, stop or dump: ")]
+                if args[0] == "start":
+                    self.profiler.start()
+                    print("Profiling started.")
+                elif args[0] == "stop":
+                    self.profiler.stop()
+                    print("Profiling stopped.")
+                elif args[0] == "dump":
+                    prefix = args[1] if len(args) > 1 else f"profile-{self.username}-{int(time())}"
+                    for path in self.profiler.dump(prefix):
+                        print(f"Wrote {path}")
+                else:
+                    print("Usage: profile start|stop|dump [path prefix]")
             elif command == "me":
                 print(f"User ID: 0x{self.user_id}, Username: {self.username}")
-                for image in self.blockchain.find_images(self.user_id):
+                for image in self.owned_images():
                     print(f"Image ID: 0x{image}")
             else:
                 print("Unknown command.")
                 
-    def login(self):
+    def connect_to_tracker(self):
+        """
+        Connects to the first tracker of the list that can be reached
+        Raises ConnectionError if none of them can
+        """
+        for tracker in self.trackers:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            try:
+                try:
+                    sock.bind((self.host, self.port))
+                except OSError:
+                    # The port is still held by the previous connection
+                    sock.bind((self.host, 0))
+                sock.connect(tracker)
+            except OSError:
+                sock.close()
+                continue
+            self.sock = sock
+            self.tracker = tracker
+            return
+        raise ConnectionError("No tracker can be reached")
+
+    def watch_tracker(self):
+        """
+        Threaded function that logs in again when the tracker connection is lost,
+        to the same tracker once it is back or to the next one of the list
+        Attempts are spread over a random delay so that the clients of a restarted
+        tracker do not all come back at the same moment
+        """
+        while self.running:
+            try:
+                data = self.sock.recv(1)
+            except OSError:
+                data = b""
+            if data or not self.running:
+                continue
+            self.sock.close()
+            print("Lost connection to the tracker.")
+            delay = TRACKER_RETRY
+            while self.running:
+                sleep(random.uniform(0, delay))
+                try:
+                    self.connect_to_tracker()
+                    self.login(self.username, self.user_id)
+                    peers = self.get_peers()
+                    break
+                except (OSError, struct.error):
+                    delay = min(delay * 2, TRACKER_RETRY_MAX)
+            else:
+                return
+            print(f"Reconnected to the tracker at {self.tracker[0]}:{self.tracker[1]}.")
+            # Users that joined while the tracker was away
+            for peer, info in peers.items():
+                if peer not in self.peers:
+                    self.peers[peer] = info
+                    threading.Thread(target=self.connect_to_peer, args=(peer,)).start()
+
+    def login(self, username=None, user_id=None):
         """
         Connect to the tracker
+        :param username: The username to use without asking, a returning user keeps the stored one
+        :param user_id: The id to log in with, given when logging in again after a reconnection
         """
         # Get the first chunk of data
         data = self.sock.recv(64)
-        if data == b"NEW":
+        if user_id is not None:
+            # The identity does not change when the client logs in again
+            self.user_id = user_id
+            self.username = username
+        elif data == b"NEW":
             # If user is not in the database
             self.user_id = uuid4().hex
-            self.username = input("Enter your username: ")
+            self.username = username or input("Enter your username: ")
         else:
             # If user is found in the database
-            user_id, username = struct.unpack("!32s32s", data)
-            self.user_id = user_id.decode()
-            self.username = username.decode().strip("\x00")
-            confirm = input(f"Welcome back, {self.username}. Is this you? (Y[es]/N[o]): ")
-            while confirm.lower() not in ["y", "n", "yes", "no"]:
-                confirm = input("Please enter Y[es]/N[o]: ")
-            if confirm.lower() in ["n", "no"]:
-                self.user_id = uuid4().hex
-                self.username = input("Enter your username: ")
+            stored_id, stored_name = struct.unpack("!32s32s", data)
+            self.user_id = stored_id.decode()
+            self.username = stored_name.decode().strip("\x00")
+            if username is None:
+                confirm = input(f"Welcome back, {self.username}. Is this you? (Y[es]/N[o]): ")
+                while confirm.lower() not in ["y", "n", "yes", "no"]:
+                    confirm = input("Please enter Y[es]/N[o]: ")
+                if confirm.lower() in ["n", "no"]:
+                    self.user_id = uuid4().hex
+                    self.username = input("Enter your username: ")
 
         # Send the tracker the data about listening port and confirm user_id and username
         self.sock.sendall(struct.pack("!32s32sH", self.user_id.encode(), self.username.encode(), self.listen_port))            
@@ -160,21 +424,23 @@ class Client:
     def get_peers(self):
         """
         Get the list of peers from the tracker
+        Returns the peers keyed by their (ip, listening port)
         """
 
-        data = self.sock.recv(4)
+        data = Compression.recv_exact(self.sock, 4)
         count = struct.unpack("!I", data)[0]
-        self.peers = {}
+        peers = {}
         for _ in range(count):
-            data = self.sock.recv(70)
+            data = Compression.recv_exact(self.sock, 70)
             ip = ".".join(map(str, struct.unpack("!BBBB", data[:4])))
             port, user_id, username = struct.unpack("!H32s32s", data[4:])
             user_id = user_id.decode().strip("\x00")
             username = username.decode().strip("\x00")
-            self.peers[(ip, port)] = {
+            peers[(ip, port)] = {
                 "user_id": user_id,
                 "username": username
             }
+        return peers
 
     def connect_to_peers(self):
         """
@@ -195,23 +461,111 @@ class Client:
         """
         Threaded function to connect to a peer
         """
+        if self.scores.banned(peer):
+            self.peers.pop(peer, None)
+            return
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.connect(peer)
-        # Sends the user_id, username and listen_port to the peer and waits for acknowledgment
-        sock.sendall(struct.pack("!32s32sH", self.user_id.encode(), self.username.encode(), self.listen_port))
-        data = sock.recv(3)
         try:
-            if data == MessageType.ALL_OK.encode():
-                # Store the connection if the peer acknowledges
-                self.peers[peer]["sock"] = sock
+            # The tracker may hand out users that left while it was down
+            sock.connect(peer)
+        except OSError:
+            self.remove_peer(peer)
+            sock.close()
+            return
+        # Sends the user_id, username, listen_port, supported codecs and flags to the peer and waits for acknowledgment
+        sock.sendall(struct.pack("!32s32sHBB", self.user_id.encode(), self.username.encode(), self.listen_port, Compression.SUPPORTED, self.flags))
+        try:
+            data = Compression.recv_exact(sock, 5)
+            if data[:3] == MessageType.ALL_OK.encode():
+                # Store the connection if the peer acknowledges, along with the codecs to use on it
+                # From now on requests and their responses are multiplexed over the connection
+                self.peers[peer]["codecs"] = Compression.negotiate(Compression.SUPPORTED, data[3])
+                self.peers[peer]["light"] = bool(data[4] & LIGHT_CLIENT)
+                if not self.peers[peer]["light"]:
+                    # Light clients store no images for others
+                    self.routing.add(node_key(self.peers[peer]["user_id"]), peer)
+                    self.replicas_changed.set()
+                self.peers[peer]["channel"] = self.open_channel(sock, peer, True, on_close=lambda: self.remove_peer(peer))
+                # Advertise the images this client holds
+                self.send_message(peer, MessageType.HAVE_IMAGES, BloomFilter.from_ids(self.storage).to_struct())
             else:
                 # Remove the peer in case of any failure
-                self.peers.pop(peer)
+                self.remove_peer(peer)
                 sock.close()
         except (ConnectionAbortedError, ConnectionResetError):
             # Remove the peer if it is disconnected
-            self.peers.pop(peer)
+            self.remove_peer(peer)
+
+    @property
+    def flags(self):
+        """
+        Handshake flags of this client
+        """
+        return LIGHT_CLIENT if self.light else 0
+
+    def full_peers(self):
+        """
+        Returns the peers that keep the whole chain, light clients cannot serve it
+        """
+        return [peer for peer, info in list(self.peers.items()) if not info.get("light")]
+
+    def remove_peer(self, peer):
+        """
+        Forgets a peer that left and closes the connection to it
+        """
+        info = self.peers.pop(peer, None)
+        self.availability.remove(peer)
+        # A peer that misbehaved enough is banned when it leaves too, not only when the eviction sweep sees it
+        if self.scores.misbehaving(peer):
+            self.scores.ban(peer)
+        self.scores.remove(peer)
+        if info:
+            self.routing.remove(node_key(info["user_id"]))
+            self.replicas_changed.set()
+        if info and "channel" in info:
+            info["channel"].close()
     
+    def evict(self, peer):
+        """
+        Disconnects a peer that stopped answering or misbehaves, the latter is also refused for a while
+        """
+        if self.scores.misbehaving(peer):
+            self.scores.ban(peer)
+            print(f"Peer {peer[0]}:{peer[1]} misbehaves and is banned.")
+        else:
+            print(f"Peer {peer[0]}:{peer[1]} does not respond.")
+        self.remove_peer(peer)
+
+    def ping_peers(self):
+        """
+        Threaded function that pings all peers periodically to estimate their round trip times
+        All pings of a round are sent before any answer is awaited
+        Peers that miss too many pings in a row or misbehave are evicted
+        """
+        while self.running:
+            sleep(PING_INTERVAL)
+            pings = []
+            for peer in list(self.peers):
+                nonce = os.urandom(8)
+                pings.append((peer, nonce, monotonic(), self.request(peer, MessageType.PING, nonce)))
+            for peer, nonce, sent, response in pings:
+                if response is None:
+                    continue
+                try:
+                    answer = response.recv(8, max(0, sent + self.scores.timeout(peer) - monotonic()))
+                except TimeoutError:
+                    # A late answer is dropped when it arrives
+                    response.discard()
+                    self.scores.missed(peer)
+                    continue
+                except ConnectionResetError:
+                    continue
+                if answer == nonce:
+                    self.scores.rtt(peer, monotonic() - sent)
+            for peer in list(self.peers):
+                if self.scores.should_evict(peer):
+                    self.evict(peer)
+
     def handle_connections(self):
         """
         Accepts incoming connections and creates a new thread to handle each connection
@@ -225,185 +579,746 @@ class Client:
                 if not self.running:
                     return
 
-    def send_message(self, peer, message):
+    def open_channel(self, sock, peer, initiator, handler=None, on_close=None):
+        """
+        Wraps a peer connection in a multiplexed channel once the handshake is done
+        The peer's messages are held to the size limits and its requests to the rate limits
+        """
+        return Channel(
+            sock, initiator, handler=handler, bulk_types=BULK_TYPES, on_close=on_close,
+            limits=MESSAGE_LIMITS, bulk_rate=BULK_RATE, control_rate=CONTROL_RATE,
+            on_violation=lambda reason: self.scores.penalize(peer, BAD_DATA),
+        )
+
+    def send_message(self, peer, message_type, payload=b""):
+        """
+        Sends a message that gets no response to a peer and removes the peer if the connection is closed
+        """
+        try:
+            self.peers[peer]["channel"].send(message_type.encode(), payload)
+        except KeyError:
+            # The connection to the peer is not set up yet
+            pass
+        except (ConnectionAbortedError, ConnectionResetError):
+            self.remove_peer(peer)
+
+    def request(self, peer, message_type, payload=b""):
         """
-        Sends a message to a peer and removes the peer if the connection is closed
+        Sends a request to a peer and returns the stream its response arrives on
+        Returns None if the peer is not connected
         """
         try:
-            self.peers[peer]["sock"].sendall(message)
+            return self.peers[peer]["channel"].request(message_type.encode(), payload)
+        except KeyError:
+            return None
         except (ConnectionAbortedError, ConnectionResetError):
-            self.peers.pop(peer)
+            self.remove_peer(peer)
+            return None
 
-    def broadcast(self, message, exclude=None):
+    def broadcast(self, message_type, payload=b"", exclude=None):
         """
         Broadcasts a message to all peers except the excluded one
         """
-        for peer in self.peers:
+        for peer in list(self.peers):
             if peer == exclude:
                 continue
-            threading.Thread(target=self.send_message, args=(peer, message)).start()
+            threading.Thread(target=self.send_message, args=(peer, message_type, payload)).start()
 
     def handle_connection(self, conn, addr):
         """
         Handles the connection from a new user
         """
-        # First receive the data from the new user
-        data = conn.recv(66)
-        user_id, username, listen_port = struct.unpack("!32s32sH", data)
+        # First receive the data from the new user, who may leave before finishing the handshake
+        try:
+            data = Compression.recv_exact(conn, 68)
+        except OSError:
+            conn.close()
+            return
+        user_id, username, listen_port, remote_codecs, flags = struct.unpack("!32s32sHBB", data)
+        # Codecs used for the payloads sent and received on this connection
+        codecs = Compression.negotiate(Compression.SUPPORTED, remote_codecs)
         user_id = user_id.decode().strip("\x00")
         username = username.decode().strip("\x00")
 
+        if self.scores.banned((addr[0], listen_port)):
+            conn.sendall(MessageType.FAILURE.encode())
+            conn.close()
+            return
+
         # If this user is connecting back to client's listening port after
         # client has connected to the user's listening port, then ignore
         if (new_adrr := (addr[0], listen_port)) not in self.peers:
             self.peers[(addr[0], listen_port)] = {
                 "user_id": user_id,
-                "username": username
+                "username": username,
+                "light": bool(flags & LIGHT_CLIENT)
             }
             threading.Thread(target=self.connect_to_peer, args=(new_adrr,)).start()
         
-        # Send acknowledgment to the new user and continues listening
+        # Send acknowledgment to the new user, then serve its requests until it disconnects
         try:
-            conn.sendall(MessageType.ALL_OK.encode())
-            while True:
-                if not self.running:
-                    return
-                
-                data = conn.recv(3) # Receive the message type header
-
-                if data == MessageType.BLOCKCHAIN_REQUESTED.encode():
-                    conn.sendall(self.blockchain.to_struct() + MessageType.END.encode())
-                    continue
-
-                if data == MessageType.NEW_TRANSACTION.encode():
-                    data = b''
-                    while not data.endswith(MessageType.END.encode()):
-                        data += conn.recv(1024)
-                    transaction = Transaction.from_struct(data[:-3])
-                    self.add_transaction(transaction)
-                    continue
-
-                if data == MessageType.NEW_BLOCK.encode():
-                    data = b''
-                    while not data.endswith(MessageType.END.encode()):
-                        data += conn.recv(1024)
-                    block = Block.from_struct(data[:-3])
-                    success = self.receive_block(block)
-                    if success:
-                        conn.sendall(MessageType.ALL_OK.encode())
-                    else:
-                        conn.sendall(MessageType.FAILURE.encode())
-                    continue
-
-                if data == MessageType.NEW_IMAGE.encode():
-                    data = b''
-                    while not data.endswith(MessageType.END.encode()):
-                        data += conn.recv(1024)
-                    image_id = data[:64].decode()
-                    image_data = data[64:-3]
-                    self.receive_image(image_id, image_data)
-                    continue
-
-                if data == MessageType.GET_IMAGE.encode():
-                    image_id = conn.recv(64).decode()
-                    if image_id in self.storage:
-                        conn.sendall(self.storage[image_id] + MessageType.END.encode())
-                    else:
-                        conn.sendall(MessageType.FAILURE.encode())
-                    continue
+            conn.sendall(MessageType.ALL_OK.encode() + struct.pack("!BB", Compression.SUPPORTED, self.flags))
+        except (ConnectionAbortedError, ConnectionResetError):
+            conn.close()
+            return
+        def handler(message_type, stream, reply):
+            # Requests are profiled by message type
+            with self.profiler.section(message_type.decode(errors="replace")):
+                self.handle_request(new_adrr, codecs, message_type, stream, reply)
 
-                if data == MessageType.NEW_DIFFICULTY.encode():
-                    data = conn.recv(2)
-                    difficulty = struct.unpack("!H", data)[0]
-                    self.update_difficulty(difficulty)
-                    continue
+        channel = self.open_channel(conn, new_adrr, False, handler=handler)
+        channel.closed.wait()
+        print(f"Connection from {addr} closed")
+        self.remove_peer(new_adrr)
 
-                if data == b"":
-                    print(f"Connection from {addr} closed")
-                    break
+    def handle_request(self, peer, codecs, message_type, stream, reply):
+        """
+        Handles a single request from a peer. Control requests are handled in the order they
+        arrive, bulk requests run concurrently
+        :param peer: The peer the request came from
+        :param codecs: The codecs negotiated with the peer
+        :param message_type: The message type header
+        :param stream: The request payload, read like a socket
+        :param reply: The stream to write the response to, None if no response is expected
+        """
+        if message_type == MessageType.BLOCKCHAIN_REQUESTED.encode():
+            # The cached packed blocks are sent as they are, the chain is never packed into one buffer
+            Compression.send_payload(reply, self.blockchain.to_segments(), codecs[MessageType.BLOCKCHAIN_REQUESTED.value])
+
+        elif message_type == MessageType.GET_SNAPSHOT.encode():
+            snapshot = self.load_snapshot()
+            if snapshot:
+                reply.sendall(MessageType.ALL_OK.encode())
+                Compression.send_payload(reply, snapshot, codecs[MessageType.GET_SNAPSHOT.value])
+            else:
+                reply.sendall(MessageType.FAILURE.encode())
+
+        elif message_type == MessageType.GET_BLOCKS.encode():
+            start = struct.unpack("!L", Compression.recv_exact(stream, 4))[0]
+            Compression.send_payload(reply, self.blockchain.blocks_to_segments(start), codecs[MessageType.GET_BLOCKS.value])
+
+        elif message_type == MessageType.GET_HEADERS.encode():
+            start = struct.unpack("!L", Compression.recv_exact(stream, 4))[0]
+            Compression.send_payload(reply, self.blockchain.headers_to_struct(start), codecs[MessageType.GET_HEADERS.value])
+
+        elif message_type == MessageType.GET_PROOFS.encode():
+            user_id, start = struct.unpack("!32sL", Compression.recv_exact(stream, 36))
+            Compression.send_payload(reply, self.blockchain.proofs_to_struct(user_id.decode(), start), codecs[MessageType.GET_PROOFS.value])
+
+        elif message_type == MessageType.NEW_TRANSACTION.encode():
+            transaction = Transaction.from_struct(stream.read())
+            self.add_transaction(transaction)
+
+        elif message_type == MessageType.NEW_TRANSACTIONS.encode():
+            transactions = Transaction.list_from_struct(stream.read())
+            if transactions:
+                self.add_transactions(transactions)
+
+        elif message_type == MessageType.NEW_BLOCK.encode():
+            block = Block.from_struct(stream.read())
+            success = self.receive_block(block)
+            if success:
+                reply.sendall(MessageType.ALL_OK.encode())
+            else:
+                # A block whose hash does not match its content is forged, other rejections may be honest forks
+                self.scores.penalize(peer, BAD_DATA if block._hash() != block.hash else REJECTED_BLOCK)
+                reply.sendall(MessageType.FAILURE.encode())
+
+        elif message_type == MessageType.NEW_IMAGE.encode():
+            image_id = Compression.recv_exact(stream, 64).decode()
+            # The image is streamed to disk and checked against its id on the way
+            writer = self.storage.writer(image_id)
+            try:
+                Compression.recv_payload(stream, writer, MAX_IMAGE_SIZE)
+            except ValueError:
+                writer.abort()
+                self.scores.penalize(peer, BAD_DATA)
+                raise
+            except BaseException:
+                writer.abort()
+                raise
+            if writer.commit()[0] is not None:
+                self.availability.add(peer, image_id)
+                self.receive_image(image_id)
+                # The other nodes closest to the image check its replicas against who holds it
+                for _, contact in self.routing.closest(image_key(image_id), self.replication):
+                    if contact != peer:
+                        self.send_message(contact, MessageType.HAVE_IMAGE, image_id.encode())
+            else:
+                self.scores.penalize(peer, BAD_DATA)
 
-                print(f"Unknown message {data} received from {addr}")
+        elif message_type == MessageType.HAVE_IMAGES.encode():
+            try:
+                self.availability.set_filter(peer, BloomFilter.from_struct(stream.read()))
+            except ValueError:
+                self.scores.penalize(peer, BAD_DATA)
+
+        elif message_type == MessageType.HAVE_IMAGE.encode():
+            self.availability.add(peer, Compression.recv_exact(stream, 64).decode())
+
+        elif message_type == MessageType.DROPPED_IMAGE.encode():
+            self.availability.discard(peer, Compression.recv_exact(stream, 64).decode())
+            self.replicas_changed.set()
+
+        elif message_type == MessageType.PING.encode():
+            reply.sendall(stream.read())
+
+        elif message_type == MessageType.FIND_NODE.encode():
+            key, count = struct.unpack("!16sB", Compression.recv_exact(stream, 17))
+            contacts = self.routing.closest(int.from_bytes(key, "big"), count)
+            reply.sendall(b"".join(
+                struct.pack("!BBBBH32s", *map(int, contact[0].split(".")), contact[1], f"{contact_key:032x}".encode())
+                for contact_key, contact in contacts
+            ))
+
+        elif message_type == MessageType.GET_IMAGE.encode():
+            image_id = Compression.recv_exact(stream, 64).decode()
+            if image_id in self.storage:
+                reply.sendall(MessageType.ALL_OK.encode())
+                with self.storage.open(image_id) as f:
+                    Compression.send_file(reply, f, self.storage.size(image_id), codecs[MessageType.GET_IMAGE.value])
+            else:
+                reply.sendall(MessageType.FAILURE.encode())
+
+        elif message_type == MessageType.GET_THUMBNAIL.encode():
+            image_id, size = struct.unpack("!64sH", Compression.recv_exact(stream, 66))
+            image_id = image_id.decode(errors="replace")
+            # The id comes from the peer and is part of a file path, so it has to be an image id
+            data = self.thumbnail(image_id, size) if IMAGE_ID.fullmatch(image_id) else None
+            if data:
+                reply.sendall(MessageType.ALL_OK.encode())
+                # Thumbnails are JPEGs and would not shrink any further
+                Compression.send_payload(reply, data, Compression.RAW)
+            else:
+                reply.sendall(MessageType.FAILURE.encode())
 
-        except (ConnectionAbortedError, ConnectionResetError):
-            print(f"Connection from {addr} closed")
-            self.peers.pop(addr)
-            conn.close()
+        else:
+            print(f"Unknown message {message_type} received from {peer}")
     
+    @profiled("get_blockchain")
     def get_blockchain(self):
         """
         Get the blockchain from the peers. The blockchain fetch works in a consensus manner.
         If there is no peer, then client will create a new one
         If there is only one peer, then client will fetch the blockchain from that peer
-        If there is more than one peer, then client will select two random peers and fetch the blockchain from them
+        If there is more than one peer, then client will select the two best ranked peers and fetch the blockchain from them
             If the blockchains received are different, it means that there is a possible fork. Client will wait for 2 seconds and try again
         If the blockchains received are the same, then client will use that blockchain
+        Light clients fetch the headers instead
         """
+        if self.light:
+            return self.get_headers()
 
-        if not self.peers:
+        if not self.full_peers():
             print("No peers found. Creating a new blockchain.")
-            self.blockchain = Blockchain(3)
+            self.blockchain = Blockchain()
             print(f"Blockchain created. First block: 0x{self.blockchain.last_hash}")
             return
         
-        if len(self.peers) == 1:
-            peers = list(self.peers.keys())
-        else:
-            peers = random.sample(list(self.peers.keys()), 2)
+        # Peers that were not measured yet are picked at random
+        peers = self.full_peers()
+        random.shuffle(peers)
+        peers = self.scores.rank(peers, TRANSFER_SIZE_HINT)[:2]
+
+        if self.bootstrap_from_snapshot(peers):
+            print(f"Blockchain restored from snapshot. Last block: 0x{self.blockchain.last_hash}")
+            return
+
         chains = set()
 
-        for peer in peers:
-            self.send_message(peer, MessageType.BLOCKCHAIN_REQUESTED.encode())
-            data = b''
-            while not data.endswith(MessageType.END.encode()):
-                data += self.peers[peer]["sock"].recv(1024)
-            
-            chains.add(data)
+        # Both requests are sent before reading either response
+        started = monotonic()
+        responses = [self.request(peer, MessageType.BLOCKCHAIN_REQUESTED) for peer in peers]
+        for peer, response in zip(peers, responses):
+            if response is None:
+                # The peer left in the meantime
+                continue
+            try:
+                chain = Compression.recv_payload(response, limit=MAX_CHAIN_SIZE)
+            except ConnectionResetError:
+                continue
+            except ValueError:
+                response.discard()
+                self.scores.penalize(peer, BAD_DATA)
+                continue
+            self.scores.transfer(peer, len(chain), monotonic() - started)
+            chains.add(chain)
         
         if len(chains) != 1:
             sleep(2) # Wait till other peers have sorted out the blockchain
-            self.get_blockchain()
+            return self.get_blockchain()
         
         self.blockchain = Blockchain.from_struct(chains.pop())
+        self.save_snapshot()
         print(f"Blockchain received. Last block: 0x{self.blockchain.last_hash}")
 
-    def save_image(self, image_data):
+    @profiled("get_headers")
+    def get_headers(self):
+        """
+        Gets the block headers for a light client, from the two best ranked full peers
+        Every header is checked against its link and its proof of work, and both chains of
+        headers have to end at the same block, else the client waits and tries again
+        Then the transactions the user sent or received are fetched with their merkle proofs
+        """
+        with self.header_sync:
+            while self.running:
+                peers = self.full_peers()
+                random.shuffle(peers)
+                peers = self.scores.rank(peers, TRANSFER_SIZE_HINT)[:2]
+                chains = {}
+                started = monotonic()
+                responses = [self.request(peer, MessageType.GET_HEADERS, struct.pack("!L", 0)) for peer in peers]
+                for peer, response in zip(peers, responses):
+                    if response is None:
+                        continue
+                    try:
+                        data = Compression.recv_payload(response, limit=MAX_CHAIN_SIZE)
+                    except ConnectionResetError:
+                        continue
+                    except ValueError:
+                        response.discard()
+                        self.scores.penalize(peer, BAD_DATA)
+                        continue
+                    try:
+                        chain = Blockchain.headers_from_struct(data)
+                    except (ValueError, struct.error):
+                        chain = None
+                    if chain is None or not chain.verify():
+                        self.scores.penalize(peer, BAD_DATA)
+                        continue
+                    self.scores.transfer(peer, len(data), monotonic() - started)
+                    chains[peer] = chain
+                if len({chain.last_hash for chain in chains.values()}) == 1:
+                    break
+                if not peers:
+                    print("Waiting for a full peer.")
+                sleep(2)
+            else:
+                return
+
+            # A peer that bootstrapped from a snapshot has fewer headers, the longest history is kept
+            peer, blockchain = min(chains.items(), key=lambda item: item[1].base_height)
+            proven = self.fetch_proofs(peer, blockchain, blockchain.base_height)
+            with self.block_lock:
+                self.blockchain = blockchain
+                self.proven = proven
+            print(f"Headers received. Last block: 0x{self.blockchain.last_hash}")
+
+    def fetch_proofs(self, peer, blockchain, start):
+        """
+        Fetches the transactions the user sent or received from the given height on and
+        returns (height, index, transaction) for those whose merkle proof checks out
         """
-        Saves the image data, broadcasts the image to all peers and returns the image id
+        response = self.request(peer, MessageType.GET_PROOFS, struct.pack("!32sL", self.user_id.encode(), start))
+        if response is None:
+            return []
+        try:
+            proofs = Blockchain.proofs_from_struct(Compression.recv_payload(response, limit=MAX_CHAIN_SIZE))
+        except ConnectionResetError:
+            return []
+        except (ValueError, struct.error):
+            self.scores.penalize(peer, BAD_DATA)
+            return []
+        proven = []
+        for height, index, transaction, branch in proofs:
+            if self.user_id in (transaction.sender, transaction.receiver) and blockchain.verify_proof(height, index, transaction, branch):
+                proven.append((height, index, transaction))
+            else:
+                self.scores.penalize(peer, BAD_DATA)
+        return proven
+
+    def owned_images(self):
         """
-        image_id = sha256(image_data).hexdigest()
-        self.storage[image_id] = image_data
-        self.broadcast(MessageType.NEW_IMAGE.encode() + image_id.encode() + image_data + MessageType.END.encode())
-        return image_id
+        Returns the ids of the images the user owns
+        Light clients replay the proven transactions of the user
+        """
+        if not self.light:
+            return self.blockchain.state.find_images(self.user_id)
+        owned = set()
+        for _, _, transaction in sorted(self.proven, key=lambda proof: proof[:2]):
+            if transaction.receiver == self.user_id:
+                owned.add(transaction.image_id)
+            else:
+                owned.discard(transaction.image_id)
+        return list(owned)
+
+    def find_owner(self, image_id):
+        """
+        Given an image id, returns the owner of the image
+        Light clients only know the images of the user and return None for the others
+        """
+        if self.light:
+            return self.user_id if image_id in self.owned_images() else None
+        return self.blockchain.find_owner(image_id)
+
+    def bootstrap_from_snapshot(self, peers):
+        """
+        Builds the blockchain from the latest ownership snapshot and the blocks after it
+        The snapshot is only used if all the given peers serve the same one and it verifies
+        against its blocks. Returns False if the full chain should be fetched instead
+        """
+        snapshots = {}
+        responses = [self.request(peer, MessageType.GET_SNAPSHOT) for peer in peers]
+        for response in responses:
+            if response is None:
+                return False
+            try:
+                if Compression.recv_exact(response, 3) == MessageType.FAILURE.encode():
+                    return False
+                snapshot = Snapshot.from_struct(Compression.recv_payload(response, limit=MAX_CHAIN_SIZE))
+            except (ConnectionResetError, ValueError, struct.error):
+                return False
+            snapshots[snapshot.digest] = snapshot
+
+        if len(snapshots) != 1:
+            return False
+        snapshot = snapshots.popitem()[1]
+
+        started = monotonic()
+        response = self.request(peers[0], MessageType.GET_BLOCKS, struct.pack("!L", snapshot.height + 1))
+        if response is None:
+            return False
+        try:
+            data = Compression.recv_payload(response, limit=MAX_CHAIN_SIZE)
+        except ConnectionResetError:
+            return False
+        except ValueError:
+            response.discard()
+            self.scores.penalize(peers[0], BAD_DATA)
+            return False
+        self.scores.transfer(peers[0], len(data), monotonic() - started)
+        blockchain = Blockchain.from_snapshot(snapshot, Blockchain.blocks_from_struct(data))
+        if blockchain is None:
+            return False
+        self.blockchain = blockchain
+        self.save_snapshot()
+        return True
+
+    def save_snapshot(self):
+        """
+        Writes the latest ownership snapshot of the chain to disk if it is not there yet
+        Only the two most recent snapshots are kept
+        """
+        snapshot = self.blockchain.latest_snapshot
+        if snapshot is None or self.light:
+            return
+        path = os.path.join(self.snapshot_dir, f"{snapshot.height}.snap")
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        # A replaced tip at a snapshot height overwrites the snapshot of that height
+        with open(path + ".tmp", "wb") as f:
+            f.write(snapshot.to_struct())
+        os.replace(path + ".tmp", path)
+        for old in self.snapshot_heights()[:-2]:
+            os.remove(os.path.join(self.snapshot_dir, f"{old}.snap"))
+
+    def snapshot_heights(self):
+        """
+        Returns the heights of the snapshots stored on disk in ascending order
+        """
+        if not os.path.isdir(self.snapshot_dir):
+            return []
+        return sorted(int(name[:-5]) for name in os.listdir(self.snapshot_dir) if name.endswith(".snap"))
+
+    def load_snapshot(self):
+        """
+        Returns the packed latest snapshot from disk, or None if there is none
+        """
+        heights = self.snapshot_heights()
+        if not heights:
+            return None
+        with open(os.path.join(self.snapshot_dir, f"{heights[-1]}.snap"), "rb") as f:
+            return f.read()
+
+    def save_image(self, image):
+        """
+        Streams the image (bytes or a file path) into the storage and returns (image_id, new)
+        new is False if the image was already stored
+        """
+        return self.storage.ingest(image)
+
+    def find_node(self, peer, key, count):
+        """
+        Asks a peer for the contacts it knows closest to a key
+        Returns (key, contact) pairs, or None if the peer does not answer in time
+        Contacts that are not connected yet are connected to, like the peers from the tracker
+        """
+        response = self.request(peer, MessageType.FIND_NODE, struct.pack("!16sB", key.to_bytes(16, "big"), count))
+        if response is None:
+            return None
+        try:
+            data = response.recv(4096, self.scores.timeout(peer)) + response.read()
+            found = list(struct.iter_unpack("!BBBBH32s", data))
+        except TimeoutError:
+            response.discard()
+            return None
+        except ConnectionResetError:
+            return None
+        except struct.error:
+            self.scores.penalize(peer, BAD_DATA)
+            return None
+        contacts = []
+        for *ip, port, user_id in found:
+            contact = (".".join(map(str, ip)), port)
+            user_id = user_id.decode()
+            if user_id == self.user_id:
+                continue
+            if contact not in self.peers:
+                self.peers[contact] = {"user_id": user_id, "username": ""}
+                self.connect_to_peer(contact)
+            contacts.append((node_key(user_id), contact))
+        return contacts
+
+    def closest_nodes(self, image_id):
+        """
+        Looks up the nodes an image is stored on, the `replication` nodes whose keys are closest
+        to the image id. This client is one of them if it is close enough, and is given as None
+        """
+        key = image_key(image_id)
+        found, _ = lookup(self.routing, key, lambda peer: self.find_node(peer, key, self.replication), self.replication)
+        if not self.light:
+            found.append((self.routing.own_key, None))
+        found.sort(key=lambda item: item[0] ^ key)
+        return [contact for _, contact in found[:self.replication]]
+
+    def store_images(self, image_ids):
+        """
+        Sends stored images to the nodes closest to their ids, which keep them for the network
+        The lookups run in the background, and this client keeps its own copies
+        """
+        def place():
+            with ThreadPoolExecutor(max_workers=FETCH_FANOUT) as executor:
+                placements = list(executor.map(self.closest_nodes, image_ids))
+            sends = {}
+            for image_id, nodes in zip(image_ids, placements):
+                for peer in nodes:
+                    if peer is not None:
+                        sends.setdefault(peer, []).append(image_id)
+            for peer, ids in sends.items():
+                threading.Thread(target=self.send_images, args=(peer, ids)).start()
+        threading.Thread(target=place, daemon=True).start()
+
+    def maintain_replicas(self):
+        """
+        Threaded function that keeps every stored image on the `replication` nodes closest to it
+        It runs when peers come or go, and every REPUBLISH_INTERVAL seconds
+        A holder sends the image to the closest nodes not known to hold it, unless a holder closer
+        to the image does it. An image this client is not among the closest nodes for anymore
+        is dropped once they all hold it, unless the user owns it
+        The routing table knows the nodes around its own key best, and the images the client
+        holds are close to its key, so the table stands in for a lookup per image
+        """
+        while self.running:
+            self.replicas_changed.wait(REPUBLISH_INTERVAL)
+            # Peers often come and go several at a time
+            sleep(REPLICATION_DELAY)
+            self.replicas_changed.clear()
+            if self.light or not self.running:
+                continue
+            sends = {}
+            for image_id in self.storage:
+                key = image_key(image_id)
+                nodes = self.routing.closest(key, self.replication) + [(self.routing.own_key, None)]
+                nodes = [contact for _, contact in sorted(nodes, key=lambda item: item[0] ^ key)[:self.replication]]
+                responsible = None in nodes
+                closer = nodes[:nodes.index(None)] if responsible else nodes
+                missing = [peer for peer in nodes if peer is not None and not self.availability.holders(image_id, [peer])]
+                if missing and not any(self.availability.holders(image_id, [peer]) for peer in closer):
+                    for peer in missing:
+                        sends.setdefault(peer, []).append(image_id)
+                elif not responsible and not missing and self.find_owner(image_id) != self.user_id:
+                    self.storage.remove(image_id)
+                    # The closest nodes would otherwise count this client as a holder
+                    for peer in nodes:
+                        self.send_message(peer, MessageType.DROPPED_IMAGE, image_id.encode())
+            for peer, ids in sends.items():
+                threading.Thread(target=self.send_images, args=(peer, ids)).start()
+
+    def send_images(self, peer, image_ids):
+        """
+        Sends images to a peer one after the other
+        """
+        for image_id in image_ids:
+            self.send_image(peer, image_id)
+
+    def send_image(self, peer, image_id):
+        """
+        Sends a NEW_IMAGE message to a peer and removes the peer if the connection is closed
+        """
+        try:
+            channel = self.peers[peer]["channel"]
+            codec = self.peers[peer].get("codecs", {}).get(MessageType.NEW_IMAGE.value, Compression.RAW)
+            with self.storage.open(image_id) as f:
+                out, _ = channel.open(MessageType.NEW_IMAGE.encode(), reply=False)
+                out.sendall(image_id.encode())
+                Compression.send_file(out, f, self.storage.size(image_id), codec)
+                out.close()
+            self.availability.add(peer, image_id)
+        except KeyError:
+            pass
+        except (ConnectionAbortedError, ConnectionResetError):
+            self.remove_peer(peer)
     
-    def get_image(self, image_id):
+    @profiled("fetch_image")
+    def fetch_image(self, image_id, progress=None):
         """
-        Given an image id, fetches the image data
+        Makes sure the image is in the client's storage, returns True if it is
 
         First, it checks if the image is already stored in the client's storage
-        If not, client picks a random peer and requests the image data
-            Client continues to ask other peers until it finds the image data or all peers are exhausted
+        If not, client requests the image from the peers known to hold it, a few of them in parallel
+            If none of them delivers, client looks up the nodes closest to the image, which store it,
+            and requests it from them in parallel
+            If none of them delivers either, client asks the remaining likely holders one by one
+        Peers are tried from the fastest and most honest ones
+        The image is streamed to disk and checked against its id
+        :param progress: Called as progress(tmp_path, size) while the image arrives, for previews of the partial image
         """
         if image_id in self.storage:
-            return self.storage[image_id]
-        
+            return True
+
         peers = list(self.peers.keys())
-        random.shuffle(peers)
-        for peer in peers:
-            conn = self.peers[peer]["sock"]
-            conn.sendall(MessageType.GET_IMAGE.encode() + image_id.encode())
-            data = conn.recv(3)
+        cost = lambda peer: self.scores.cost(peer, TRANSFER_SIZE_HINT)
+        holders = self.availability.holders(image_id, peers, key=cost)
+
+        if not self.fetch_image_from_any(holders[:FETCH_FANOUT], image_id, progress):
+            closest = [peer for peer in self.closest_nodes(image_id) if peer is not None and peer not in holders[:FETCH_FANOUT]]
+            if not self.fetch_image_from_any(closest, image_id, progress):
+                for peer in holders[FETCH_FANOUT:]:
+                    if image_id in self.storage or self.fetch_image_from(peer, image_id, progress):
+                        break
+
+        if image_id not in self.storage:
+            return False
+        self.perceptual_index.add(image_id, self.storage.path(image_id))
+        # Let the peers know there is one more holder of the image
+        self.broadcast(MessageType.HAVE_IMAGE, image_id.encode())
+        return True
+
+    def fetch_image_from_any(self, peers, image_id, progress=None):
+        """
+        Requests an image from several peers at once, returns True once one of them delivered it
+        """
+        if not peers:
+            return False
+        with ThreadPoolExecutor(max_workers=FETCH_FANOUT) as executor:
+            futures = [executor.submit(self.fetch_image_from, peer, image_id, progress) for peer in peers]
+            for future in as_completed(futures):
+                if future.result():
+                    return True
+        return image_id in self.storage
+
+    def fetch_image_from(self, peer, image_id, progress=None):
+        """
+        Requests an image from a single peer and streams it into the storage
+        Returns True if the peer delivered the image
+        """
+        if image_id in self.storage:
+            return True
+        try:
+            started = monotonic()
+            conn = self.peers[peer]["channel"].request(MessageType.GET_IMAGE.encode(), image_id.encode())
+            data = Compression.recv_exact(conn, 3)
 
             if data == MessageType.FAILURE.encode():
-                continue
+                self.availability.discard(peer, image_id)
+                return False
 
-            image_data = data
+            writer = self.storage.writer(image_id, progress)
+            try:
+                Compression.recv_payload(conn, writer, MAX_IMAGE_SIZE)
+            except BaseException:
+                writer.abort()
+                raise
+        except (KeyError, ConnectionAbortedError, ConnectionResetError):
+            self.remove_peer(peer)
+            return False
+        except ValueError:
+            conn.discard()
+            self.availability.discard(peer, image_id)
+            self.scores.penalize(peer, BAD_DATA)
+            return False
+        if writer.commit()[0] is None:
+            # The peer sent data that does not match the id
+            self.availability.discard(peer, image_id)
+            self.scores.penalize(peer, BAD_DATA)
+            return False
+        self.scores.transfer(peer, writer.size, monotonic() - started)
+        self.availability.add(peer, image_id)
+        return True
 
-            while not image_data.endswith(MessageType.END.encode()):
-                image_data += conn.recv(1024)
-            self.storage[image_id] = image_data
+    def thumbnail(self, image_id, size):
+        """
+        Returns the thumbnail of an image from the cache, or generated from the stored image
+        Returns None if neither has it
+        """
+        data = self.thumbnails.get(image_id, size)
+        if data is None and image_id in self.storage:
+            data = self.thumbnails.generate(image_id, size, self.storage.path(image_id))
+        return data
 
-            return image_data
+    def fetch_thumbnail(self, image_id, size):
+        """
+        Returns a JPEG preview of an image that fits in size x size, rounded up to a size bucket
+        It comes from this client if it can, else from the likely holders of the image and
+        then from the nodes closest to it, a few in parallel. Previews from peers are cached
+        They cannot be checked against the image id, the image itself is checked once it is opened
+        At most MAX_THUMBNAIL_FETCHES are fetched from the peers at once, the others wait their turn
+        Returns None if no peer has it
+        """
+        data = self.thumbnail(image_id, size)
+        if data is not None:
+            return data
+        with self.thumbnail_fetches:
+            # Another caller may have fetched it while this one waited
+            data = self.thumbnails.get(image_id, size)
+            if data is not None:
+                return data
+            cost = lambda peer: self.scores.cost(peer, MAX_THUMBNAIL_SIZE)
+            holders = self.availability.holders(image_id, list(self.peers), key=cost)[:FETCH_FANOUT]
+            data = self.fetch_thumbnail_from_any(holders, image_id, size)
+            if data is None:
+                closest = [peer for peer in self.closest_nodes(image_id) if peer is not None and peer not in holders]
+                data = self.fetch_thumbnail_from_any(closest, image_id, size)
+        if data is not None:
+            self.thumbnails.put(image_id, size, data)
+        return data
+
+    def fetch_thumbnail_from_any(self, peers, image_id, size):
+        """
+        Requests a thumbnail from several peers at once, returns the first one delivered or None
+        """
+        if not peers:
+            return None
+        with ThreadPoolExecutor(max_workers=FETCH_FANOUT) as executor:
+            futures = [executor.submit(self.fetch_thumbnail_from, peer, image_id, size) for peer in peers]
+            for future in as_completed(futures):
+                if (data := future.result()) is not None:
+                    return data
+        return None
 
+    def fetch_thumbnail_from(self, peer, image_id, size):
+        """
+        Requests a thumbnail from a single peer, returns it or None
+        """
+        try:
+            response = self.peers[peer]["channel"].request(MessageType.GET_THUMBNAIL.encode(), struct.pack("!64sH", image_id.encode(), bucket(size)))
+            if Compression.recv_exact(response, 3) != MessageType.ALL_OK.encode():
+                return None
+            return Compression.recv_payload(response, limit=MAX_THUMBNAIL_SIZE)
+        except (KeyError, ConnectionAbortedError, ConnectionResetError):
+            self.remove_peer(peer)
+            return None
+        except ValueError:
+            response.discard()
+            self.scores.penalize(peer, BAD_DATA)
+            return None
+
+    def get_image(self, image_id):
+        """
+        Given an image id, fetches the image data
+        Returns None if no peer has the image
+        """
+        if self.fetch_image(image_id):
+            return self.storage[image_id]
         return None
     
     def add_transaction(self, transaction, own=False):
@@ -411,54 +1326,137 @@ class Client:
         Adds a transaction to the current block and starts mining
         Optionally sends the transaction to all peers if applicable
         """
-        if not self.current_block.stop and len(self.current_block.transactions) > 0: # If the block is already mining
-            self.current_block._stop()
-            
-        self.current_block.add_transaction(transaction)
-        self.current_block.mine(self.blockchain.difficulty)
+        self.add_transactions([transaction], own)
+
+    def add_transactions(self, transactions, own=False):
+        """
+        Adds transactions to the current block and restarts mining once for all of them
+        Optionally sends them to all peers in a single message
+        Light clients do not mine, they only send their own transactions to the full peers
+        """
+        if not self.light:
+            with self.block_lock:
+                if self.current_block.mining: # If the block is already mining
+                    self.current_block._stop()
+
+                self.current_block.add_transactions(transactions)
+                self.start_mining(self.current_block)
         
         if own:
-           self.broadcast(MessageType.NEW_TRANSACTION.encode() + transaction.to_struct() + MessageType.END.encode())
+            if len(transactions) == 1:
+                self.broadcast(MessageType.NEW_TRANSACTION, transactions[0].to_struct())
+            else:
+                self.broadcast(MessageType.NEW_TRANSACTIONS, Transaction.list_to_struct(transactions))
 
-    def create_nft(self, image_data):
+    def create_nft(self, image):
         """
-        Given the image data, creates an NFT and adds it to the blockchain
+        Given the image data or the path to an image file, creates an NFT and adds it to the blockchain
+        The image is streamed into the storage while it is hashed
         """
-        image_hash = sha256(image_data).hexdigest()
-        for image in self.blockchain.all_images():
-            if image_hash == image:
-                print(f"Image is already owned by 0x{self.blockchain.find_owner(image_hash)}.")
-                return False
-            
-        image_id = self.save_image(image_data)
-        transaction = Transaction(self.user_id, self.user_id, image_id)
-        self.add_transaction(transaction, True)
-        return True
-        
+        return bool(self.create_nfts([image]))
+
+    @profiled("create_nfts")
+    def create_nfts(self, images, workers=None):
+        """
+        Given a list of image data or paths to image files, creates an NFT for each new image
+        The images are stored and hashed in parallel, then checked against the ownership index
+        All the NFTs go out in a single message and mining is restarted once
+        Returns the ids of the created NFTs
+        """
+        if self.light:
+            print("A light client cannot check new images against the chain, create them on a full client.")
+            return []
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            saved = list(executor.map(self.save_image, images))
+
+        # image id -> whether the batch added the image to the storage
+        candidates = {}
+        for image_id, new in saved:
+            if image_id in candidates:
+                # The same image is in the batch twice
+                continue
+            if self.storage.size(image_id) > MAX_IMAGE_SIZE:
+                # Peers would refuse to store it
+                print(f"Image is larger than {MAX_IMAGE_SIZE // (1024 * 1024)} MiB.")
+                if new:
+                    self.storage.remove(image_id)
+                continue
+            if (owner := self.blockchain.find_owner(image_id)) is not None:
+                print(f"Image is already owned by 0x{owner}.")
+                if new:
+                    self.storage.remove(image_id)
+                continue
+            candidates[image_id] = new
+
+        # Re-encoded or resized copies of someone else's image are rejected as well
+        phashes = self.perceptual_index.hash_many([self.storage.path(image_id) for image_id in candidates], workers)
+        created = []
+        for (image_id, new), phash in zip(candidates.items(), phashes):
+            for _, match in self.perceptual_index.find(value=phash):
+                owner = self.blockchain.find_owner(match)
+                if owner is not None and owner != self.user_id:
+                    print(f"Image is a near-duplicate of 0x{match} owned by 0x{owner}.")
+                    if new:
+                        self.storage.remove(image_id)
+                    break
+            else:
+                self.perceptual_index.add(image_id, value=phash)
+                created.append(image_id)
+
+        if created:
+            self.store_images(created)
+            self.add_transactions([Transaction(self.user_id, self.user_id, image_id) for image_id in created], True)
+        return created
 
     def transfer_nft(self, image_id, recipient_id):
         """
         Given the image id and recipient id, transfers the NFT to the recipient
         Client must be the owner of the NFT to transfer it
         """
+        return bool(self.transfer_nfts([(image_id, recipient_id)]))
 
-        if self.blockchain.find_owner(image_id) != self.user_id:
-            print(f"The image is owned by 0x{self.blockchain.find_owner(image_id)}")
-            return False
-        
-        transaction = Transaction(self.user_id, recipient_id, image_id)
-        self.add_transaction(transaction, True)
-        return True
+    @profiled("transfer_nfts")
+    def transfer_nfts(self, transfers):
+        """
+        Given a list of (image id, recipient id) pairs, transfers the NFTs owned by the client
+        All the transfers go out in a single message and mining is restarted once
+        Returns the ids of the transferred NFTs
+        """
+        transactions = []
+        transferred = set()
+        for image_id, recipient_id in transfers:
+            if image_id in transferred:
+                print(f"Image 0x{image_id} is transferred more than once.")
+                continue
+            if (owner := self.find_owner(image_id)) != self.user_id:
+                print(f"The image is owned by 0x{owner}")
+                continue
+            transferred.add(image_id)
+            transactions.append(Transaction(self.user_id, recipient_id, image_id))
+
+        if transactions:
+            self.add_transactions(transactions, True)
+        return [transaction.image_id for transaction in transactions]
 
+    @profiled("send_block")
     def send_block(self, block):
         """
         Utility function to broadcast a block to all peers
         """
-        message = MessageType.NEW_BLOCK.encode() + block.to_struct() + MessageType.END.encode()
+        message = block.to_struct()
         results = {"success": 0, "failure": 0}
-        for peer in self.peers:
-            self.peers[peer]["sock"].sendall(message)
-            data = self.peers[peer]["sock"].recv(3)
+        # The block goes out to every peer before any answer is awaited
+        # Light clients get it as well, but only the full peers have a say in whether it stays
+        peers = list(self.peers)
+        full = set(self.full_peers())
+        responses = [self.request(peer, MessageType.NEW_BLOCK, message) for peer in peers]
+        for peer, response in zip(peers, responses):
+            if peer not in full or response is None:
+                continue
+            try:
+                data = Compression.recv_exact(response, 3)
+            except ConnectionResetError:
+                continue
             if data == MessageType.ALL_OK.encode():
                 results["success"] += 1
             else:
@@ -468,67 +1466,171 @@ class Client:
             self.get_blockchain()
 
 
-    def update_difficulty(self, difficulty = None):
+    def start_mining(self, block):
         """
-        Utility function to run everytime a new block is mined or received
-        This checks whether the difficulty will be updated or not
+        Starts mining the given block and hands it to the coordinator once it is mined
         """
+        future = block.mine(self.blockchain.target)
+        future.add_done_callback(self._on_block_mined)
+        if self.pool:
+            self.pool.publish(block, self.blockchain.target)
+        return future
 
-        if difficulty is None:
-            changed, difficulty = self.blockchain.adjust_difficulty()
-            if not changed:
-                return
-            self.broadcast(MessageType.NEW_DIFFICULTY.encode() + struct.pack("!H", difficulty))
-        
-        self.diffs[difficulty] = self.diffs.get(difficulty, 0) + 1
-        if self.diffs[difficulty] > len(self.peers) // 2:
-            self.blockchain.difficulty = difficulty
-            self.diffs = {}
+    def _on_block_mined(self, future):
+        """
+        Mining future callback, runs on the worker that found the hash
+        Cancelled futures are ignored, the coordinator only cares about mined blocks
+        """
+        if not future.cancelled():
+            self.mined_blocks.put(future.result())
+
+    def shutdown(self):
+        """
+        Stops mining and wakes up the coordinator so that it can close the peer connections
+        Closing the tracker connection logs the user out
+        """
+        self.running = False
+        self.current_block._stop()
+        self.mined_blocks.put(None)
+        if self.query_server:
+            self.query_server.close()
+        if self.pool:
+            self.pool.close()
+        try:
+            # shutdown wakes up the tracker watcher blocked in recv
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
 
     def receive_block(self, block):
         """
         Receives a block from a peer and adds it to the blockchain
         """
-        if self.blockchain.add_block(block):
+        if self.light:
+            return self.receive_header(block)
+        with self.block_lock:
+            if not self.blockchain.add_block(block):
+                return False
             self.current_block._stop()
             self.current_block = Block([], self.blockchain.last_hash)
-            self.update_difficulty()
-            return True
-        else:
-            return False
+        self.save_snapshot()
+        return True
         
-    def receive_image(self, image_id, image_data):
+    def receive_header(self, block):
         """
-        Receives an image from a peer and stores it
+        Light clients keep the header of a received block and the transactions of the user in it
+        The block hash commits to the merkle root of the transactions it came with, so those need no proof
+        A block that does not extend the known headers means blocks were missed, the headers are fetched again
         """
+        header = BlockHeader.of(block)
+        with self.block_lock:
+            height = self.blockchain.height
+            if not self.blockchain.add_block(header):
+                chain = self.blockchain.chain
+                known = {chain[-1].hash} | ({chain[-2].hash} if len(chain) > 1 else set())
+                if header._hash() == header.hash and header.previous_hash not in known and not self.header_sync.locked():
+                    threading.Thread(target=self.get_headers, daemon=True).start()
+                return False
+            if self.blockchain.height == height:
+                # The tip was replaced, and so were the transactions proven in it
+                self.proven = [proof for proof in self.proven if proof[0] < height]
+            for index, transaction in enumerate(block.transactions):
+                if self.user_id in (transaction.sender, transaction.receiver):
+                    self.proven.append((self.blockchain.height, index, transaction))
+        return True
 
-        self.storage[image_id] = image_data
+    def receive_image(self, image_id):
+        """
+        Indexes the perceptual hash of an image received from a peer and already in the storage
+        Near-duplicates of images minted by someone else are reported
+        """
+
+        phash = self.perceptual_index.hash(self.storage.path(image_id))
+        sender = self.blockchain.find_owner(image_id)
+        for _, match in self.perceptual_index.find(value=phash, exclude=image_id):
+            owner = self.blockchain.find_owner(match)
+            if owner is not None and owner != sender:
+                print(f"Received image 0x{image_id} is a near-duplicate of 0x{match} owned by 0x{owner}.")
+                break
+        self.perceptual_index.add(image_id, value=phash)
         return True
+
+    @profiled("index_images")
+    def index_images(self, workers=None):
+        """
+        Indexes the perceptual hashes of all the stored images in parallel
+        Returns the number of newly indexed images
+        """
+        return self.perceptual_index.add_many([(image_id, self.storage.path(image_id)) for image_id in self.storage], workers)
         
     def mine(self):
         """
-        Threaded function to check for mined block. This does not mine a block
-        but rather updates difficulty, sends mined blocks to other users etc
+        Threaded function to handle mined blocks. This does not mine a block
+        but rather adds mined blocks to the chain, sends mined blocks to other users etc
+        The thread sleeps until a mining future delivers a block or the client shuts down
         """
         while True:
-            if self.current_block.hash:
-                print("Block mined.")
-                mine_success = self.blockchain.add_block(self.current_block)
-                if not mine_success:
-                    self.get_blockchain()
-                    continue
-                self.send_block(self.current_block)
+            block = self.mined_blocks.get()
+            if block is None or not self.running:
+                break
+            self.handle_mined_block(block)
+
+        for peer in list(self.peers):
+            self.remove_peer(peer)
+
+    @profiled("mine")
+    def handle_mined_block(self, block):
+        """
+        Adds a mined block to the chain and sends it to the peers
+        If the chain moved on meanwhile, the transactions are mined again on top of the peers' chain
+        """
+        with self.block_lock:
+            if block is not self.current_block:
+                # The block was replaced by a received one before it could be handled
+                return
+            print("Block mined.")
+            mine_success = self.blockchain.add_block(block)
+            if mine_success:
                 self.current_block = Block([], self.blockchain.last_hash)
-                self.update_difficulty()
-            sleep(0.01)
-            if not self.running:
-                for peer in self.peers:
-                    try:
-                        self.peers[peer]["sock"].close()
-                    except:
-                        pass
+        if not mine_success:
+            # Rebase the pending transactions on top of the peers' chain and mine again
+            # The lock is not held while the chain is fetched, so handlers keep running
+            self.get_blockchain()
+            with self.block_lock:
+                # Transactions added while the chain was fetched went to the current block, which a
+                # received block may have replaced. Those the peers' chain already holds are dropped,
+                # replaying a confirmed transfer would hand the image back to its former owner
+                transactions = block.transactions
+                if self.current_block is not block:
+                    transactions = transactions + self.current_block.transactions
+                self.current_block._stop()
+                self.current_block = Block(self.unconfirmed(transactions, block.previous_hash), self.blockchain.last_hash)
+                self.start_mining(self.current_block)
+            return
+        self.send_block(block)
+        self.save_snapshot()
+
+    def unconfirmed(self, transactions, fork_hash):
+        """
+        Returns the transactions that are not in the chain, in order and without repeats
+        Only the blocks after fork_hash are searched, the transactions were mined on top of it
+        """
+        confirmed = set()
+        for chain_block in reversed(self.blockchain.chain):
+            if chain_block.hash == fork_hash:
+                break
+            confirmed.update(trx.to_struct() for trx in chain_block.transactions)
+        pending = []
+        for trx in transactions:
+            key = trx.to_struct()
+            if key not in confirmed:
+                confirmed.add(key)
+                pending.append(trx)
+        return pending
     
     def create_image(self):
+        from tkinter import filedialog
 
         cwd = os.getcwd()
 
@@ -543,9 +1645,7 @@ class Client:
         )
         
         if file_path:
-            with open(file_path, 'rb') as file:
-                image_data = file.read()
-            success = self.create_nft(image_data)
+            success = self.create_nft(file_path)
             
         else:
             raise Exception
@@ -557,6 +1657,13 @@ class Client:
        
         
     def frontend(self):
+        # The GUI toolkits are only loaded by GUI clients, headless ones start without a display
+        import customtkinter
+        import tkinter as tk
+        from PIL import Image, ImageTk, ImageFile
+        # Images still downloading are shown as far as they arrived
+        ImageFile.LOAD_TRUNCATED_IMAGES = True
+
         interface = customtkinter.CTk()
         interface.title("Anik's Blockchain Network")
         interface.geometry("900x650")
@@ -571,12 +1678,14 @@ class Client:
         welcome_label.grid(row=0, column=0, columnspan=3, pady=(20, 20), sticky="ew")
 
         def terminate():
-            self.running = False
+            loader.shutdown(wait=False, cancel_futures=True)
+            self.shutdown()
             interface.destroy()
             interface.quit()
 
         def refresh_peers():
             if not self.running:
+                loader.shutdown(wait=False, cancel_futures=True)
                 interface.destroy()
                 interface.quit()
                 return
@@ -637,27 +1746,113 @@ class Client:
 
         img_canvas.configure(yscrollcommand=img_scrollbar.set)
 
+        # image id -> decoded thumbnail, and (image id, width) -> its PhotoImage, so a refresh fetches nothing again
+        thumbs = {}
+        photos = {}
+        # Thumbnails are fetched and decoded on other threads, only the Tk thread may create PhotoImages
+        decoded = queue.Queue()
+        # image id -> time after which a thumbnail that could not be fetched is asked for again
+        pending = {}
+        # loader fetches the thumbnails a few at a time, a large gallery queues the rest
+        loader = ThreadPoolExecutor(max_workers=MAX_THUMBNAIL_FETCHES)
+
+        def load_thumbnail(image, size):
+            img = None
+            data = self.fetch_thumbnail(image, size)
+            if data:
+                try:
+                    img = Image.open(io.BytesIO(data))
+                    img.load()
+                except (OSError, SyntaxError, ValueError):
+                    img = None
+            decoded.put((image, img))
+
+        def fit(img, width, height):
+            """
+            Scales an image, up or down, to fit in width x height
+            """
+            scale = min(width / img.width, height / img.height)
+            return img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.LANCZOS)
+
+        def open_image(image):
+            """
+            Opens an image in its own window. The thumbnail is shown scaled up at once, the image
+            is downloaded in the background and shown as far as it arrived every 250 ms
+            """
+            window = customtkinter.CTkToplevel(interface)
+            window.title(f"0x{image}")
+            picture = tk.Label(window)
+            picture.pack(padx=10, pady=10)
+            status = customtkinter.CTkLabel(window, text="Downloading...")
+            status.pack(pady=(0, 10))
+            # Written by the download thread, read by the Tk thread
+            download = {"path": None, "size": 0, "shown": 0, "done": None}
+
+            def show(img):
+                photo = ImageTk.PhotoImage(fit(img, 800, 600))
+                picture.configure(image=photo)
+                picture.image = photo
+
+            def progress(path, size):
+                download["path"], download["size"] = path, size
+
+            def fetch():
+                download["done"] = self.fetch_image(image, progress)
+
+            def poll():
+                if not window.winfo_exists():
+                    return
+                if download["done"] is not None:
+                    if download["done"]:
+                        show(Image.open(self.storage.path(image)))
+                        status.configure(text=f"0x{image}")
+                    else:
+                        status.configure(text="Image not found.")
+                    return
+                if download["size"] > download["shown"]:
+                    download["shown"] = download["size"]
+                    status.configure(text=f"Downloading... {download['size'] // 1024} KiB")
+                    try:
+                        # The file grows while it is read, and is moved away once it is complete
+                        with open(download["path"], "rb") as f:
+                            partial = Image.open(f)
+                            partial.load()
+                        show(partial)
+                    except (OSError, SyntaxError, ValueError):
+                        pass
+                window.after(250, poll)
+
+            if image in thumbs:
+                show(thumbs[image])
+            threading.Thread(target=fetch, daemon=True).start()
+            poll()
+
         def screenshow():
             img_canvas.update_idletasks()
             canvas_width = img_canvas.winfo_width()
+            scaled_width = max(1, canvas_width // 2 - 30)
+
+            while not decoded.empty():
+                image, img = decoded.get()
+                if img is None:
+                    pending[image] = monotonic() + THUMBNAIL_RETRY
+                else:
+                    thumbs[image] = img
 
             for widget in img_frame.winfo_children():
                 widget.destroy()
 
-            image_stack = []
-            for image in self.blockchain.all_images():
-                user_name = f"0x{self.blockchain.find_owner(image)}"
-                image_id = f"0x{image}"
-                image_data = self.get_image(image)
-                if image_data:
-                    img = Image.open(io.BytesIO(image_data))
-                    image_stack.insert(0, (user_name, image_id, img))
+            state = self.blockchain.state
+            # Light clients only know their own images
+            images = [(image, self.user_id) for image in self.owned_images()] if self.light else [(image, state.find_owner(image)) for image in state.all_images()]
+            # The newest images first
+            image_stack = list(reversed(images))
 
             row = 0
             selected_filter = image_filter.get()
             i = 0
-            for (user_name, image_id, img) in image_stack:
-                if selected_filter == "Owned" and user_name != f"0x{self.user_id}":
+            for (image, owner) in image_stack:
+                if selected_filter == "Owned" and owner != self.user_id:
                     continue
 
                 if i == 0:
@@ -665,16 +1860,25 @@ class Client:
 
                 col = i % 2
 
-                scaled_width = canvas_width // 2 - 30
-                scaled_height = int((scaled_width / img.width) * img.height)
-                img = img.resize((scaled_width, scaled_height), Image.LANCZOS)
-                tk_thumb = ImageTk.PhotoImage(img)
-
-                thumbnail_label = tk.Label(img_frame, image=tk_thumb)
-                thumbnail_label.image = tk_thumb
+                if image not in thumbs and pending.get(image, 0) <= monotonic():
+                    # Asked for again only once it failed and the retry time has passed
+                    pending[image] = float("inf")
+                    loader.submit(load_thumbnail, image, scaled_width)
+
+                if image in thumbs:
+                    tk_thumb = photos.get((image, scaled_width))
+                    if tk_thumb is None:
+                        img = thumbs[image]
+                        scaled_height = int((scaled_width / img.width) * img.height)
+                        tk_thumb = photos[(image, scaled_width)] = ImageTk.PhotoImage(img.resize((scaled_width, max(1, scaled_height)), Image.LANCZOS))
+                    thumbnail_label = tk.Label(img_frame, image=tk_thumb, cursor="hand2")
+                    thumbnail_label.image = tk_thumb
+                else:
+                    thumbnail_label = tk.Label(img_frame, text="Loading preview...", width=30, height=10, cursor="hand2")
+                thumbnail_label.bind("<Button-1>", lambda event, image=image: open_image(image))
                 thumbnail_label.grid(row=row, column=col, padx=10, pady=10)
 
-                owner_label = tk.Label(img_frame, text=f"Owner: {user_name}           Image ID: {image_id}",
+                owner_label = tk.Label(img_frame, text=f"Owner: 0x{owner}           Image ID: 0x{image}",
                                     bg="#DBDBDB", fg="#3B8ED0", font=('Arial', 12, "bold"))
                 owner_label.grid(row=row + 1, column=col, sticky="ew", padx=10)
                 i += 1
@@ -698,5 +1902,12 @@ if __name__ == "__main__":
     parser.add_argument("tracker_host", type=str, help="Host of the tracker")
     parser.add_argument("tracker_port", type=str, help="Port of the tracker")
     parser.add_argument("client_type", type=str, help="Type of client (cli/gui)", choices=["cli", "gui"], default="none")
+    parser.add_argument("--standby", type=str, action="append", default=[], help="host:port of a standby tracker, can be repeated")
+    parser.add_argument("--query-port", type=int, default=None, help="Local port to serve the read-only HTTP query API on")
+    parser.add_argument("--profile", type=str, default=None, help="Profile from the start and write the profile to this path prefix on SIGUSR1 and at exit")
+    parser.add_argument("--light", action="store_true", help="Run as a light client that keeps the block headers only")
+    parser.add_argument("--replication", type=int, default=REPLICATION, help="Number of nodes closest to an image that store it")
+    parser.add_argument("--pool-port", type=int, default=None, help="Port to hand out the block being mined to pool workers (Pool.py) on")
     args = parser.parse_args()
-    client = Client("", int(args.port), args.tracker_host, int(args.tracker_port), args.client_type)
+    standby = [(tracker.rsplit(":", 1)[0], int(tracker.rsplit(":", 1)[1])) for tracker in args.standby]
+    client = Client("", int(args.port), args.tracker_host, int(args.tracker_port), args.client_type, standby_trackers=standby, query_port=args.query_port, profile=args.profile, light=args.light, replication=args.replication, pool_port=args.pool_port)
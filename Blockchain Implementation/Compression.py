@@ -0,0 +1,264 @@
+import struct
+import zlib
+import lzma
+
+# Codec ids as sent on the wire in front of every compressible payload
+RAW = 0
+ZLIB = 1
+LZMA = 2
+
+# Bitmask of the codecs this node can decode, sent during the connection handshake
+SUPPORTED = (1 << ZLIB) | (1 << LZMA)
+
+# Preferred codecs per message type header, the first one both sides support is used
+# Chains are mostly hex ASCII and worth the slower lzma, images are sent with zlib
+PREFERENCES = {
+    "SBC": [LZMA, ZLIB],
+    "GSN": [LZMA, ZLIB],
+    "GBL": [LZMA, ZLIB],
+    "GHD": [LZMA, ZLIB],
+    "GPF": [ZLIB],
+    "SIM": [ZLIB],
+    "GIM": [ZLIB],
+}
+
+# Payloads smaller than this are sent raw
+THRESHOLD = 1024
+# Size of the chunks fed to the compressor and of the frames on the wire
+CHUNK_SIZE = 64 * 1024
+
+# Magic numbers of formats that are already compressed
+COMPRESSED_MAGIC = [
+    b"\xff\xd8\xff",        # JPEG
+    b"\x89PNG\r\n\x1a\n",   # PNG
+    b"GIF8",                # GIF
+    b"\x1f\x8b",            # gzip
+    b"PK\x03\x04",          # zip
+    b"\xfd7zXZ\x00",        # xz
+]
+
+
+def negotiate(local_mask: int, remote_mask: int):
+    """
+    Picks a codec for every compressible message type from the codecs both sides support
+    Both ends run the same function on the same masks so they agree without another round trip
+    :param local_mask: The codecs supported by this node
+    :param remote_mask: The codecs supported by the peer
+    """
+    common = local_mask & remote_mask
+    codecs = {}
+    for message_type, preferred in PREFERENCES.items():
+        codecs[message_type] = next((codec for codec in preferred if common & (1 << codec)), RAW)
+    return codecs
+
+
+def looks_compressed(data):
+    """
+    Checks the magic number of the payload for formats that would not shrink further
+    """
+    head = bytes(data[:8])
+    return any(head.startswith(magic) for magic in COMPRESSED_MAGIC) or (head[:4] == b"RIFF" and bytes(data[8:12]) == b"WEBP")
+
+
+def _compressor(codec: int):
+    if codec == ZLIB:
+        return zlib.compressobj()
+    if codec == LZMA:
+        return lzma.LZMACompressor()
+    return None
+
+
+def _decompressor(codec: int):
+    if codec == ZLIB:
+        return zlib.decompressobj()
+    if codec == LZMA:
+        return lzma.LZMADecompressor()
+    if codec == RAW:
+        return None
+    raise ValueError(f"Unknown codec {codec}")
+
+
+def _pieces(segments):
+    """
+    Splits the segments into groups of at most CHUNK_SIZE bytes without copying them
+    Small segments are grouped together and large ones are cut into several pieces
+    """
+    group, size = [], 0
+    for segment in segments:
+        for start in range(0, len(segment), CHUNK_SIZE):
+            piece = segment[start:start + CHUNK_SIZE]
+            if size + len(piece) > CHUNK_SIZE:
+                yield group, size
+                group, size = [], 0
+            group.append(piece)
+            size += len(piece)
+    if group:
+        yield group, size
+
+
+def _frames(payload, codec: int, threshold: int = THRESHOLD):
+    """
+    Generator that streams the payload as frames: 1 byte codec id, then length prefixed
+    chunks, then an empty chunk. Small or already compressed payloads are sent raw
+    Every frame is yielded as a list of buffers so that raw chunks are never copied
+    :param payload: bytes-like object to send, or a list of them sent as if they were joined
+    :param codec: The negotiated codec for the message type
+    :param threshold: Payloads smaller than this are not compressed
+    """
+    segments = [memoryview(segment).cast("B") for segment in (payload if isinstance(payload, list) else [payload])]
+    segments = [segment for segment in segments if len(segment)]
+    head = b"".join([bytes(segment[:12]) for segment in segments[:3]])
+    if sum(len(segment) for segment in segments) < threshold or looks_compressed(head):
+        codec = RAW
+    yield [struct.pack("!B", codec)]
+    compressor = _compressor(codec)
+    for group, size in _pieces(segments):
+        if not compressor:
+            yield [struct.pack("!I", size)] + group
+            continue
+        out = b"".join([compressor.compress(piece) for piece in group])
+        if out:
+            yield [struct.pack("!I", len(out)), out]
+    if compressor:
+        out = compressor.flush()
+        if out:
+            yield [struct.pack("!I", len(out)), out]
+    yield [struct.pack("!I", 0)]
+
+
+def framed_size(size: int):
+    """
+    Upper bound of the framed size of a payload of size bytes: the codec byte, the chunk
+    lengths, the end marker and what a compressor adds to data that does not compress
+    """
+    return size + size // 64 + 1024
+
+
+def encode(payload, codec: int, threshold: int = THRESHOLD):
+    """
+    Returns the whole framed payload as bytes
+    """
+    return b"".join(b"".join(frame) for frame in _frames(payload, codec, threshold))
+
+
+def sendmsg_all(sock, buffers):
+    """
+    Sends a list of buffers with scatter-gather I/O, retrying until everything is sent
+    """
+    buffers = [memoryview(buffer).cast("B") for buffer in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers and sent:
+            buffers[0] = buffers[0][sent:]
+
+
+def send_payload(sock, payload, codec: int, threshold: int = THRESHOLD):
+    """
+    Compresses and sends the payload frame by frame
+    A list of buffers is sent without joining it, raw frames go out with scatter-gather I/O
+    """
+    for frame in _frames(payload, codec, threshold):
+        sendmsg_all(sock, frame)
+
+
+def send_file(sock, file, size: int, codec: int, threshold: int = THRESHOLD):
+    """
+    Sends an open binary file as a framed payload without reading it into memory
+    Raw payloads go out as a single frame through sendfile, compressed ones are
+    read and compressed one chunk at a time
+    :param file: The file object, positioned at the start
+    :param size: The number of bytes in the file
+    """
+    head = file.read(12)
+    file.seek(0)
+    if size < threshold or looks_compressed(head):
+        codec = RAW
+    if codec == RAW:
+        if size:
+            sock.sendall(struct.pack("!BI", RAW, size))
+            sock.sendfile(file, 0, size)
+        else:
+            sock.sendall(struct.pack("!B", RAW))
+        sock.sendall(struct.pack("!I", 0))
+        return
+    sock.sendall(struct.pack("!B", codec))
+    compressor = _compressor(codec)
+    while chunk := file.read(CHUNK_SIZE):
+        out = compressor.compress(chunk)
+        if out:
+            sendmsg_all(sock, [struct.pack("!I", len(out)), out])
+    out = compressor.flush()
+    if out:
+        sendmsg_all(sock, [struct.pack("!I", len(out)), out])
+    sock.sendall(struct.pack("!I", 0))
+
+
+def recv_exact(sock, size: int):
+    """
+    Receives exactly size bytes from the socket
+    Raises ConnectionResetError if the connection is closed before that
+    """
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionResetError("Connection closed in the middle of a message")
+        data += chunk
+    return bytes(data)
+
+
+def _decompress(decompressor, codec: int, chunk):
+    """
+    Decompresses a chunk in pieces of at most CHUNK_SIZE bytes
+    so that a small frame cannot expand into a huge buffer
+    """
+    yield decompressor.decompress(chunk, CHUNK_SIZE)
+    if codec == ZLIB:
+        while decompressor.unconsumed_tail:
+            yield decompressor.decompress(decompressor.unconsumed_tail, CHUNK_SIZE)
+    else:
+        while not decompressor.needs_input and not decompressor.eof:
+            yield decompressor.decompress(b"", CHUNK_SIZE)
+
+
+def recv_payload(sock, sink=None, limit: int = None):
+    """
+    Receives a framed payload and decompresses it as the frames arrive
+    If a sink with a write method is given, the data is streamed into it
+    chunk by chunk and the sink is returned, otherwise the data is returned as bytes
+    :param limit: Largest payload accepted once decompressed, raises ValueError beyond it
+    """
+    codec = recv_exact(sock, 1)[0]
+    decompressor = _decompressor(codec)
+    data = bytearray() if sink is None else None
+    sink_write = data.extend if sink is None else sink.write
+    received = 0
+
+    def write(chunk):
+        nonlocal received
+        received += len(chunk)
+        # A few compressed bytes can expand into a lot, so the limit is checked on the output
+        if limit is not None and received > limit:
+            raise ValueError(f"Payload is larger than {limit} bytes")
+        sink_write(chunk)
+    while True:
+        size = struct.unpack("!I", recv_exact(sock, 4))[0]
+        if size == 0:
+            break
+        while size:
+            # Raw frames can be large, so they are read in bounded chunks as well
+            chunk = sock.recv(min(size, CHUNK_SIZE))
+            if not chunk:
+                raise ConnectionResetError("Connection closed in the middle of a message")
+            size -= len(chunk)
+            if decompressor:
+                for out in _decompress(decompressor, codec, chunk):
+                    write(out)
+            else:
+                write(chunk)
+    if codec == ZLIB:
+        write(decompressor.flush())
+    return bytes(data) if sink is None else sink
@@ -0,0 +1,135 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# Distances are taken over 128 bit keys, the size of a user id
+KEY_BITS = 128
+# Contacts kept per bucket, Kademlia's k
+BUCKET_SIZE = 20
+# Contacts waiting per bucket for a place to free up
+REPLACEMENT_SIZE = 20
+# Every image is stored on this many nodes closest to its id
+REPLICATION = 3
+# Queries in flight at once during a lookup, Kademlia's alpha
+ALPHA = 3
+
+
+def node_key(user_id: str):
+    """
+    Key of a node, its user id is already a random 128 bit number
+    """
+    return int(user_id, 16)
+
+
+def image_key(image_id: str):
+    """
+    Key of an image, the first 128 bits of its sha256
+    """
+    return int(image_id[:KEY_BITS // 4], 16)
+
+
+class RoutingTable:
+    """
+    Kademlia routing table. Contacts are filed into one bucket per length of the key prefix
+    they share with this node, and a bucket keeps at most bucket_size of them, so the table
+    knows many nodes close to its own key and a few far away from it
+    A full bucket keeps its contacts, which the pings keep checking, and newcomers wait
+    in a replacement cache until one of them leaves
+    """
+    def __init__(self, own_key: int, bucket_size: int = BUCKET_SIZE):
+        """
+        :param own_key: The key of this node
+        :param bucket_size: The number of contacts per bucket
+        """
+        self.own_key = own_key
+        self.bucket_size = bucket_size
+        self.lock = threading.Lock()
+        # bucket index -> key -> contact, the least recently seen first
+        self.buckets = [OrderedDict() for _ in range(KEY_BITS)]
+        self.replacements = [OrderedDict() for _ in range(KEY_BITS)]
+
+    def _bucket(self, key: int):
+        return (self.own_key ^ key).bit_length() - 1
+
+    def add(self, key: int, contact):
+        """
+        Adds or refreshes a contact. Returns False if its bucket is full and it has to wait
+        """
+        if key == self.own_key:
+            return False
+        index = self._bucket(key)
+        with self.lock:
+            bucket = self.buckets[index]
+            if key in bucket or len(bucket) < self.bucket_size:
+                bucket[key] = contact
+                bucket.move_to_end(key)
+                return True
+            replacements = self.replacements[index]
+            replacements[key] = contact
+            replacements.move_to_end(key)
+            if len(replacements) > REPLACEMENT_SIZE:
+                replacements.popitem(last=False)
+            return False
+
+    def remove(self, key: int):
+        """
+        Drops a contact that left, the most recently seen waiting contact takes its place
+        """
+        if key == self.own_key:
+            return
+        index = self._bucket(key)
+        with self.lock:
+            self.replacements[index].pop(key, None)
+            if self.buckets[index].pop(key, None) is not None and self.replacements[index]:
+                waiting, contact = self.replacements[index].popitem()
+                self.buckets[index][waiting] = contact
+
+    def closest(self, key: int, count: int):
+        """
+        Returns up to count (key, contact) pairs closest to the key, the closest first
+        """
+        with self.lock:
+            contacts = [item for bucket in self.buckets for item in bucket.items()]
+        contacts.sort(key=lambda item: item[0] ^ key)
+        return contacts[:count]
+
+    def __contains__(self, key: int):
+        return key != self.own_key and key in self.buckets[self._bucket(key)]
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets)
+
+
+def lookup(table: RoutingTable, key: int, ask, count: int = REPLICATION, alpha: int = ALPHA):
+    """
+    Iterative Kademlia lookup of the nodes closest to a key
+    The closest contacts known are asked for the contacts they know closest to the key, alpha
+    at a time, until the count closest contacts seen have all answered. Every round gets at
+    least one bit closer to the key, so a lookup takes O(log N) rounds
+    :param ask: Called with a contact, returns the (key, contact) pairs it knows closest to the key,
+                or None if it did not answer
+    Returns the count closest (key, contact) pairs that answered and the number of rounds
+    """
+    distance = lambda candidate: candidate ^ key
+    shortlist = dict(table.closest(key, count))
+    queried = set()
+    failed = set()
+    rounds = 0
+    with ThreadPoolExecutor(max_workers=alpha) as executor:
+        while True:
+            best = sorted((candidate for candidate in shortlist if candidate not in failed), key=distance)[:count]
+            pending = [candidate for candidate in best if candidate not in queried][:alpha]
+            if not pending:
+                break
+            rounds += 1
+            answers = list(executor.map(lambda candidate: ask(shortlist[candidate]), pending))
+            for candidate, answer in zip(pending, answers):
+                queried.add(candidate)
+                if answer is None:
+                    failed.add(candidate)
+                    continue
+                for found, contact in answer:
+                    if found != table.own_key:
+                        shortlist.setdefault(found, contact)
+    best = sorted((candidate for candidate in shortlist if candidate not in failed), key=distance)[:count]
+    return [(candidate, shortlist[candidate]) for candidate in best], rounds
@@ -0,0 +1,111 @@
+import os
+import json
+import signal
+import threading
+from uuid import uuid4
+from argparse import ArgumentParser
+from Client import Client
+from DHT import REPLICATION
+
+# Settings a config file can leave out
+DEFAULTS = {
+    "port": 0,
+    "standby": [],
+    "identity": "identity.json",
+    "username": None,
+    "data_dir": ".",
+    "light": False,
+    "replication": REPLICATION,
+    "query_port": None,
+    "profile": None,
+    "pool_port": None,
+}
+
+
+def parse_address(address: str):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def load_config(path: str):
+    """
+    Reads a JSON config file. Relative paths in it are taken from the directory of the file
+    Raises ValueError if the tracker is missing or a setting is unknown
+    """
+    with open(path) as f:
+        config = json.load(f)
+    unknown = set(config) - set(DEFAULTS) - {"tracker"}
+    if unknown:
+        raise ValueError(f"Unknown settings: {', '.join(sorted(unknown))}")
+    if "tracker" not in config:
+        raise ValueError("The tracker (host:port) is missing")
+    config = {**DEFAULTS, **config}
+    base = os.path.dirname(os.path.abspath(path))
+    for key in ("identity", "data_dir", "profile"):
+        if config[key] is not None:
+            config[key] = os.path.join(base, config[key])
+    return config
+
+
+def load_identity(path: str, username: str = None):
+    """
+    Returns (user_id, username) from an identity file
+    A new identity is created and written to the file on the first start, so the node keeps
+    its user id, and with it its images and place in the DHT, across restarts
+    """
+    if os.path.exists(path):
+        with open(path) as f:
+            identity = json.load(f)
+        return identity["user_id"], identity["username"]
+    if not username:
+        raise ValueError(f"No identity at {path}, a username is needed to create one")
+    identity = {"user_id": uuid4().hex, "username": username}
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + ".tmp"
+    # Only the owner can read the identity
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        json.dump(identity, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return identity["user_id"], identity["username"]
+
+
+def run(config: dict):
+    """
+    Runs a headless client until SIGTERM or SIGINT, then shuts it down
+    Nothing is read from the terminal and no GUI or imaging module is loaded at start
+    """
+    user_id, username = load_identity(config["identity"], config["username"])
+    tracker_host, tracker_port = parse_address(config["tracker"])
+    client = Client(
+        "", config["port"], tracker_host, tracker_port, "headless",
+        username=username,
+        data_dir=config["data_dir"],
+        user_id=user_id,
+        standby_trackers=[parse_address(tracker) for tracker in config["standby"]],
+        query_port=config["query_port"],
+        profile=config["profile"],
+        light=config["light"],
+        replication=config["replication"],
+        pool_port=config["pool_port"],
+    )
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop.set())
+    print(f"Running as 0x{user_id}")
+    # Waiting in steps lets the signal handlers run on every platform
+    while not stop.wait(1):
+        pass
+    print("Shutting down.")
+    client.shutdown()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("config", type=str, help="JSON config file of the node")
+    args = parser.parse_args()
+    run(load_config(args.config))
@@ -0,0 +1,148 @@
+import os
+import threading
+from hashlib import sha256
+from uuid import uuid4
+
+# Size of the chunks read from disk and sockets, it bounds the memory used per transfer
+CHUNK_SIZE = 64 * 1024
+
+
+class ImageWriter:
+    """
+    File-like sink that streams image data into the store while hashing it
+    The image only becomes visible in the store once it is committed
+    """
+    def __init__(self, store, image_id: str = None, progress=None):
+        """
+        :param store: The ImageStore to write into
+        :param image_id: The expected image id, the data is checked against it on commit
+        :param progress: Called as progress(tmp_path, size) after every write, with the data so far on disk
+        """
+        self.store = store
+        self.image_id = image_id
+        self.progress = progress
+        self.hasher = sha256()
+        self.size = 0
+        self.tmp_path = os.path.join(store.directory, f".{uuid4().hex}.tmp")
+        self.file = open(self.tmp_path, "wb")
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.file.write(data)
+        self.size += len(data)
+        if self.progress:
+            self.file.flush()
+            self.progress(self.tmp_path, self.size)
+        return len(data)
+
+    def commit(self):
+        """
+        Moves the written data into the store
+        Returns (image_id, new) or (None, False) if the data does not match the expected id
+        """
+        self.file.close()
+        image_id = self.hasher.hexdigest()
+        if self.image_id is not None and image_id != self.image_id:
+            os.remove(self.tmp_path)
+            return None, False
+        with self.store.lock:
+            new = image_id not in self.store
+            if new:
+                os.replace(self.tmp_path, self.store.path(image_id))
+                self.store.ids.add(image_id)
+            else:
+                os.remove(self.tmp_path)
+        return image_id, new
+
+    def abort(self):
+        """
+        Drops the written data
+        """
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
+
+
+class ImageStore:
+    """
+    Disk backed image storage keyed by the sha256 of the image
+    Images are streamed in and out in chunks and never held in memory as a whole
+    """
+    def __init__(self, directory: str):
+        """
+        :param directory: The directory the images are stored in, it is created if needed
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        # Images stored by an earlier run are served again
+        self.ids = {name for name in os.listdir(directory) if len(name) == 64 and not name.startswith(".")}
+
+    def path(self, image_id: str):
+        return os.path.join(self.directory, image_id)
+
+    def size(self, image_id: str):
+        return os.path.getsize(self.path(image_id))
+
+    def open(self, image_id: str):
+        """
+        Opens a stored image for reading in binary mode
+        """
+        return open(self.path(image_id), "rb")
+
+    def writer(self, image_id: str = None, progress=None):
+        """
+        Returns an ImageWriter for streaming an image into the store
+        """
+        return ImageWriter(self, image_id, progress)
+
+    def ingest(self, source, chunk_size: int = CHUNK_SIZE):
+        """
+        Streams an image from a file path, a binary file object or bytes into the store
+        Returns (image_id, new) where new is False if the image was already stored
+        """
+        writer = self.writer()
+        try:
+            if isinstance(source, (bytes, bytearray, memoryview)):
+                writer.write(source)
+            elif isinstance(source, (str, os.PathLike)):
+                with open(source, "rb") as f:
+                    while chunk := f.read(chunk_size):
+                        writer.write(chunk)
+            else:
+                while chunk := source.read(chunk_size):
+                    writer.write(chunk)
+        except BaseException:
+            writer.abort()
+            raise
+        return writer.commit()
+
+    def remove(self, image_id: str):
+        with self.lock:
+            if image_id in self.ids:
+                self.ids.discard(image_id)
+                os.remove(self.path(image_id))
+
+    def __contains__(self, image_id):
+        return image_id in self.ids
+
+    def __getitem__(self, image_id: str):
+        """
+        Reads a whole image into memory, used where the decoded image is needed anyway
+        """
+        if image_id not in self.ids:
+            raise KeyError(image_id)
+        with self.open(image_id) as f:
+            return f.read()
+
+    def __setitem__(self, image_id: str, image_data):
+        writer = self.writer(image_id)
+        writer.write(image_data)
+        if writer.commit()[0] is None:
+            raise ValueError(f"Image data does not match 0x{image_id}")
+
+    def __iter__(self):
+        return iter(list(self.ids))
+
+    def __len__(self):
+        return len(self.ids)
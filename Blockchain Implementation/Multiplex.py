@@ -0,0 +1,611 @@
+import socket
+import struct
+import threading
+import queue
+from collections import deque
+from time import monotonic, sleep
+
+# Every frame starts with: message type, request id, flags, payload length
+HEADER = struct.Struct("!3sIBI")
+# Flags
+RESPONSE = 1  # The frame belongs to the response to a request this side sent
+END = 2       # Last frame of the message
+NO_REPLY = 4  # The sender does not wait for a response
+WINDOW = 8    # The frame grants the sender of a stream more bytes, its payload is the 4 byte increment
+WINDOW_TYPE = b"WIN"
+
+# Largest payload per frame, control frames can be sent between two bulk frames
+FRAME_SIZE = 64 * 1024
+# Number of bulk frames that can wait to be sent before bulk writers block
+BULK_QUEUE_SIZE = 16
+# Bytes a stream can have unread at the receiver. The receiver grants more as it reads,
+# so a message is never buffered beyond this however large it is
+STREAM_WINDOW = 256 * 1024
+# Largest payload of a message type without a limit of its own
+DEFAULT_LIMIT = 64 * 1024
+# Bulk requests handled at the same time per connection, and waiting for a handler
+MAX_BULK_HANDLERS = 4
+MAX_QUEUED_BULK = 16
+# Control requests waiting to be handled per connection, the connection is not read while it is full
+MAX_QUEUED_CONTROL = 32
+
+
+class ProtocolError(Exception):
+    """
+    The peer broke the framing or the limits of the connection, which is closed
+    """
+    pass
+
+
+class TokenBucket:
+    """
+    Token bucket: rate tokens per second, up to burst of them saved up
+    Takers go into debt and sleep it off, so a taker waits exactly as long as the rate requires
+    """
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, amount: float):
+        """
+        Takes amount tokens, sleeping until the bucket has refilled enough
+        """
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - amount
+            self.updated = now
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            sleep(wait)
+
+
+def _recv_exact(sock, size: int):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionResetError("Connection closed in the middle of a frame")
+        data += chunk
+    return bytes(data)
+
+
+def _sendmsg_all(sock, buffers):
+    """
+    Sends a frame header and its payload with one scatter-gather call where possible
+    """
+    buffers = [memoryview(buffer) for buffer in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while buffers and sent >= len(buffers[0]):
+            sent -= len(buffers[0])
+            buffers.pop(0)
+        if buffers and sent:
+            buffers[0] = buffers[0][sent:]
+
+
+class InStream:
+    """
+    Receiving end of a message payload. It can be read like a socket with recv,
+    which returns b'' once the whole message has been read
+    The sender may only send STREAM_WINDOW bytes ahead of the reader, and reading grants it more
+    """
+    def __init__(self, channel=None, request_id: int = 0, response: bool = False, limit: int = None, bucket: TokenBucket = None):
+        """
+        :param channel: The channel the grants are sent on, nothing is granted without one
+        :param request_id: The request the stream belongs to
+        :param response: True for the response to a request this side sent
+        :param limit: Largest payload the message may have
+        :param bucket: Rate limit the grants are paced by, None to grant as fast as the stream is read
+        """
+        self.cond = threading.Condition()
+        self.chunks = deque()
+        self.ended = False
+        self.broken = False
+        self.channel = channel
+        self.request_id = request_id
+        self.response = response
+        self.limit = limit
+        self.bucket = bucket
+        self.received = 0
+        self.buffered = 0
+        # Bytes read since the last grant
+        self.consumed = 0
+        self.discarded = False
+
+    def check(self, length: int):
+        """
+        Called with the length of a frame before its payload is read
+        Raises ProtocolError if the frame would go over the limit or the window
+        """
+        if self.limit is not None and self.received + length > self.limit:
+            raise ProtocolError(f"Message is larger than {self.limit} bytes")
+        if self.buffered + length > STREAM_WINDOW:
+            raise ProtocolError("Frame sent beyond the stream window")
+
+    def feed(self, data, end: bool):
+        with self.cond:
+            self.received += len(data)
+            self.ended = self.ended or end
+            if data and self.discarded:
+                # Nobody reads the rest, it is dropped and the sender may go on
+                self._grant(len(data))
+            elif data:
+                self.chunks.append(memoryview(data))
+                self.buffered += len(data)
+            self.cond.notify_all()
+
+    def discard(self):
+        """
+        Drops the unread data and whatever else arrives, for readers that stop early
+        """
+        with self.cond:
+            if self.discarded:
+                return
+            self.discarded = True
+            self.chunks.clear()
+            unread = self.buffered + self.consumed
+            self.buffered = self.consumed = 0
+            self.cond.notify_all()
+        self._grant(unread)
+
+    def _grant(self, size: int):
+        if self.channel and size and not self.ended and not self.broken:
+            self.channel._grant(self.request_id, self.response, size)
+
+    def abort(self):
+        """
+        Wakes up the reader when the connection is lost
+        """
+        with self.cond:
+            self.broken = True
+            self.cond.notify_all()
+
+    def recv(self, size: int, timeout: float = None):
+        """
+        Returns b"" once the whole message was read
+        Raises TimeoutError if nothing arrives within timeout seconds, and ConnectionResetError
+        if the connection is lost or the stream was discarded before the end of the message
+        """
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.chunks or self.ended or self.broken or self.discarded, timeout):
+                raise TimeoutError("No data received in time")
+            if not self.chunks:
+                if self.discarded:
+                    raise ConnectionResetError("Stream was discarded")
+                if not self.ended:
+                    raise ConnectionResetError("Connection lost in the middle of a message")
+                return b""
+            chunk = self.chunks[0]
+            if len(chunk) <= size:
+                self.chunks.popleft()
+            else:
+                self.chunks[0] = chunk[size:]
+                chunk = chunk[:size]
+            self.buffered -= len(chunk)
+            self.consumed += len(chunk)
+            grant = self.consumed if self.consumed >= STREAM_WINDOW // 2 else 0
+            if grant:
+                self.consumed = 0
+        if grant:
+            # The reader pays for the bytes it lets in, so a rate limited sender slows down to the rate
+            if self.bucket:
+                self.bucket.take(grant)
+            self._grant(grant)
+        return bytes(chunk)
+
+    def read(self):
+        """
+        Reads the rest of the message
+        Raises ConnectionResetError if it does not arrive whole
+        """
+        data = bytearray()
+        while chunk := self.recv(FRAME_SIZE):
+            data += chunk
+        return bytes(data)
+
+
+class OutStream:
+    """
+    Sending end of a message payload. It can be written like a socket with
+    sendall, sendmsg and sendfile, and close marks the end of the message
+    Writers block while the receiver has not granted room for the next frame
+    """
+    def __init__(self, channel, message_type: bytes, request_id: int, flags: int, bulk: bool, bucket: TokenBucket = None):
+        """
+        :param bucket: Rate limit the frames are sent at, None for no limit
+        """
+        self.channel = channel
+        self.message_type = message_type
+        self.request_id = request_id
+        self.flags = flags
+        self.bulk = bulk
+        self.bucket = bucket
+        self.closed = False
+        self.credit = STREAM_WINDOW
+        self.credit_cond = threading.Condition()
+
+    def _header(self, length: int, end: bool = False):
+        return HEADER.pack(self.message_type, self.request_id, self.flags | (END if end else 0), length)
+
+    def grant(self, size: int):
+        with self.credit_cond:
+            self.credit += size
+            self.credit_cond.notify_all()
+
+    def _take_credit(self, length: int):
+        """
+        Waits until the receiver has room for a frame of the given length
+        """
+        with self.credit_cond:
+            while self.credit < length:
+                if self.channel.closed.is_set():
+                    raise ConnectionResetError("Channel is closed")
+                self.credit_cond.wait(1)
+            self.credit -= length
+        if self.bucket:
+            self.bucket.take(length)
+
+    def sendall(self, data):
+        view = memoryview(data).cast("B")
+        for start in range(0, len(view), FRAME_SIZE):
+            chunk = view[start:start + FRAME_SIZE]
+            self._take_credit(len(chunk))
+            self.channel._enqueue(self.bulk, [self._header(len(chunk)), chunk])
+
+    def sendmsg(self, buffers):
+        """
+        Packs the buffers into as few frames as possible, each frame goes out
+        as its header and the buffers with one scatter-gather call
+        """
+        frame, size, total = [], 0, 0
+        for buffer in buffers:
+            view = memoryview(buffer).cast("B")
+            total += len(view)
+            while len(view):
+                piece = view[:FRAME_SIZE - size]
+                view = view[len(piece):]
+                frame.append(piece)
+                size += len(piece)
+                if size == FRAME_SIZE:
+                    self._take_credit(size)
+                    self.channel._enqueue(self.bulk, [self._header(size)] + frame)
+                    frame, size = [], 0
+        if frame:
+            self._take_credit(size)
+            self.channel._enqueue(self.bulk, [self._header(size)] + frame)
+        return total
+
+    def sendfile(self, file, offset: int = 0, count: int = None):
+        """
+        Sends a file region frame by frame with socket.sendfile, so it is not copied into memory
+        Blocks until the frames are sent since the caller may close the file afterwards
+        """
+        if count is None:
+            file.seek(0, 2)
+            count = file.tell() - offset
+        sent = threading.Event()
+        end = offset + count
+        while offset < end:
+            length = min(FRAME_SIZE, end - offset)
+            last = offset + length >= end
+            self._take_credit(length)
+            self.channel._enqueue(self.bulk, (self._header(length), file, offset, length, sent if last else None))
+            offset += length
+        if count:
+            self.channel._wait(sent)
+        return count
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.channel._forget(self)
+            self.channel._enqueue(self.bulk, [self._header(0, end=True)])
+
+
+class Channel:
+    """
+    Multiplexes concurrent requests and responses over a single connection
+    Every message is split into frames tagged with a request id, a reader thread routes
+    response frames to the stream of the waiting request and hands new requests to the handler.
+    Control frames are always sent before queued bulk frames, and bulk writers block
+    when their queue is full
+
+    Memory per connection is bounded: frames and messages have a size limit checked from the
+    frame header before the payload is read, every stream buffers at most STREAM_WINDOW bytes,
+    and only a fixed number of requests can wait to be handled. A peer that breaks a limit
+    is reported and disconnected
+    """
+    def __init__(self, sock, initiator: bool, handler=None, bulk_types=(), on_close=None,
+                 limits=None, bulk_rate=None, control_rate=None, on_violation=None):
+        """
+        :param sock: The connected socket, after the handshake
+        :param initiator: True on the side that opened the connection, the two sides use odd and even request ids
+        :param handler: Called as handler(message_type, payload InStream, reply OutStream or None) for incoming requests
+        :param bulk_types: Message types (bytes) whose frames and handlers go on the bulk path
+        :param on_close: Called once when the connection is lost
+        :param limits: Message type (bytes) -> (largest request payload, largest response payload),
+                       DEFAULT_LIMIT for the types not in it
+        :param bulk_rate: (bytes per second, burst bytes) of the bulk requests of the peer and their responses
+        :param control_rate: (messages per second, burst) of the control requests of the peer
+        :param on_violation: Called with the reason when the peer breaks a limit, before the connection is closed
+        """
+        self.sock = sock
+        self.handler = handler
+        self.bulk_types = set(bulk_types)
+        self.on_close = on_close
+        self.limits = limits or {}
+        self.bulk_bucket = TokenBucket(*bulk_rate) if bulk_rate else None
+        self.control_bucket = TokenBucket(*control_rate) if control_rate else None
+        self.on_violation = on_violation
+        self.next_id = 1 if initiator else 2
+        self.lock = threading.Lock()
+        self.pending = {}   # request id -> InStream of the response
+        self.incoming = {}  # request id -> InStream of an incoming request
+        self.outgoing = {}  # (request id, response) -> OutStream being written, to hand it its grants
+        self.send_cond = threading.Condition()
+        self.control = deque()
+        self.bulk = deque()
+        self.closed = threading.Event()
+        # Control requests are handled one at a time and in order, bulk requests by a few threads at once
+        self.control_requests = queue.Queue(MAX_QUEUED_CONTROL)
+        self.bulk_requests = deque()
+        self.bulk_handlers = 0
+        threading.Thread(target=self._send_loop, daemon=True).start()
+        threading.Thread(target=self._recv_loop, daemon=True).start()
+        threading.Thread(target=self._control_loop, daemon=True).start()
+
+    def _new_id(self):
+        with self.lock:
+            request_id = self.next_id
+            self.next_id += 2
+            return request_id
+
+    def _limit(self, message_type: bytes, response: bool):
+        return self.limits.get(message_type, (DEFAULT_LIMIT, DEFAULT_LIMIT))[response]
+
+    def open(self, message_type, bulk: bool = None, reply: bool = True):
+        """
+        Starts a request and returns (OutStream, response InStream or None)
+        The payload is written to the OutStream, which must be closed when done
+        """
+        message_type = bytes(message_type)
+        bulk = message_type in self.bulk_types if bulk is None else bulk
+        request_id = self._new_id()
+        response = None
+        if reply:
+            response = InStream(self, request_id, True, self._limit(message_type, True))
+            with self.lock:
+                self.pending[request_id] = response
+            if self.closed.is_set():
+                response.abort()
+        out = OutStream(self, message_type, request_id, 0 if reply else NO_REPLY, bulk)
+        with self.lock:
+            self.outgoing[(request_id, False)] = out
+        return out, response
+
+    def request(self, message_type, payload=b"", bulk: bool = None):
+        """
+        Sends a request with the whole payload and returns the response InStream
+        """
+        out, response = self.open(message_type, bulk)
+        if payload:
+            out.sendall(payload)
+        out.close()
+        return response
+
+    def send(self, message_type, payload=b"", bulk: bool = None):
+        """
+        Sends a message that does not get a response
+        """
+        out, _ = self.open(message_type, bulk, reply=False)
+        if payload:
+            out.sendall(payload)
+        out.close()
+
+    def _forget(self, out: OutStream):
+        with self.lock:
+            self.outgoing.pop((out.request_id, bool(out.flags & RESPONSE)), None)
+
+    def _grant(self, request_id: int, response: bool, size: int):
+        """
+        Lets the sender of a stream send size more bytes, ahead of any queued bulk frame
+        """
+        header = HEADER.pack(WINDOW_TYPE, request_id, WINDOW | (RESPONSE if response else 0), 4)
+        try:
+            self._enqueue(False, [header, struct.pack("!I", size)])
+        except ConnectionResetError:
+            pass
+
+    def _enqueue(self, bulk: bool, item):
+        with self.send_cond:
+            if bulk:
+                while len(self.bulk) >= BULK_QUEUE_SIZE and not self.closed.is_set():
+                    self.send_cond.wait()
+            if self.closed.is_set():
+                raise ConnectionResetError("Channel is closed")
+            (self.bulk if bulk else self.control).append(item)
+            self.send_cond.notify_all()
+
+    def _wait(self, event: threading.Event):
+        while not event.wait(1):
+            if self.closed.is_set():
+                raise ConnectionResetError("Channel is closed")
+
+    def _send_loop(self):
+        try:
+            while True:
+                with self.send_cond:
+                    while not self.control and not self.bulk and not self.closed.is_set():
+                        self.send_cond.wait()
+                    if self.closed.is_set():
+                        return
+                    item = self.control.popleft() if self.control else self.bulk.popleft()
+                    self.send_cond.notify_all()
+                if isinstance(item, list):
+                    _sendmsg_all(self.sock, item)
+                else:
+                    header, file, offset, length, sent = item
+                    self.sock.sendall(header)
+                    self.sock.sendfile(file, offset, length)
+                    if sent:
+                        sent.set()
+        except OSError:
+            self.close()
+
+    def _recv_loop(self):
+        try:
+            while True:
+                message_type, request_id, flags, length = HEADER.unpack(_recv_exact(self.sock, HEADER.size))
+                # Everything is checked against the header, a payload over a limit is never read
+                if length > FRAME_SIZE:
+                    raise ProtocolError(f"Frame of {length} bytes")
+                end = bool(flags & END)
+                if flags & WINDOW:
+                    if length != 4:
+                        raise ProtocolError("Malformed window frame")
+                    size = struct.unpack("!I", _recv_exact(self.sock, 4))[0]
+                    with self.lock:
+                        out = self.outgoing.get((request_id, bool(flags & RESPONSE)))
+                    if out:
+                        out.grant(size)
+                    continue
+
+                if flags & RESPONSE:
+                    with self.lock:
+                        stream = self.pending.get(request_id)
+                    if stream:
+                        stream.check(length)
+                    data = _recv_exact(self.sock, length) if length else b""
+                    if stream:
+                        if end:
+                            with self.lock:
+                                self.pending.pop(request_id, None)
+                        stream.feed(data, end)
+                    continue
+
+                with self.lock:
+                    stream = self.incoming.get(request_id)
+                new = stream is None
+                if new:
+                    bulk = message_type in self.bulk_types
+                    stream = InStream(self, request_id, False, self._limit(message_type, False), self.bulk_bucket if bulk else None)
+                stream.check(length)
+                data = _recv_exact(self.sock, length) if length else b""
+                with self.lock:
+                    if new and not end:
+                        self.incoming[request_id] = stream
+                    elif end:
+                        self.incoming.pop(request_id, None)
+                stream.feed(data, end)
+                if new:
+                    self._dispatch(message_type, request_id, flags, stream)
+        except ProtocolError as e:
+            print(f"Closing connection: {e}")
+            if self.on_violation:
+                self.on_violation(str(e))
+        except (OSError, struct.error):
+            pass
+        finally:
+            self.close()
+
+    def _dispatch(self, message_type: bytes, request_id: int, flags: int, stream: InStream):
+        bulk = message_type in self.bulk_types
+        reply = None
+        if not flags & NO_REPLY:
+            reply = OutStream(self, message_type, request_id, RESPONSE, bulk, self.bulk_bucket if bulk else None)
+            with self.lock:
+                self.outgoing[(request_id, True)] = reply
+        item = (message_type, stream, reply)
+        if not bulk:
+            # A full queue stops the reading, so the peer is held back by TCP until it drains
+            while not self.closed.is_set():
+                try:
+                    self.control_requests.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    pass
+            return
+        with self.lock:
+            if self.bulk_handlers < MAX_BULK_HANDLERS:
+                self.bulk_handlers += 1
+            elif len(self.bulk_requests) < MAX_QUEUED_BULK:
+                self.bulk_requests.append(item)
+                return
+            else:
+                raise ProtocolError("Too many bulk requests at once")
+        threading.Thread(target=self._bulk_loop, args=(item,), daemon=True).start()
+
+    def _bulk_loop(self, item):
+        try:
+            while True:
+                self._handle(*item)
+                with self.lock:
+                    if not self.bulk_requests or self.closed.is_set():
+                        return
+                    item = self.bulk_requests.popleft()
+        finally:
+            # The slot is given back however the handler ended, or the bulk lane would fill up for good
+            with self.lock:
+                self.bulk_handlers -= 1
+
+    def _control_loop(self):
+        while not self.closed.is_set():
+            item = self.control_requests.get()
+            if item is None:
+                return
+            # A peer that sends too many messages is slowed down to the rate
+            if self.control_bucket:
+                self.control_bucket.take(1)
+            self._handle(*item)
+
+    def _handle(self, message_type: bytes, stream: InStream, reply: OutStream):
+        try:
+            if self.handler:
+                self.handler(message_type, stream, reply)
+        except Exception as e:
+            # A failing handler must not end the handler thread, other requests are waiting on it
+            print(f"Failed to handle {message_type}: {type(e).__name__}: {e}")
+        finally:
+            # The rest of a request the handler did not read is dropped
+            stream.discard()
+            if reply:
+                try:
+                    reply.close()
+                except ConnectionResetError:
+                    pass
+
+    def close(self):
+        """
+        Closes the connection and wakes up everything waiting on it
+        """
+        if self.closed.is_set():
+            return
+        self.closed.set()
+        with self.send_cond:
+            self.send_cond.notify_all()
+        with self.lock:
+            streams = list(self.pending.values()) + list(self.incoming.values())
+            self.pending.clear()
+            self.incoming.clear()
+            self.bulk_requests.clear()
+        for stream in streams:
+            stream.abort()
+        try:
+            self.control_requests.put_nowait(None)
+        except queue.Full:
+            # The control loop sees the closed channel after the request it is on
+            pass
+        try:
+            # shutdown wakes up the reader thread blocked in recv
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        if self.on_close:
+            self.on_close()
@@ -0,0 +1,177 @@
+import threading
+from time import monotonic
+
+# Estimates used for peers that have not been measured yet
+DEFAULT_RTT = 0.5 # seconds
+DEFAULT_THROUGHPUT = 1024 * 1024 # bytes per second
+# Weight of a new sample in the moving averages, the RTT ones are the same as TCP's
+RTT_ALPHA = 1 / 8
+RTTVAR_BETA = 1 / 4
+THROUGHPUT_ALPHA = 1 / 4
+# Transfers smaller than this are dominated by the round trip and say little about throughput
+MIN_THROUGHPUT_SAMPLE = 16 * 1024
+# Misbehaviour halves every this many seconds, so old mistakes are forgiven
+MISBEHAVIOUR_HALF_LIFE = 600
+# Penalties, a block can be rejected because of an honest fork but bad data is never honest
+REJECTED_BLOCK = 1
+BAD_DATA = 10
+# A peer is disconnected at this misbehaviour score or after this many unanswered pings in a row
+EVICT_SCORE = 20
+MAX_MISSED_PINGS = 3
+# Seconds a misbehaving peer is refused after it was evicted
+BAN_TIME = 600
+# Misbehaviour of a peer that left is forgotten once it decayed below this
+FORGOTTEN_MISBEHAVIOUR = 0.1
+
+
+class PeerScores:
+    """
+    Keeps round trip time, throughput and misbehaviour estimates for every peer
+    and ranks peers by how fast and honest they are expected to be
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        # peer -> {"srtt", "rttvar", "throughput", "misbehaviour", "penalized_at", "missed"}
+        self.stats = {}
+        # peer -> time until which the peer is refused
+        self.bans = {}
+        # peer -> (misbehaviour, penalized_at) of the peers that left, so reconnecting does not clear it
+        self.departed = {}
+
+    def _get(self, peer):
+        stats = self.stats.get(peer)
+        if stats is None:
+            misbehaviour, penalized_at = self.departed.pop(peer, (0.0, monotonic()))
+            stats = self.stats[peer] = {
+                "srtt": None,
+                "rttvar": None,
+                "throughput": None,
+                "misbehaviour": misbehaviour,
+                "penalized_at": penalized_at,
+                "missed": 0,
+            }
+        return stats
+
+    @staticmethod
+    def _decayed(misbehaviour: float, penalized_at: float):
+        return misbehaviour * 0.5 ** ((monotonic() - penalized_at) / MISBEHAVIOUR_HALF_LIFE)
+
+    def _misbehaviour(self, stats):
+        return self._decayed(stats["misbehaviour"], stats["penalized_at"])
+
+    def rtt(self, peer, seconds: float):
+        """
+        Records an answered ping
+        """
+        with self.lock:
+            stats = self._get(peer)
+            stats["missed"] = 0
+            if stats["srtt"] is None:
+                stats["srtt"] = seconds
+                stats["rttvar"] = seconds / 2
+            else:
+                stats["rttvar"] += RTTVAR_BETA * (abs(stats["srtt"] - seconds) - stats["rttvar"])
+                stats["srtt"] += RTT_ALPHA * (seconds - stats["srtt"])
+
+    def missed(self, peer):
+        """
+        Records an unanswered ping and returns the number of pings missed in a row
+        """
+        with self.lock:
+            stats = self._get(peer)
+            stats["missed"] += 1
+            return stats["missed"]
+
+    def timeout(self, peer):
+        """
+        Seconds to wait for a ping answer, like TCP's retransmission timeout
+        """
+        with self.lock:
+            stats = self.stats.get(peer)
+            if not stats or stats["srtt"] is None:
+                return 2 * DEFAULT_RTT + 1
+            return max(1.0, stats["srtt"] + 4 * stats["rttvar"])
+
+    def transfer(self, peer, size: int, seconds: float):
+        """
+        Records a payload received from a peer
+        """
+        if size < MIN_THROUGHPUT_SAMPLE or seconds <= 0:
+            return
+        with self.lock:
+            stats = self._get(peer)
+            sample = size / seconds
+            if stats["throughput"] is None:
+                stats["throughput"] = sample
+            else:
+                stats["throughput"] += THROUGHPUT_ALPHA * (sample - stats["throughput"])
+
+    def penalize(self, peer, amount: float):
+        with self.lock:
+            stats = self._get(peer)
+            stats["misbehaviour"] = self._misbehaviour(stats) + amount
+            stats["penalized_at"] = monotonic()
+
+    def cost(self, peer, size: int = 0):
+        """
+        Expected seconds to get size bytes from the peer, inflated by its misbehaviour
+        """
+        with self.lock:
+            stats = self.stats.get(peer)
+            if not stats:
+                return DEFAULT_RTT + size / DEFAULT_THROUGHPUT
+            rtt = stats["srtt"] if stats["srtt"] is not None else DEFAULT_RTT
+            throughput = stats["throughput"] or DEFAULT_THROUGHPUT
+            return (rtt + size / throughput) * (1 + self._misbehaviour(stats))
+
+    def rank(self, peers, size: int = 0):
+        """
+        Returns the peers from the cheapest to the most expensive
+        """
+        return sorted(peers, key=lambda peer: self.cost(peer, size))
+
+    def should_evict(self, peer):
+        with self.lock:
+            stats = self.stats.get(peer)
+            return bool(stats) and (stats["missed"] >= MAX_MISSED_PINGS or self._misbehaviour(stats) >= EVICT_SCORE)
+
+    def misbehaving(self, peer):
+        with self.lock:
+            stats = self.stats.get(peer)
+            return bool(stats) and self._misbehaviour(stats) >= EVICT_SCORE
+
+    def ban(self, peer, seconds: float = BAN_TIME):
+        with self.lock:
+            self.bans[peer] = monotonic() + seconds
+
+    def banned(self, peer):
+        with self.lock:
+            until = self.bans.get(peer)
+            if until is not None and until < monotonic():
+                del self.bans[peer]
+                return False
+            return until is not None
+
+    def remove(self, peer):
+        """
+        Forgets the estimates of a peer that left. Its misbehaviour is kept and keeps decaying,
+        so a peer cannot clear it by reconnecting. Bans are kept too
+        """
+        with self.lock:
+            stats = self.stats.pop(peer, None)
+            if stats and self._misbehaviour(stats) >= FORGOTTEN_MISBEHAVIOUR:
+                self.departed[peer] = (stats["misbehaviour"], stats["penalized_at"])
+            for other in [other for other, kept in self.departed.items() if self._decayed(*kept) < FORGOTTEN_MISBEHAVIOUR]:
+                del self.departed[other]
+
+    def summary(self, peer):
+        """
+        Returns (rtt in ms, throughput in KiB/s, misbehaviour, missed pings), None where unknown
+        """
+        with self.lock:
+            stats = self.stats.get(peer)
+            if not stats:
+                return None, None, 0.0, 0
+            rtt = stats["srtt"] * 1000 if stats["srtt"] is not None else None
+            throughput = stats["throughput"] / 1024 if stats["throughput"] is not None else None
+            return rtt, throughput, self._misbehaviour(stats), stats["missed"]
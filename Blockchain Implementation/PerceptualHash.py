@@ -0,0 +1,220 @@
+import io
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
+# Hashes within this many differing bits (out of 64) are treated as the same picture
+HAMMING_RADIUS = 10
+
+
+def _grayscale(image_data, width: int, height: int):
+    """
+    Decodes the image (bytes or a file path) and returns it as a grayscale float array of the given size
+    NumPy and PIL are imported on the first hash, so that clients that never hash an image start without them
+    """
+    import numpy as np
+    from PIL import Image
+    source = image_data if isinstance(image_data, (str, os.PathLike)) else io.BytesIO(image_data)
+    img = Image.open(source).convert("L").resize((width, height), Image.LANCZOS)
+    return np.asarray(img, dtype=np.float64)
+
+
+def _to_int(bits):
+    """
+    Packs a boolean array into an integer, first element is the most significant bit
+    """
+    import numpy as np
+    return int.from_bytes(np.packbits(bits.flatten()).tobytes(), "big")
+
+
+def dhash(image_data, size: int = 8):
+    """
+    Difference hash: compares every pixel with its right neighbour on a (size+1) x size thumbnail
+    Returns a size*size bit integer
+    """
+    pixels = _grayscale(image_data, size + 1, size)
+    return _to_int(pixels[:, 1:] > pixels[:, :-1])
+
+
+@lru_cache(maxsize=None)
+def _dct_matrix(n: int):
+    """
+    Orthonormal DCT-II matrix, the 2D DCT of X is D @ X @ D.T
+    Built once per size
+    """
+    import numpy as np
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.sqrt(2 / n) * np.cos(np.pi * (2 * i + 1) * k / (2 * n))
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+def phash(image_data, size: int = 8):
+    """
+    Perceptual hash: takes the lowest size x size DCT frequencies of a 32x32 thumbnail
+    and compares them against their median. Robust to re-encoding, resizing and small edits
+    Returns a size*size bit integer
+    """
+    import numpy as np
+    pixels = _grayscale(image_data, 32, 32)
+    dct = _dct_matrix(32)
+    low = (dct @ pixels @ dct.T)[:size, :size]
+    # The DC term only carries the average brightness, so it is left out of the median
+    median = np.median(low.flatten()[1:])
+    return _to_int(low > median)
+
+
+def hamming(a: int, b: int):
+    """
+    Number of differing bits between two hashes
+    """
+    return bin(a ^ b).count("1")
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over hashes with the hamming distance
+    Radius searches only visit the children whose edge distance can still contain a match
+    """
+    def __init__(self):
+        # Each node is [hash, items, children] where children maps distance -> node
+        self.root = None
+        self.size = 0
+
+    def add(self, value: int, item):
+        """
+        Adds an item under the given hash
+        """
+        self.size += 1
+        if self.root is None:
+            self.root = [value, [item], {}]
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value: int, radius: int = HAMMING_RADIUS):
+        """
+        Returns (distance, item) pairs for every item within radius of the hash, closest first
+        """
+        results = []
+        stack = [self.root] if self.root else []
+        while stack:
+            node = stack.pop()
+            distance = hamming(value, node[0])
+            if distance <= radius:
+                results.extend((distance, item) for item in node[1])
+            # By the triangle inequality only edges in [distance - radius, distance + radius] can match
+            for edge, child in node[2].items():
+                if distance - radius <= edge <= distance + radius:
+                    stack.append(child)
+        results.sort(key=lambda result: result[0])
+        return results
+
+    def __len__(self):
+        return self.size
+
+
+class PerceptualIndex:
+    """
+    Index of the perceptual hashes of images for near-duplicate lookups
+    """
+    def __init__(self, hash_function=phash, radius: int = HAMMING_RADIUS):
+        """
+        :param hash_function: The perceptual hash to use, phash or dhash
+        :param radius: The hamming distance up to which two images are near-duplicates
+        """
+        self.hash_function = hash_function
+        self.radius = radius
+        self.hashes = {}
+        self.tree = BKTree()
+        self.lock = threading.Lock()
+
+    def hash(self, image_data):
+        """
+        Returns the perceptual hash of the image, or None if it cannot be decoded
+        or NumPy and PIL are not installed
+        """
+        try:
+            return self.hash_function(image_data)
+        except Exception:
+            # ImportError without NumPy or PIL, and PIL's own errors such as DecompressionBombError
+            return None
+
+    def add(self, image_id: str, image_data=None, value: int = None):
+        """
+        Adds an image by its data or by an already computed hash
+        Returns the hash, or None if the image could not be decoded
+        """
+        if value is None:
+            value = self.hash(image_data)
+        if value is None:
+            return None
+        with self.lock:
+            if image_id not in self.hashes:
+                self.hashes[image_id] = value
+                self.tree.add(value, image_id)
+        return value
+
+    def find(self, image_data=None, value: int = None, exclude: str = None):
+        """
+        Returns (distance, image_id) pairs of the indexed near-duplicates of an image, closest first
+        """
+        if value is None:
+            value = self.hash(image_data)
+        if value is None:
+            return []
+        with self.lock:
+            matches = self.tree.search(value, self.radius)
+        return [(distance, image_id) for distance, image_id in matches if image_id != exclude]
+
+    def hash_many(self, images, workers: int = None):
+        """
+        Hashes a list of images (data or paths) in parallel processes
+        Returns the hashes in the same order, None for images that cannot be decoded
+        """
+        if not images:
+            return []
+        if len(images) == 1:
+            return [self.hash(images[0])]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(_safe_hash, [self.hash_function] * len(images), images, chunksize=16))
+
+    def add_many(self, images, workers: int = None):
+        """
+        Indexes a catalogue of (image_id, image_data or path) pairs, hashing them in parallel processes
+        Returns the number of images that were indexed
+        """
+        images = [(image_id, image_data) for image_id, image_data in images if image_id not in self.hashes]
+        if not images:
+            return 0
+        values = self.hash_many([data for _, data in images], workers)
+        count = 0
+        for (image_id, _), value in zip(images, values):
+            if value is not None and self.add(image_id, value=value) is not None:
+                count += 1
+        return count
+
+    def __len__(self):
+        return len(self.hashes)
+
+
+def _safe_hash(hash_function, image_data):
+    """
+    Worker process entry point for batch indexing
+    Returns None where PerceptualIndex.hash does
+    """
+    try:
+        return hash_function(image_data)
+    except Exception:
+        return None
@@ -0,0 +1,434 @@
+import os
+import re
+import sys
+import signal
+import socket
+import struct
+import threading
+import multiprocessing
+from hashlib import sha256
+from collections import deque
+from argparse import ArgumentParser
+from time import sleep, monotonic, monotonic_ns, time_ns
+from Blockchain import target_from_difficulty
+from Compression import recv_exact
+
+# Messages of the pool protocol, each is a 3 byte type followed by a fixed size body
+# worker -> coordinator, first message: name of the worker
+HELLO = b"HLO"
+HELLO_FORMAT = "!32s"
+# coordinator -> worker: job id, timestamp, previous hash, transaction count, merkle root, block target, share target
+JOB = b"JOB"
+JOB_FORMAT = "!IQ64sL64s32s32s"
+# coordinator -> worker: the job is stale, stop hashing it
+DROP = b"DRP"
+DROP_FORMAT = "!I"
+# worker -> coordinator: job id, timestamp and nonce of a hash at or below the share target
+SHARE = b"SHR"
+SHARE_FORMAT = "!IQ32s"
+
+# Shares need this many leading hex zeros, unless the block target is easier
+SHARE_DIFFICULTY = 4
+# Seconds of shares the hashrate of a worker is estimated over
+HASHRATE_WINDOW = 60
+# Attempts a worker makes between two checks for a new job
+BATCH = 4096
+# Seconds between two hashrate reports of a worker process
+REPORT_INTERVAL = 10
+# Seconds a worker waits before connecting to the coordinator again
+RECONNECT_DELAY = 5
+# Nanoseconds a share's timestamp may be ahead of the coordinator's clock. Workers count from the
+# job's timestamp, so honest shares are never ahead of it, beyond clocks ticking at slightly different rates
+MAX_SHARE_DRIFT = 5 * 10**9
+
+NONCE = re.compile(rb"[0-9a-f]{32}")
+
+
+class Job:
+    """
+    Block template handed out to the workers: the header of the block without nonce and timestamp
+    """
+    def __init__(self, job_id: int, block, timestamp: int, target: int, share_target: int):
+        self.id = job_id
+        self.block = block
+        # The mining run of the block the job belongs to, a solution for another run is refused
+        self.future = block.mining_future
+        self.timestamp = timestamp
+        self.target = target
+        self.share_target = share_target
+        # Expected number of hashes per share
+        self.share_work = 2 ** 256 // (share_target + 1)
+        self.previous_hash = block.previous_hash.encode()
+        self.trx_num = len(block.transactions)
+        self.markle_root = block.markle_root.encode()
+        # (timestamp, nonce) of the shares already counted, so a share is not counted twice
+        self.seen = set()
+        self.message = JOB + struct.pack(
+            JOB_FORMAT, job_id, timestamp, self.previous_hash, self.trx_num, self.markle_root,
+            target.to_bytes(32, "big"), share_target.to_bytes(32, "big"),
+        )
+
+    def hash(self, timestamp: int, nonce: bytes):
+        """
+        Hash of the block header with the given timestamp and nonce, as a number
+        """
+        header = struct.pack("!64sQ32sL", self.previous_hash, timestamp, nonce, self.trx_num)
+        return int.from_bytes(sha256(header + self.markle_root).digest(), "big")
+
+
+class RemoteWorker:
+    """
+    Connection of the coordinator to a worker, with the statistics of its shares
+    Jobs are sent from a thread of its own. Only the latest job or drop waits to be sent,
+    so a slow worker skips the ones it missed and never holds up the others
+    """
+    def __init__(self, conn: socket.socket, addr, name: str):
+        self.conn = conn
+        self.addr = addr
+        self.name = name
+        self.connected = monotonic()
+        self.accepted = 0
+        self.stale = 0
+        self.invalid = 0
+        self.blocks = 0
+        # (time, work) of the accepted shares within the hashrate window
+        self.shares = deque()
+        self.cond = threading.Condition()
+        self.pending = None
+        self.closed = False
+        threading.Thread(target=self._send_loop, daemon=True).start()
+
+    def send(self, message: bytes):
+        with self.cond:
+            self.pending = message
+            self.cond.notify()
+
+    def _send_loop(self):
+        while True:
+            with self.cond:
+                while self.pending is None and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                message, self.pending = self.pending, None
+            try:
+                self.conn.sendall(message)
+            except OSError:
+                self.close()
+                return
+
+    def add_share(self, work: int):
+        now = monotonic()
+        self.accepted += 1
+        self.shares.append((now, work))
+        self._expire(now)
+
+    def _expire(self, now: float):
+        while self.shares and self.shares[0][0] < now - HASHRATE_WINDOW:
+            self.shares.popleft()
+
+    def hashrate(self):
+        """
+        Hashes per second, estimated from the work of the accepted shares
+        """
+        now = monotonic()
+        self._expire(now)
+        span = min(HASHRATE_WINDOW, now - self.connected)
+        return sum(work for _, work in self.shares) / span if span > 0 else 0.0
+
+    def close(self):
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify()
+        try:
+            # shutdown wakes up the thread blocked reading the shares
+            self.conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+
+
+class PoolCoordinator:
+    """
+    Hands out the block being mined to remote mining workers and collects their shares
+
+    A job is the header of the block without nonce and timestamp: previous hash, transaction
+    count and merkle root, with the block target and an easier share target. Workers search
+    nonces on their own and send every hash at or below the share target. Shares prove the
+    work of a worker, which gives its hashrate, and a share that also meets the block target
+    mines the block. The job is dropped as soon as the mining future of the block is done,
+    when it is mined, replaced by a received block or extended with transactions, so workers
+    stop hashing a stale tip within one batch
+    """
+    def __init__(self, host: str = "", port: int = 0, share_difficulty: int = SHARE_DIFFICULTY):
+        """
+        :param host: The host to bind to
+        :param port: The port to bind to, any free port if 0
+        :param share_difficulty: Leading hex zeros of a share
+        """
+        self.share_target = target_from_difficulty(share_difficulty)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen()
+        self.port = self.sock.getsockname()[1]
+        self.lock = threading.Lock()
+        # connection -> RemoteWorker
+        self.workers = {}
+        self.job = None
+        self.job_id = 0
+        self.running = True
+        threading.Thread(target=self.accept_workers, daemon=True).start()
+
+    def publish(self, block, target: int):
+        """
+        Hands the block out to all workers, replacing the job they work on
+        Must be called right after block.mine, whose future ends the job
+        """
+        with self.lock:
+            self.job_id += 1
+            job = Job(self.job_id, block, time_ns(), target, max(target, self.share_target))
+            self.job = job
+            for worker in self.workers.values():
+                worker.send(job.message)
+        job.future.add_done_callback(lambda future: self.drop(job))
+        return job.id
+
+    def drop(self, job: Job):
+        """
+        Tells the workers to stop hashing a job, unless it was replaced already
+        """
+        with self.lock:
+            if self.job is not job:
+                return
+            self.job = None
+            for worker in self.workers.values():
+                worker.send(DROP + struct.pack(DROP_FORMAT, job.id))
+
+    def accept_workers(self):
+        while self.running:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                # The listening socket was closed
+                return
+            threading.Thread(target=self.handle_worker, args=(conn, addr), daemon=True).start()
+
+    def handle_worker(self, conn: socket.socket, addr):
+        """
+        Greets a worker, sends it the current job and reads its shares until it leaves
+        """
+        try:
+            if recv_exact(conn, 3) != HELLO:
+                conn.close()
+                return
+            name = struct.unpack(HELLO_FORMAT, recv_exact(conn, struct.calcsize(HELLO_FORMAT)))[0]
+        except OSError:
+            conn.close()
+            return
+        worker = RemoteWorker(conn, addr, name.rstrip(b"\x00").decode(errors="replace"))
+        with self.lock:
+            self.workers[conn] = worker
+            if self.job:
+                worker.send(self.job.message)
+        print(f"Pool worker {worker.name} joined from {addr[0]}:{addr[1]}")
+        try:
+            # Anything other than a share is a protocol violation and ends the connection
+            while recv_exact(conn, 3) == SHARE:
+                job_id, timestamp, nonce = struct.unpack(SHARE_FORMAT, recv_exact(conn, struct.calcsize(SHARE_FORMAT)))
+                self.submit(worker, job_id, timestamp, nonce)
+        except OSError:
+            pass
+        with self.lock:
+            self.workers.pop(conn, None)
+        worker.close()
+        print(f"Pool worker {worker.name} left")
+
+    def submit(self, worker: RemoteWorker, job_id: int, timestamp: int, nonce: bytes):
+        """
+        Checks a share of a worker and hands it to the block if it meets the block target
+        Shares for a job that was replaced or dropped meanwhile are counted as stale
+        A worker does not get to pick the block timestamp: it must lie between the job's and now
+        """
+        job = self.job
+        if job is None or job.id != job_id:
+            with self.lock:
+                worker.stale += 1
+            return
+        valid = NONCE.fullmatch(nonce) and job.timestamp <= timestamp <= time_ns() + MAX_SHARE_DRIFT
+        digest = job.hash(timestamp, nonce) if valid else None
+        with self.lock:
+            if not valid or digest > job.share_target or (timestamp, nonce) in job.seen:
+                worker.invalid += 1
+                return
+            job.seen.add((timestamp, nonce))
+            worker.add_share(job.share_work)
+        if digest <= job.target and job.block.submit(job.future, nonce.decode(), timestamp, job.target):
+            with self.lock:
+                worker.blocks += 1
+            print(f"Block mined by pool worker {worker.name}")
+
+    def stats(self):
+        """
+        Returns the statistics of every worker, the fastest first
+        """
+        with self.lock:
+            stats = [{
+                "name": worker.name,
+                "address": f"{worker.addr[0]}:{worker.addr[1]}",
+                "hashrate": round(worker.hashrate()),
+                "accepted": worker.accepted,
+                "stale": worker.stale,
+                "invalid": worker.invalid,
+                "blocks": worker.blocks,
+            } for worker in self.workers.values()]
+        return sorted(stats, key=lambda stat: -stat["hashrate"])
+
+    def hashrate(self):
+        """
+        Hashes per second of all workers together
+        """
+        with self.lock:
+            return sum(worker.hashrate() for worker in self.workers.values())
+
+    def close(self):
+        self.running = False
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        with self.lock:
+            workers = list(self.workers.values())
+        for worker in workers:
+            worker.close()
+
+
+class PoolWorker:
+    """
+    Mining worker of a pool. It needs nothing but a connection to the coordinator:
+    no chain, no peers and no images, so any spare machine can run it
+    One worker hashes on one core, a machine runs one worker process per core
+    """
+    def __init__(self, host: str, port: int, name: str = None):
+        """
+        :param host: The host of the coordinator
+        :param port: The pool port of the coordinator
+        :param name: The name the worker is listed under, the host name and process id by default
+        """
+        self.sock = socket.create_connection((host, port))
+        self.name = name or f"{socket.gethostname()}-{os.getpid()}"
+        # (job id, timestamp, local time received, previous hash, transaction count, merkle root, target, share target)
+        self.job = None
+        self.has_job = threading.Event()
+        self.running = True
+        self.hashes = 0
+
+    def run(self):
+        """
+        Mines the jobs of the coordinator until the connection is closed
+        """
+        self.sock.sendall(HELLO + struct.pack(HELLO_FORMAT, self.name.encode()[:32]))
+        threading.Thread(target=self.receive, daemon=True).start()
+        reported, counted = monotonic(), 0
+        try:
+            while self.running:
+                job = self.job
+                if job is None:
+                    self.has_job.wait(1)
+                else:
+                    self.mine(job)
+                if monotonic() - reported >= REPORT_INTERVAL:
+                    now = monotonic()
+                    print(f"{self.name}: {(self.hashes - counted) / (now - reported) / 1000:.1f} kH/s")
+                    reported, counted = now, self.hashes
+        except OSError:
+            pass
+        self.sock.close()
+
+    def mine(self, job):
+        """
+        Hashes a job in batches until it is replaced or dropped, sending every share
+        """
+        job_id, timestamp, received, previous_hash, trx_num, markle_root, target, share_target = job
+        # The previous hash fills the first 64 byte block of sha256, so that block is hashed once per job
+        midstate = sha256(previous_hash)
+        # A random prefix keeps the nonces of the workers apart
+        prefix = os.urandom(4).hex().encode()
+        counter = 0
+        pack = struct.Struct("!Q32sL").pack
+        from_bytes = int.from_bytes
+        while self.job is job:
+            # Timestamps follow the clock of the coordinator, so the clocks of the machines need not agree
+            now = timestamp + monotonic_ns() - received
+            for counter in range(counter, counter + BATCH):
+                nonce = b"%s%024x" % (prefix, counter)
+                hasher = midstate.copy()
+                hasher.update(pack(now, nonce, trx_num) + markle_root)
+                if from_bytes(hasher.digest(), "big") <= share_target:
+                    self.sock.sendall(SHARE + struct.pack(SHARE_FORMAT, job_id, now, nonce))
+            counter += 1
+            self.hashes += BATCH
+
+    def receive(self):
+        """
+        Reads jobs and drops from the coordinator, the mining loop picks them up between two batches
+        """
+        try:
+            while True:
+                message_type = recv_exact(self.sock, 3)
+                if message_type == JOB:
+                    job_id, timestamp, previous_hash, trx_num, markle_root, target, share_target = struct.unpack(
+                        JOB_FORMAT, recv_exact(self.sock, struct.calcsize(JOB_FORMAT)))
+                    self.job = (job_id, timestamp, monotonic_ns(), previous_hash, trx_num, markle_root,
+                                int.from_bytes(target, "big"), int.from_bytes(share_target, "big"))
+                    self.has_job.set()
+                elif message_type == DROP:
+                    job_id = struct.unpack(DROP_FORMAT, recv_exact(self.sock, struct.calcsize(DROP_FORMAT)))[0]
+                    job = self.job
+                    if job is not None and job[0] == job_id:
+                        self.has_job.clear()
+                        self.job = None
+                else:
+                    break
+        except OSError:
+            pass
+        self.running = False
+        self.job = None
+        self.has_job.set()
+
+
+def run_worker(host: str, port: int, name: str = None):
+    """
+    Runs a worker, connecting again whenever the coordinator goes away
+    """
+    while True:
+        try:
+            PoolWorker(host, port, name).run()
+        except OSError:
+            pass
+        sleep(RECONNECT_DELAY)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Runs pool mining workers for a client started with --pool-port")
+    parser.add_argument("coordinator", type=str, help="host:port of the pool port of the coordinating client")
+    parser.add_argument("--processes", type=int, default=1, help="Number of worker processes, one per core")
+    parser.add_argument("--name", type=str, default=None, help="Name of the worker, numbered when there are several processes")
+    args = parser.parse_args()
+    host, port = args.coordinator.rsplit(":", 1)
+    if args.processes == 1:
+        run_worker(host, int(port), args.name)
+    else:
+        # Daemonic processes are stopped when the parent exits, also on SIGTERM
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        processes = [
+            multiprocessing.Process(target=run_worker, args=(host, int(port), f"{args.name}-{i}" if args.name else None), daemon=True)
+            for i in range(args.processes)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
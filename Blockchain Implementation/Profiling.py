@@ -0,0 +1,252 @@
+import os
+import re
+import sys
+import json
+import signal
+import atexit
+import threading
+import tracemalloc
+import functools
+from collections import Counter
+from time import sleep, monotonic, perf_counter
+
+# Seconds between two stack samples while profiling
+SAMPLE_INTERVAL = 0.005
+# Seconds between two readings of the growth probes
+GROWTH_INTERVAL = 1
+# Frames kept per allocation by tracemalloc
+TRACEMALLOC_DEPTH = 10
+# Lines of allocation statistics written by dump
+TOP_ALLOCATIONS = 50
+
+CHAIN_MODULE = "Blockchain.py"
+
+
+def _thread_name(name: str):
+    """
+    Default thread names carry a counter, "Thread-12 (mine)" is filed under "mine" so that threads add up
+    """
+    match = re.fullmatch(r"Thread-\d+(?: \((.*)\))?", name)
+    if match:
+        return match.group(1) or "thread"
+    return name
+
+
+class _NullSection:
+    """
+    Section used while profiling is off, entering it costs a method call and nothing else
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SECTION = _NullSection()
+
+
+class _Section:
+    def __init__(self, profiler, key: str):
+        self.profiler = profiler
+        self.key = key
+
+    def __enter__(self):
+        self.keys = self.profiler.sections.setdefault(threading.get_ident(), [])
+        self.keys.append(self.key)
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = perf_counter() - self.started
+        self.keys.pop()
+        with self.profiler.lock:
+            timing = self.profiler.timings.setdefault(self.key, [0, 0.0, 0.0])
+            timing[0] += 1
+            timing[1] += elapsed
+            timing[2] = max(timing[2], elapsed)
+        return False
+
+
+class Profiler:
+    """
+    Opt-in sampling profiler for a client or a tracker
+
+    While it runs, a thread samples the stacks of all threads every few milliseconds.
+    Each sample is filed under the sections the thread is in (message types, mining, ...),
+    or the thread name outside of them, and credited to the first Blockchain.py function
+    on the stack, the method called from outside or the mining worker. Sections also record
+    their wall time. tracemalloc traces the allocations and the growth probes
+    (chain height, stored images, ...) are read every second.
+    Sampling is used instead of cProfile since only one cProfile can be active
+    at a time, and handlers run on many threads at once
+    """
+    def __init__(self, probes: dict = None, interval: float = SAMPLE_INTERVAL):
+        """
+        :param probes: name -> callable returning a number, read every second while profiling
+        :param interval: Seconds between two stack samples
+        """
+        self.probes = probes or {}
+        self.interval = interval
+        self.running = False
+        self.lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # thread id -> stack of the section keys the thread is in
+        self.sections = {}
+        # section key -> [calls, total seconds, longest seconds]
+        self.timings = {}
+        # "root;frame;frame" -> samples, the folded stack format of flamegraph tools
+        self.stacks = Counter()
+        # Blockchain.py entry point -> samples
+        self.methods = Counter()
+        self.samples = 0
+        # (seconds since start, {probe: value})
+        self.growth = []
+        self.started = None
+        self.stopped = None
+        self.snapshot = None
+        self._own_tracemalloc = False
+
+    def section(self, key: str):
+        """
+        Returns a context manager that files the samples taken inside it under key
+        """
+        if not self.running:
+            return _NULL_SECTION
+        return _Section(self, key)
+
+    def start(self):
+        """
+        Starts profiling, the data of the previous run is dropped
+        """
+        if self.running:
+            return
+        self._reset()
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_DEPTH)
+            self._own_tracemalloc = True
+        self.started = monotonic()
+        self.running = True
+        threading.Thread(target=self._sample_loop, name="profiler", daemon=True).start()
+
+    def stop(self):
+        """
+        Stops profiling, the data is kept for dump
+        """
+        if not self.running:
+            return
+        self.running = False
+        self.stopped = monotonic()
+        self.snapshot = tracemalloc.take_snapshot()
+        if self._own_tracemalloc:
+            tracemalloc.stop()
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        next_growth = 0
+        while self.running:
+            names = {thread.ident: _thread_name(thread.name) for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                self._sample(ident, names.get(ident, "thread"), frame)
+            elapsed = monotonic() - self.started
+            if elapsed >= next_growth:
+                self._read_probes(elapsed)
+                next_growth = elapsed + GROWTH_INTERVAL
+            sleep(self.interval)
+
+    def _sample(self, ident: int, thread_name: str, frame):
+        frames = []
+        entry = None
+        while frame is not None:
+            code = frame.f_code
+            filename = os.path.basename(code.co_filename)
+            name = getattr(code, "co_qualname", code.co_name)
+            frames.append(f"{name} ({filename}:{code.co_firstlineno})")
+            if filename == CHAIN_MODULE:
+                # Frames are walked from the innermost, so the last one seen is the entry point
+                entry = name
+            frame = frame.f_back
+        keys = self.sections.get(ident)
+        root = ";".join(keys) if keys else thread_name
+        with self.lock:
+            self.stacks[root + ";" + ";".join(reversed(frames))] += 1
+            if entry:
+                self.methods[entry] += 1
+            self.samples += 1
+
+    def _read_probes(self, elapsed: float):
+        values = {}
+        for name, probe in self.probes.items():
+            try:
+                values[name] = probe()
+            except Exception:
+                values[name] = None
+        if tracemalloc.is_tracing():
+            values["traced_bytes"], values["traced_peak"] = tracemalloc.get_traced_memory()
+        self.growth.append((round(elapsed, 3), values))
+
+    def dump(self, prefix: str):
+        """
+        Writes the collected data and returns the paths written:
+            prefix.folded      folded stacks, for flamegraph.pl, speedscope or inferno
+            prefix.json        section timings, Blockchain methods and growth over time
+            prefix.allocations top allocation sites from tracemalloc
+        """
+        snapshot = tracemalloc.take_snapshot() if self.running else self.snapshot
+        end = monotonic() if self.running else self.stopped
+        with self.lock:
+            stacks = dict(self.stacks)
+            report = {
+                "duration": round(end - self.started, 3) if self.started else 0,
+                "samples": self.samples,
+                "interval": self.interval,
+                "sections": {
+                    key: {"calls": calls, "total": round(total, 6), "mean": round(total / calls, 6), "max": round(longest, 6)}
+                    for key, (calls, total, longest) in sorted(self.timings.items(), key=lambda item: -item[1][1])
+                },
+                # Share of the samples spent inside each Blockchain.py entry point
+                "blockchain": {name: count for name, count in self.methods.most_common()},
+                "growth": [dict(values, time=elapsed) for elapsed, values in self.growth],
+            }
+        directory = os.path.dirname(prefix)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        paths = [prefix + ".folded", prefix + ".json"]
+        with open(paths[0], "w") as f:
+            for stack, count in stacks.items():
+                f.write(f"{stack} {count}\n")
+        with open(paths[1], "w") as f:
+            json.dump(report, f, indent=2)
+        if snapshot is not None:
+            paths.append(prefix + ".allocations")
+            with open(paths[-1], "w") as f:
+                for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]:
+                    f.write(f"{stat}\n")
+        return paths
+
+
+def profiled(key: str):
+    """
+    Decorator that runs a method inside a section of the profiler of its object (self.profiler)
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.profiler.section(key):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def dump_on_signal(profiler: Profiler, prefix: str):
+    """
+    Dumps the profile when the process gets SIGUSR1 and when it exits,
+    for processes that have no interactive command line
+    """
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.dump(prefix))
+    atexit.register(lambda: profiler.dump(prefix))
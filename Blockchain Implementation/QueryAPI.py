@@ -0,0 +1,235 @@
+import json
+import re
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from Thumbnails import bucket
+
+# Number of responses kept for the current chain tip
+CACHE_SIZE = 1024
+# Blocks per page of the chain listing
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# Longest side of a thumbnail when the query does not give one
+THUMBNAIL_SIZE = 128
+
+HASH = re.compile(r"[0-9a-f]{64}")
+USER_ID = re.compile(r"[0-9a-f]{32}")
+
+
+class QueryError(Exception):
+    """
+    A query that cannot be answered, carries the HTTP status
+    """
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def transaction_to_dict(transaction):
+    return {
+        "hash": transaction.hash,
+        "sender": transaction.sender,
+        "receiver": transaction.receiver,
+        "image_id": transaction.image_id,
+        "timestamp": transaction.timestamp,
+    }
+
+
+def block_to_dict(block, height: int):
+    return {
+        "height": height,
+        "hash": block.hash,
+        "previous_hash": block.previous_hash,
+        "timestamp": block.timestamp,
+        "nonce": block.nonce,
+        "merkle_root": block.markle_root,
+        "transactions": [transaction_to_dict(transaction) for transaction in block.transactions],
+    }
+
+
+class QueryServer:
+    """
+    Read-only HTTP/JSON view of the chain for dashboards and scripts
+
+    Routes:
+        GET /                         height and hash of the tip
+        GET /blocks?start=&limit=     blocks from a height, in pages
+        GET /blocks/<height or hash>  a single block
+        GET /images/<image_id>        owner of an image
+        GET /images/<image_id>/thumbnail?size=  JPEG preview of an image
+        GET /users/<user_id>/images   images owned by a user
+
+    Every response carries the hash of the chain tip as its ETag, and responses are cached
+    until the tip changes, so polling with If-None-Match costs nothing between blocks.
+    The chain is read from its published state without taking any lock, so queries never
+    hold up mining or message handling
+    Thumbnails do not change with the tip, they are tagged with the image id and size instead
+    """
+    def __init__(self, get_blockchain, host: str = "127.0.0.1", port: int = 0, get_thumbnail=None):
+        """
+        :param get_blockchain: Returns the current Blockchain, which the client replaces on resync
+        :param host: The host to bind to, only local by default
+        :param port: The port to bind to, any free port if 0
+        :param get_thumbnail: Called with an image id and a size, returns the JPEG thumbnail or None
+        """
+        self.get_blockchain = get_blockchain
+        self.get_thumbnail = get_thumbnail
+        self.lock = threading.Lock()
+        self.tip = None
+        # path -> (status, body) for the current tip
+        self.cache = OrderedDict()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def handle(self, request: BaseHTTPRequestHandler):
+        parts = [part for part in urlsplit(request.path).path.split("/") if part]
+        if len(parts) == 3 and parts[0] == "images" and parts[2] == "thumbnail":
+            return self.handle_thumbnail(request, parts[1])
+
+        # One state serves the whole request, blocks added meanwhile do not change it
+        state = self.get_blockchain().state
+        tip = state.last_hash
+        etag = f'"{tip}"'
+        if request.headers.get("If-None-Match") == etag:
+            request.send_response(304)
+            request.send_header("ETag", etag)
+            request.end_headers()
+            return
+
+        with self.lock:
+            if tip != self.tip:
+                self.tip = tip
+                self.cache.clear()
+            cached = self.cache.get(request.path)
+            if cached:
+                self.cache.move_to_end(request.path)
+
+        if cached:
+            status, body = cached
+        else:
+            try:
+                status, result = 200, self.query(state, request.path)
+            except QueryError as e:
+                status, result = e.status, {"error": str(e)}
+            body = json.dumps(result).encode()
+            with self.lock:
+                # The cache may have moved on to a newer tip while the response was built
+                if tip == self.tip:
+                    self.cache[request.path] = (status, body)
+                    if len(self.cache) > CACHE_SIZE:
+                        self.cache.popitem(last=False)
+
+        self.send(request, status, body, "application/json", etag, "no-cache")
+
+    def handle_thumbnail(self, request: BaseHTTPRequestHandler, image_id: str):
+        """
+        Serves the thumbnail of an image, fetched from the peers if this client has none
+        """
+        try:
+            size = int(parse_qs(urlsplit(request.path).query).get("size", [THUMBNAIL_SIZE])[0])
+        except ValueError:
+            size = 0
+        if not HASH.fullmatch(image_id) or not 0 < size < 65536:
+            body = json.dumps({"error": "A thumbnail needs an image id and a positive size"}).encode()
+            return self.send(request, 400, body, "application/json", None, "no-cache")
+        etag = f'"{image_id}-{bucket(size)}"'
+        if request.headers.get("If-None-Match") == etag:
+            request.send_response(304)
+            request.send_header("ETag", etag)
+            request.end_headers()
+            return
+        data = self.get_thumbnail(image_id, size) if self.get_thumbnail else None
+        if data is None:
+            body = json.dumps({"error": "Thumbnail not found"}).encode()
+            return self.send(request, 404, body, "application/json", None, "no-cache")
+        self.send(request, 200, data, "image/jpeg", etag, "max-age=86400")
+
+    def send(self, request: BaseHTTPRequestHandler, status: int, body: bytes, content_type: str, etag, cache_control: str):
+        request.send_response(status)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Content-Length", str(len(body)))
+        if etag:
+            request.send_header("ETag", etag)
+        request.send_header("Cache-Control", cache_control)
+        request.end_headers()
+        request.wfile.write(body)
+
+    def query(self, state, path: str):
+        """
+        Answers a query from the given chain state and returns the result to be sent as JSON
+        """
+        url = urlsplit(path)
+        parts = [part for part in url.path.split("/") if part]
+        params = parse_qs(url.query)
+
+        if not parts:
+            return {"height": state.height, "last_hash": state.last_hash, "base_height": state.base_height}
+
+        if parts[0] == "blocks" and len(parts) == 1:
+            try:
+                start = int(params.get("start", [state.base_height])[0])
+                limit = min(int(params.get("limit", [PAGE_SIZE])[0]), MAX_PAGE_SIZE)
+            except ValueError:
+                raise QueryError(400, "start and limit must be integers")
+            if limit < 1:
+                raise QueryError(400, "limit must be positive")
+            first = max(start, state.base_height)
+            index = first - state.base_height
+            blocks = [block_to_dict(block, height) for height, block in enumerate(state.chain[index:index + limit], first)]
+            end = first + len(blocks)
+            return {
+                "height": state.height,
+                "blocks": blocks,
+                "next": end if end <= state.height else None,
+            }
+
+        if parts[0] == "blocks" and len(parts) == 2:
+            return self.find_block(state, parts[1])
+
+        if parts[0] == "images" and len(parts) == 2 and HASH.fullmatch(parts[1]):
+            owner = state.find_owner(parts[1])
+            if owner is None:
+                raise QueryError(404, "Image not found")
+            return {"image_id": parts[1], "owner": owner}
+
+        if parts[0] == "users" and len(parts) == 3 and parts[2] == "images" and USER_ID.fullmatch(parts[1]):
+            return {"user_id": parts[1], "images": sorted(state.find_images(parts[1]))}
+
+        raise QueryError(404, "Unknown query")
+
+    def find_block(self, state, key: str):
+        """
+        Finds a block by height or by hash. Blocks are searched from the tip,
+        where the blocks asked for usually are
+        """
+        chain = state.chain
+        base_height = state.base_height
+        if key.isdigit():
+            height = int(key)
+            if not base_height <= height < base_height + len(chain):
+                raise QueryError(404, "Block not found")
+            return block_to_dict(chain[height - base_height], height)
+        if not HASH.fullmatch(key):
+            raise QueryError(400, "A block is looked up by height or hash")
+        for index in range(len(chain) - 1, -1, -1):
+            if chain[index].hash == key:
+                return block_to_dict(chain[index], base_height + index)
+        raise QueryError(404, "Block not found")
@@ -0,0 +1,672 @@
+import gc
+import heapq
+import json
+import math
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import types
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from time import sleep, monotonic
+from concurrent.futures import TimeoutError as FutureTimeout
+from Blockchain import Blockchain, Block, Transaction, MAX_TARGET, BLOCK_INTERVAL, target_from_difficulty
+from Client import Client
+from Tracker import Tracker
+from DHT import RoutingTable, lookup, KEY_BITS, BUCKET_SIZE, REPLICATION
+from Pool import PoolCoordinator, SHARE_DIFFICULTY
+
+# Connections are TCP, so a lost segment shows up as a retransmission delay
+# rather than a lost message. This is the minimum retransmission timeout
+RETRANSMIT_TIMEOUT = 0.2
+
+# Objects that are shared by every node and not counted in the per-node memory
+_SHARED_TYPES = (type, types.ModuleType, types.FunctionType, types.BuiltinFunctionType, threading.Thread)
+
+
+def percentile(values, p: float):
+    """
+    Nearest-rank percentile of a list of numbers, None if it is empty
+    """
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100 * len(values) + 0.5)) - 1))]
+
+
+def deep_size(root, exclude=()):
+    """
+    Approximate number of bytes reachable from an object, leaving out classes,
+    modules, functions, threads and the excluded objects
+    """
+    seen = {id(obj) for obj in exclude}
+    stack = [root]
+    size = 0
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, _SHARED_TYPES):
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        stack.extend(gc.get_referents(obj))
+    return size
+
+
+class Link:
+    """
+    Latency and loss injected on every connection
+    """
+    def __init__(self, latency: float = 0, jitter: float = 0, loss: float = 0, rng: random.Random = None):
+        """
+        :param latency: One way delay in seconds
+        :param jitter: Extra delay in seconds, uniform between 0 and jitter
+        :param loss: Probability that a message or segment is lost and retransmitted
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.rng = rng or random.Random()
+        self.lock = threading.Lock()
+
+    @property
+    def impaired(self):
+        return self.latency > 0 or self.jitter > 0 or self.loss > 0
+
+    def delay(self):
+        """
+        Draws the delay of one message in seconds
+        """
+        with self.lock:
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+            if self.rng.random() < self.loss:
+                delay += RETRANSMIT_TIMEOUT
+        return delay
+
+
+class ImpairedSocket:
+    """
+    Socket wrapper that delivers outgoing data after the link delay
+    Data leaves in order, so a delayed write holds back the ones after it like on TCP
+    Everything else is passed to the wrapped socket
+    """
+    def __init__(self, sock, link: Link):
+        self.sock = sock
+        self.link = link
+        self.cond = threading.Condition()
+        self.pending = []
+        self.ready_at = 0
+        self.broken = False
+        threading.Thread(target=self._deliver, daemon=True).start()
+
+    def _enqueue(self, data):
+        with self.cond:
+            if self.broken:
+                raise ConnectionResetError("Connection closed")
+            self.ready_at = max(self.ready_at, monotonic() + self.link.delay())
+            self.pending.append((self.ready_at, data))
+            self.cond.notify()
+
+    def _deliver(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                ready_at, data = self.pending.pop(0)
+            wait = ready_at - monotonic()
+            if wait > 0:
+                sleep(wait)
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                with self.cond:
+                    self.broken = True
+                    self.pending.clear()
+
+    def sendall(self, data):
+        self._enqueue(bytes(data))
+
+    def sendmsg(self, buffers):
+        data = b"".join(bytes(memoryview(buffer).cast("B")) for buffer in buffers)
+        self._enqueue(data)
+        return len(data)
+
+    def sendfile(self, file, offset: int = 0, count: int = None):
+        file.seek(offset)
+        data = file.read() if count is None else file.read(count)
+        self._enqueue(data)
+        return len(data)
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+
+class Workload:
+    """
+    Mint and transfer operations arriving as a Poisson process
+    """
+    def __init__(self, rate: float, transfer_ratio: float = 0.3, image_size: int = 2048, seed: int = None):
+        """
+        :param rate: Average number of operations per second over the whole network
+        :param transfer_ratio: Share of operations that transfer an owned image instead of minting one
+        :param image_size: Size of the minted images in bytes
+        :param seed: Seed of the random generator, runs with the same seed submit the same operations
+        """
+        self.rate = rate
+        self.transfer_ratio = transfer_ratio
+        self.image_size = image_size
+        self.rng = random.Random(seed)
+
+    def arrivals(self, duration: float):
+        """
+        Generator of (time in seconds, operation) pairs, operation is "mint" or "transfer"
+        """
+        t = 0
+        while self.rate > 0:
+            t += self.rng.expovariate(self.rate)
+            if t >= duration:
+                return
+            yield t, "transfer" if self.rng.random() < self.transfer_ratio else "mint"
+
+    def image(self):
+        """
+        Random image data, each one has a different id
+        """
+        return self.rng.randbytes(self.image_size)
+
+
+class Metrics:
+    """
+    Collects the block and transaction events of a run and builds the report
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.submitted = 0
+        # block hash -> (node, time in seconds) of the node that mined it
+        self.mined = {}
+        # block hash -> list of seconds until each other node accepted it
+        self.propagation = {}
+
+    def transaction_submitted(self):
+        with self.lock:
+            self.submitted += 1
+
+    def block_mined(self, node, block_hash: str, t: float):
+        with self.lock:
+            self.mined[block_hash] = (node, t)
+            self.propagation[block_hash] = []
+
+    def block_received(self, node, block_hash: str, t: float):
+        with self.lock:
+            if block_hash in self.mined and self.mined[block_hash][0] != node:
+                self.propagation[block_hash].append(t - self.mined[block_hash][1])
+
+    def report(self, chains, elapsed: float, memory):
+        """
+        :param chains: The blockchain of every node at the end of the run
+        :param elapsed: Length of the run in seconds
+        :param memory: Bytes held by every node
+        """
+        # The tip most nodes agree on is taken as the final chain
+        tips = {}
+        for chain in chains:
+            tips.setdefault(chain.last_hash, []).append(chain)
+        final = max(tips.values(), key=len)[0]
+        included = {block.hash for block in final.chain}
+        confirmed = sum(len(block.transactions) for block in final.chain)
+        stale = [block_hash for block_hash in self.mined if block_hash not in included]
+        delays = [delay for delays in self.propagation.values() for delay in delays]
+        return {
+            "elapsed": round(elapsed, 3),
+            "submitted": self.submitted,
+            "confirmed": confirmed,
+            "tps": round(confirmed / elapsed, 3) if elapsed else None,
+            "height": final.height,
+            "blocks_mined": len(self.mined),
+            "stale_blocks": len(stale),
+            "fork_rate": round(len(stale) / len(self.mined), 4) if self.mined else 0,
+            "converged": round(len(tips[final.last_hash]) / len(chains), 4),
+            "propagation": {
+                "samples": len(delays),
+                "p50": percentile(delays, 50),
+                "p90": percentile(delays, 90),
+                "p99": percentile(delays, 99),
+                "max": max(delays) if delays else None,
+            },
+            "memory": {
+                "per_node": memory,
+                "mean": sum(memory) // len(memory) if memory else 0,
+                "max": max(memory) if memory else 0,
+            },
+        }
+
+
+class SimClient(Client):
+    """
+    Headless client that reports its blocks to the metrics and runs its connections over the link
+    """
+    def __init__(self, tracker_port: int, username: str, data_dir: str, metrics: Metrics, link: Link, start: float):
+        self.metrics = metrics
+        self.link = link
+        self.start = start
+        super().__init__("127.0.0.1", 0, "127.0.0.1", tracker_port, "headless", username=username, data_dir=data_dir)
+
+    def open_channel(self, sock, peer, initiator, handler=None, on_close=None):
+        if self.link.impaired:
+            sock = ImpairedSocket(sock, self.link)
+        return super().open_channel(sock, peer, initiator, handler, on_close)
+
+    def send_block(self, block):
+        self.metrics.block_mined(self.user_id, block.hash, monotonic() - self.start)
+        super().send_block(block)
+
+    def receive_block(self, block):
+        accepted = super().receive_block(block)
+        if accepted:
+            self.metrics.block_received(self.user_id, block.hash, monotonic() - self.start)
+        return accepted
+
+
+def submit(client: Client, operation: str, workload: Workload, clients):
+    """
+    Submits one workload operation on a client, transfers fall back to mints
+    when the client does not own any image yet
+    """
+    if operation == "transfer":
+        owned = client.blockchain.find_images(client.user_id)
+        recipients = [other for other in clients if other is not client]
+        if owned and recipients:
+            return client.transfer_nft(workload.rng.choice(owned), workload.rng.choice(recipients).user_id)
+    return client.create_nft(workload.image())
+
+
+def run_loopback(nodes: int, duration: float, workload: Workload, link: Link, settle: float = 10):
+    """
+    Runs a tracker and headless clients on loopback sockets in this process
+    Returns the report of the run
+    """
+    data_dir = tempfile.mkdtemp(prefix="simulator-")
+    metrics = Metrics()
+    tracker = Tracker("127.0.0.1", 0)
+    tracker_port = tracker.sock.getsockname()[1]
+    start = monotonic()
+    clients = []
+    try:
+        for i in range(nodes):
+            clients.append(SimClient(tracker_port, f"node{i}", data_dir, metrics, link, start))
+
+        begin = monotonic()
+        for t, operation in workload.arrivals(duration):
+            wait = begin + t - monotonic()
+            if wait > 0:
+                sleep(wait)
+            if submit(workload.rng.choice(clients), operation, workload, clients):
+                metrics.transaction_submitted()
+        remaining = begin + duration - monotonic()
+        sleep(max(0, remaining) + settle)
+        elapsed = monotonic() - begin
+
+        chains = [client.blockchain for client in clients]
+        memory = [deep_size(client, exclude=[metrics, link] + [other for other in clients if other is not client]) for client in clients]
+    finally:
+        # The client and tracker threads are not daemons, so they must be stopped for the process to exit
+        for client in clients:
+            client.shutdown()
+        tracker.close()
+        # Every node's images, snapshots and thumbnails are under it
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = metrics.report(chains, elapsed, memory)
+    report["peak_rss_kib"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    report["stored_images"] = [len(client.storage) for client in clients]
+    return report
+
+
+def run_dht(nodes: int, lookups: int, images: int, bucket_size: int = BUCKET_SIZE, replication: int = REPLICATION, seed: int = None):
+    """
+    Builds the routing tables of a network in this process and runs lookups over them
+    Every node is offered every other node in a random order, like nodes joining one by one,
+    and keeps what its buckets have room for
+    Returns the rounds per lookup, the share of lookups that found the truly closest nodes,
+    and the images per node when each image is stored on the closest nodes
+    """
+    rng = random.Random(seed)
+    keys = [rng.getrandbits(KEY_BITS) for _ in range(nodes)]
+    tables = {}
+    for key in keys:
+        table = RoutingTable(key, bucket_size)
+        for other in rng.sample(keys, len(keys)):
+            table.add(other, other)
+        tables[key] = table
+
+    rounds = []
+    exact = 0
+    stored = dict.fromkeys(keys, 0)
+    for i in range(max(lookups, images)):
+        target = rng.getrandbits(KEY_BITS)
+        closest = sorted(keys, key=lambda key: key ^ target)[:replication]
+        if i < images:
+            for key in closest:
+                stored[key] += 1
+        if i < lookups:
+            start = tables[rng.choice(keys)]
+            found, hops = lookup(start, target, lambda contact: tables[contact].closest(target, replication), replication)
+            # The node looking up may be one of the closest itself
+            found = sorted([key for key, _ in found] + [start.own_key], key=lambda key: key ^ target)[:replication]
+            rounds.append(hops)
+            exact += found == closest
+
+    per_node = list(stored.values())
+    return {
+        "bucket_size": bucket_size,
+        "replication": replication,
+        "contacts": {
+            "mean": round(sum(len(table) for table in tables.values()) / nodes, 1),
+            "max": max(len(table) for table in tables.values()),
+        },
+        "lookups": {
+            "samples": len(rounds),
+            "log2_nodes": round(math.log2(nodes), 2),
+            "mean_rounds": round(sum(rounds) / len(rounds), 2) if rounds else None,
+            "p90_rounds": percentile(rounds, 90),
+            "max_rounds": max(rounds) if rounds else None,
+            "exact": round(exact / len(rounds), 4) if rounds else None,
+        },
+        "storage": {
+            "images": images,
+            "expected_per_node": round(images * replication / nodes, 1),
+            "mean_per_node": round(sum(per_node) / nodes, 1),
+            "max_per_node": max(per_node),
+        },
+    }
+
+
+def run_pool(workers: int, duration: float, difficulty: int, tip_interval: float, share_difficulty: int = SHARE_DIFFICULTY, seed: int = None):
+    """
+    Mines blocks with a pool coordinator and local worker processes, and no mining thread of its own
+    A block not mined within tip_interval is replaced, as if a peer's block had arrived, so the
+    workers have to drop stale work. Returns the blocks mined and the statistics of every worker
+    """
+    rng = random.Random(seed)
+    pool = PoolCoordinator("127.0.0.1", 0, share_difficulty)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Pool.py")
+    processes = [
+        subprocess.Popen([sys.executable, script, f"127.0.0.1:{pool.port}", "--name", f"worker-{i}"], stdout=subprocess.DEVNULL)
+        for i in range(workers)
+    ]
+    deadline = monotonic() + 10
+    while len(pool.workers) < workers and monotonic() < deadline:
+        sleep(0.1)
+
+    target = target_from_difficulty(difficulty)
+    previous_hash = "%064x" % rng.getrandbits(256)
+    block_times = []
+    replaced = 0
+    invalid_blocks = 0
+    started = monotonic()
+    end = started + duration
+    while monotonic() < end:
+        transaction = Transaction("%032x" % rng.getrandbits(128), "%032x" % rng.getrandbits(128), "%064x" % rng.getrandbits(256))
+        block = Block([transaction], previous_hash)
+        mined = monotonic()
+        future = block.mine(target, workers=0)
+        pool.publish(block, target)
+        try:
+            future.result(timeout=max(0, min(tip_interval, end - mined)))
+        except FutureTimeout:
+            block._stop()
+            replaced += 1
+            previous_hash = "%064x" % rng.getrandbits(256)
+            continue
+        block_times.append(monotonic() - mined)
+        invalid_blocks += block._hash() != block.hash or not block.meets_target(target)
+        previous_hash = block.hash
+    elapsed = monotonic() - started
+    # Shares still on their way in are counted before the statistics are read
+    sleep(0.5)
+    stats = pool.stats()
+    hashrate = pool.hashrate()
+    for process in processes:
+        process.terminate()
+        process.wait()
+    pool.close()
+    return {
+        "workers": len(stats),
+        "difficulty": difficulty,
+        "share_difficulty": share_difficulty,
+        "duration": round(elapsed, 2),
+        "blocks": {
+            "mined": len(block_times),
+            "invalid": invalid_blocks,
+            "replaced": replaced,
+            "mean_seconds": round(sum(block_times) / len(block_times), 3) if block_times else None,
+            "expected_seconds": round(2 ** 256 / (target + 1) / hashrate, 3) if hashrate else None,
+        },
+        "hashrate": round(hashrate),
+        "per_worker": stats,
+    }
+
+
+class VirtualNode:
+    """
+    Model of a client for the virtual network: mining and messages are events on
+    the virtual clock, while chains, blocks and transactions are the real ones
+    """
+    def __init__(self, network, user_id: str, blockchain: Blockchain):
+        self.network = network
+        self.user_id = user_id
+        self.blockchain = blockchain
+        # Transactions and previous hash of the block being mined, like Client.current_block
+        self.transactions = []
+        self.previous_hash = blockchain.last_hash
+        # Bumped whenever mining restarts, so that stale mining events are ignored
+        self.epoch = 0
+
+    def restart_mining(self):
+        """
+        Draws when the current block will be mined. Mining is memoryless, so a restart
+        after a new transaction simply draws a new time
+        """
+        self.epoch += 1
+        if not self.transactions:
+            return
+        rate = self.network.hashrate * self.blockchain.target / 2 ** 256
+        self.network.schedule(self.network.rng.expovariate(rate), self.block_mined, self.epoch)
+
+    def reset_block(self):
+        self.transactions = []
+        self.previous_hash = self.blockchain.last_hash
+        self.restart_mining()
+
+    def add_transaction(self, transaction: Transaction, own: bool = False):
+        self.transactions.append(transaction)
+        self.restart_mining()
+        if own:
+            for peer in self.network.peers(self):
+                self.network.send(peer.add_transaction, transaction)
+
+    def block_mined(self, epoch: int):
+        if epoch != self.epoch:
+            return
+        network = self.network
+        block = Block(list(self.transactions), self.previous_hash, network.now_ns)
+        network.solve(block, self.blockchain.target)
+        if not self.blockchain.add_block(block):
+            # Rebase the pending transactions on top of the peers' chain and mine again
+            self.sync(block.transactions)
+            return
+        network.metrics.block_mined(self.user_id, block.hash, network.now)
+        self.reset_block()
+        peers = network.peers(self)
+        votes = {"success": 0, "failure": 0, "pending": len(peers)}
+        for peer in peers:
+            network.send(peer.receive_block, block, self, votes)
+
+    def receive_block(self, block: Block, sender, votes: dict):
+        accepted = self.blockchain.add_block(block)
+        if accepted:
+            self.network.metrics.block_received(self.user_id, block.hash, self.network.now)
+            self.reset_block()
+        self.network.send(sender.block_answered, accepted, votes)
+
+    def block_answered(self, accepted: bool, votes: dict):
+        votes["success" if accepted else "failure"] += 1
+        votes["pending"] -= 1
+        if votes["pending"] == 0 and votes["success"] < votes["failure"]:
+            self.sync()
+
+    def sync(self, transactions=None):
+        """
+        Fetches the chain from two random peers after a round trip and adopts it if they agree,
+        otherwise tries again after 2 seconds like Client.get_blockchain
+        """
+        peers = self.network.peers(self)
+        if not peers:
+            return
+        chosen = self.network.rng.sample(peers, min(2, len(peers)))
+        self.network.schedule(self.network.link.delay() * 2, self.adopt_chain, chosen, transactions)
+
+    def adopt_chain(self, chosen, transactions):
+        if len({peer.blockchain.last_hash for peer in chosen}) != 1:
+            self.network.schedule(2, self.sync, transactions)
+            return
+        self.blockchain = Blockchain.from_struct(chosen[0].blockchain.to_struct())
+        self.reset_block()
+        if transactions:
+            self.transactions = list(transactions)
+            self.restart_mining()
+
+
+class VirtualNetwork:
+    """
+    Discrete event simulation of a fully connected network on a virtual clock
+    Runs much faster than real time and gives the same result for the same seed
+    """
+    def __init__(self, nodes: int, link: Link, block_interval: float = BLOCK_INTERVAL / 1e9, seed: int = None):
+        """
+        :param nodes: Number of nodes
+        :param link: Latency and loss of every message
+        :param block_interval: Aimed seconds between blocks, which sets the hash rate of the network
+        """
+        self.rng = random.Random(seed)
+        self.link = link
+        self.metrics = Metrics()
+        self.events = []
+        self.sequence = 0
+        self.now = 0
+        # The easiest target keeps the nonce search for every simulated block short
+        genesis = Blockchain(initial_target=MAX_TARGET, block_interval=int(block_interval * 1e9))
+        self.epoch_ns = genesis.chain[0].timestamp
+        # Hashes per second of a single node, such that the whole network meets
+        # the initial target once per block interval on average
+        self.hashrate = 2 ** 256 / (genesis.initial_target * block_interval * nodes)
+        data = genesis.to_struct()
+        self.nodes = [VirtualNode(self, "%032x" % self.rng.getrandbits(128), Blockchain.from_struct(data)) for _ in range(nodes)]
+
+    @property
+    def now_ns(self):
+        return self.epoch_ns + int(self.now * 1e9)
+
+    def schedule(self, delay: float, callback, *args):
+        self.sequence += 1
+        heapq.heappush(self.events, (self.now + delay, self.sequence, callback, args))
+
+    def send(self, callback, *args):
+        """
+        Delivers a message to a node after the link delay
+        """
+        self.schedule(self.link.delay(), callback, *args)
+
+    def peers(self, node: VirtualNode):
+        return [other for other in self.nodes if other is not node]
+
+    def solve(self, block: Block, target: int):
+        """
+        Finds a nonce for the block at its virtual timestamp
+        """
+        while True:
+            nonce = "%032x" % self.rng.getrandbits(128)
+            block_hash = block._hash(nonce)
+            if int(block_hash, 16) <= target:
+                block.nonce = nonce
+                block.hash = block_hash
+                return block
+
+    def submit(self, operation: str, workload: Workload):
+        node = self.rng.choice(self.nodes)
+        timestamp = self.now_ns
+        if operation == "transfer":
+            owned = node.blockchain.find_images(node.user_id)
+            if owned:
+                recipient = self.rng.choice(self.peers(node)) if len(self.nodes) > 1 else node
+                node.add_transaction(Transaction(node.user_id, recipient.user_id, self.rng.choice(owned), timestamp), True)
+                self.metrics.transaction_submitted()
+                return
+        image_id = "%064x" % self.rng.getrandbits(256)
+        node.add_transaction(Transaction(node.user_id, node.user_id, image_id, timestamp), True)
+        self.metrics.transaction_submitted()
+
+    def run(self, duration: float, workload: Workload, settle: float = 10):
+        """
+        Runs the workload for duration virtual seconds and then lets the network settle
+        Returns the report of the run
+        """
+        for t, operation in workload.arrivals(duration):
+            self.schedule(t, self.submit, operation, workload)
+        end = duration + settle
+        while self.events and self.events[0][0] <= end:
+            self.now, _, callback, args = heapq.heappop(self.events)
+            callback(*args)
+        self.now = end
+
+        chains = [node.blockchain for node in self.nodes]
+        memory = [deep_size(node, exclude=[self, self.metrics, self.link] + self.peers(node)) for node in self.nodes]
+        return self.metrics.report(chains, end, memory)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Runs a simulated network under a mint/transfer workload and reports its performance")
+    parser.add_argument("mode", type=str, choices=["loopback", "virtual", "dht", "pool"], help="Real clients on loopback sockets, a model on a virtual clock, lookups over in-process routing tables, or pool mining with local worker processes")
+    parser.add_argument("--nodes", type=int, default=4, help="Number of clients, or of worker processes (pool mode)")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds during which operations are submitted")
+    parser.add_argument("--settle", type=float, default=10, help="Seconds to wait for the last blocks after the workload")
+    parser.add_argument("--rate", type=float, default=1, help="Average operations per second over the network")
+    parser.add_argument("--transfer-ratio", type=float, default=0.3, help="Share of operations that are transfers")
+    parser.add_argument("--image-size", type=int, default=2048, help="Size of minted images in bytes")
+    parser.add_argument("--latency", type=float, default=0, help="One way latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0, help="Extra random latency in seconds")
+    parser.add_argument("--loss", type=float, default=0, help="Probability of a lost message, retransmitted after 200ms")
+    parser.add_argument("--block-interval", type=float, default=BLOCK_INTERVAL / 1e9, help="Aimed seconds between blocks (virtual mode)")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for reproducible runs")
+    parser.add_argument("--output", type=str, default=None, help="File to write the JSON report to")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the clients")
+    parser.add_argument("--lookups", type=int, default=1000, help="Number of lookups (dht mode)")
+    parser.add_argument("--images", type=int, default=10000, help="Number of images placed on the closest nodes (dht mode)")
+    parser.add_argument("--bucket-size", type=int, default=BUCKET_SIZE, help="Contacts per routing table bucket (dht mode)")
+    parser.add_argument("--replication", type=int, default=REPLICATION, help="Nodes storing each image (dht mode)")
+    parser.add_argument("--difficulty", type=int, default=5, help="Leading hex zeros of the mined blocks (pool mode)")
+    parser.add_argument("--share-difficulty", type=int, default=SHARE_DIFFICULTY, help="Leading hex zeros of a share (pool mode)")
+    parser.add_argument("--tip-interval", type=float, default=5, help="Seconds after which an unmined block is replaced (pool mode)")
+    args = parser.parse_args()
+
+    workload = Workload(args.rate, args.transfer_ratio, args.image_size, args.seed)
+    link = Link(args.latency, args.jitter, args.loss, random.Random(args.seed))
+    with redirect_stdout(sys.stdout if args.verbose else open(os.devnull, "w")):
+        if args.mode == "loopback":
+            report = run_loopback(args.nodes, args.duration, workload, link, args.settle)
+        elif args.mode == "pool":
+            report = run_pool(args.nodes, args.duration, args.difficulty, args.tip_interval, args.share_difficulty, args.seed)
+        elif args.mode == "dht":
+            report = run_dht(args.nodes, args.lookups, args.images, args.bucket_size, args.replication, args.seed)
+        else:
+            report = VirtualNetwork(args.nodes, link, args.block_interval, args.seed).run(args.duration, workload, args.settle)
+    report = {"mode": args.mode, "nodes": args.nodes, **report}
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    print(text)
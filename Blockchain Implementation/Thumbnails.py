@@ -0,0 +1,104 @@
+import io
+import os
+import re
+import threading
+from uuid import uuid4
+
+# Longest side in pixels of the thumbnails a node generates, requests are rounded up to one of them
+THUMBNAIL_SIZES = (64, 128, 256, 512)
+# JPEG quality of the thumbnails, they are saved progressive so a partial one already shows the whole picture
+THUMBNAIL_QUALITY = 75
+# Largest thumbnail accepted from a peer, a 512 pixel JPEG is far below it
+MAX_THUMBNAIL_SIZE = 256 * 1024
+
+IMAGE_ID = re.compile(r"[0-9a-f]{64}")
+
+
+def bucket(size: int):
+    """
+    Returns the smallest thumbnail size that is at least the given size, or the largest one
+    """
+    return next((bucket_size for bucket_size in THUMBNAIL_SIZES if bucket_size >= size), THUMBNAIL_SIZES[-1])
+
+
+def make_thumbnail(source, size: int):
+    """
+    Returns a JPEG of the image (bytes or a file path) scaled down to fit in size x size
+    PIL is imported on the first thumbnail, nodes that never make one start without it
+    """
+    from PIL import Image
+    image = Image.open(source if isinstance(source, (str, os.PathLike)) else io.BytesIO(source))
+    # JPEGs are decoded at a reduced scale straight away, which is much faster than decoding them whole
+    image.draft("RGB", (size, size))
+    image.thumbnail((size, size), Image.LANCZOS)
+    out = io.BytesIO()
+    image.convert("RGB").save(out, "JPEG", quality=THUMBNAIL_QUALITY, progressive=True, optimize=True)
+    return out.getvalue()
+
+
+class ThumbnailCache:
+    """
+    Disk cache of thumbnails keyed by image id and size bucket
+    Thumbnails of the stored images are generated once, on the first request, and
+    thumbnails received from peers are kept so they are not fetched again
+    """
+    def __init__(self, directory: str):
+        """
+        :param directory: The directory the thumbnails are kept in, it is created if needed
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        # (image_id, size) -> lock held while the thumbnail is generated, so it is generated only once
+        self.generating = {}
+
+    def path(self, image_id: str, size: int):
+        """
+        Raises ValueError unless the image id is a sha256 hex string, ids from peers never reach the file system otherwise
+        """
+        if not IMAGE_ID.fullmatch(image_id):
+            raise ValueError(f"Invalid image id {image_id!r}")
+        return os.path.join(self.directory, f"{image_id}-{size}.jpg")
+
+    def get(self, image_id: str, size: int):
+        """
+        Returns the cached thumbnail of the size bucket, or None
+        """
+        try:
+            with open(self.path(image_id, bucket(size)), "rb") as f:
+                return f.read()
+        except (OSError, ValueError):
+            return None
+
+    def put(self, image_id: str, size: int, data: bytes):
+        """
+        Caches a thumbnail, it is written aside and swapped in so readers never see half of it
+        """
+        path = self.path(image_id, bucket(size))
+        tmp_path = os.path.join(self.directory, f".{uuid4().hex}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def generate(self, image_id: str, size: int, source):
+        """
+        Returns the thumbnail of the size bucket, generating it from the source file if it is not cached
+        Returns None if the image cannot be decoded, is too large to decode, or PIL is not installed
+        """
+        size = bucket(size)
+        if not IMAGE_ID.fullmatch(image_id):
+            return None
+        with self.lock:
+            lock = self.generating.setdefault((image_id, size), threading.Lock())
+        with lock:
+            data = self.get(image_id, size)
+            if data is None:
+                try:
+                    data = make_thumbnail(source, size)
+                    self.put(image_id, size, data)
+                except Exception:
+                    # PIL raises errors of its own as well, e.g. DecompressionBombError for huge images
+                    data = None
+        with self.lock:
+            self.generating.pop((image_id, size), None)
+        return data
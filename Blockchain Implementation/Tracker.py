@@ -1,18 +1,100 @@
 import socket
 import threading
 import struct
-import sys
+import os
+import json
+from argparse import ArgumentParser
 from time import sleep
+from Profiling import Profiler, profiled, dump_on_signal
+
+# The log is compacted once it holds this many records more than there are users
+COMPACT_THRESHOLD = 1000
+# Seconds recovered users have to reconnect before they are no longer handed out as peers
+RECOVERY_GRACE = 60
+# Longest wait in seconds between two attempts to reach a standby tracker
+REPLICA_RETRY = 30
+
+
+def recv_exact(conn, size: int):
+    """
+    Receives exactly size bytes, raises ConnectionResetError if the connection is closed before that
+    """
+    data = b""
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionResetError("Connection closed")
+        data += chunk
+    return data
+
+
+class TrackerLog:
+    """
+    Append-only log of user records, each line is the JSON of the latest state of one user
+    Replaying the log gives the state back, and compaction rewrites it with one line per user
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.records = 0
+        self.file = None
+
+    def load(self):
+        """
+        Replays the log and returns the users keyed by user_id
+        A line cut short by a crash is skipped
+        """
+        users = {}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    users[record["user_id"]] = record
+                    self.records += 1
+        self.file = open(self.path, "a")
+        return users
+
+    def append(self, record: dict):
+        self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.records += 1
+
+    def compact(self, users: dict):
+        """
+        Rewrites the log with the current state of every user and swaps it in atomically
+        """
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            for record in users.values():
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.file.close()
+        os.replace(tmp_path, self.path)
+        self.file = open(self.path, "a")
+        self.records = len(users)
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
 
 class Tracker:
     """
     Tracker keeps track of all active users and sends the list of to new users
     """
-    def __init__(self, host, port):
+    def __init__(self, host, port, state_path=None, replication_port=None, replicas=(), profile=None):
         """
         Initialize the tracker
-        :param host: The host to bind the tracker to 
+        :param host: The host to bind the tracker to
         :param port: The port to bind the tracker to
+        :param state_path: The file the users are logged to, the state is only kept in memory if not given
+        :param replication_port: The port to receive records from a primary tracker on, for standby trackers
+        :param replicas: (host, replication port) of the standby trackers the records are sent to
+        :param profile: Path prefix to write a profile to on SIGUSR1 and at exit, profiling runs from the start if given
         """
         self.host = host
         self.port = port
@@ -20,36 +102,208 @@ class Tracker:
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sock.bind((self.host, self.port))
         self.sock.listen()
+        self.lock = threading.Lock()
+        # user_id -> {user_id, username, host, listen_port, addr, active}
         self.users = {}
+        # (ip, port) the user connected from -> user_id, to recognize returning users
+        self.addresses = {}
+        # user_id -> the open connection of the user
+        self.connections = {}
+        self.running = True
+        self.profiler = Profiler({
+            "users": lambda: len(self.users),
+            "connections": lambda: len(self.connections),
+            "log_records": lambda: self.log.records if self.log else 0,
+        })
+        if profile:
+            self.profiler.start()
+            dump_on_signal(self.profiler, profile)
+
+        self.log = TrackerLog(state_path) if state_path else None
+        if self.log:
+            self.recover(self.log.load())
+
+        # Every standby tracker gets its own queue of records so a slow one does not hold up the others
+        self.replica_queues = []
+        self.replica_socks = []
+        for replica in replicas:
+            records = []
+            self.replica_queues.append((records, threading.Condition()))
+            threading.Thread(target=self.replicate, args=(replica, records, self.replica_queues[-1][1]), daemon=True).start()
+
         print(f"Tracker is listening on {self.sock.getsockname()[0]}:{self.port}")
         threading.Thread(target=self.accept_connections).start()
 
+        if replication_port is not None:
+            self.replication_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.replication_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.replication_sock.bind((self.host, replication_port))
+            self.replication_sock.listen()
+            threading.Thread(target=self.accept_replication, daemon=True).start()
+
+    @profiled("recover")
+    def recover(self, users: dict):
+        """
+        Restores the users from the log. Users that were active are handed out as peers
+        right away, and marked inactive if they do not reconnect within the grace period
+        """
+        with self.lock:
+            for user_id, record in users.items():
+                self.users[user_id] = record
+                self.addresses[tuple(record["addr"])] = user_id
+            self.log.compact(self.users)
+        if users:
+            print(f"Recovered {len(users)} users")
+        self.expire_later([user_id for user_id, record in users.items() if record["active"]])
+
+    def expire_later(self, user_ids):
+        """
+        Marks the given users inactive after the grace period unless they reconnected to this tracker
+        """
+        def expire():
+            sleep(RECOVERY_GRACE)
+            with self.lock:
+                for user_id in user_ids:
+                    record = self.users.get(user_id)
+                    if record and record["active"] and user_id not in self.connections:
+                        self.update({**record, "active": False})
+        threading.Thread(target=expire, daemon=True).start()
+
+    @profiled("update")
+    def update(self, record: dict, replicate: bool = True):
+        """
+        Applies a user record, logs it and sends it to the standby trackers
+        Must be called with the lock held
+        :param replicate: False for records that came from another tracker, so they are not sent back
+        """
+        self.users[record["user_id"]] = record
+        self.addresses[tuple(record["addr"])] = record["user_id"]
+        if self.log:
+            self.log.append(record)
+            if self.log.records > len(self.users) + COMPACT_THRESHOLD:
+                self.log.compact(self.users)
+        if replicate:
+            for records, cond in self.replica_queues:
+                with cond:
+                    records.append(record)
+                    cond.notify()
+
+    def replicate(self, replica, records: list, cond: threading.Condition):
+        """
+        Streams records to a standby tracker, each as a 4 byte length and the JSON
+        The whole state is sent first on every (re)connection
+        """
+        delay = 1
+        while self.running:
+            try:
+                sock = socket.create_connection(replica)
+            except OSError:
+                sleep(delay)
+                delay = min(delay * 2, REPLICA_RETRY)
+                continue
+            delay = 1
+            # Records queued before the state is copied are part of it
+            with self.lock:
+                self.replica_socks.append(sock)
+                state = list(self.users.values())
+                with cond:
+                    records.clear()
+            try:
+                for record in state:
+                    data = json.dumps(record).encode()
+                    sock.sendall(struct.pack("!I", len(data)) + data)
+                while self.running:
+                    with cond:
+                        while not records:
+                            cond.wait()
+                        pending = records[:]
+                        records.clear()
+                    for record in pending:
+                        data = json.dumps(record).encode()
+                        sock.sendall(struct.pack("!I", len(data)) + data)
+            except OSError:
+                pass
+            with self.lock:
+                self.replica_socks.remove(sock)
+            sock.close()
+
+    def accept_replication(self):
+        while self.running:
+            try:
+                conn, addr = self.replication_sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self.receive_replication, args=(conn, addr), daemon=True).start()
+
+    def receive_replication(self, conn, addr):
+        """
+        Applies the records sent by a primary tracker
+        If the primary goes away, its users get the grace period to reconnect here
+        """
+        print(f"Replicating from {addr}")
+        try:
+            while True:
+                size = struct.unpack("!I", recv_exact(conn, 4))[0]
+                record = json.loads(recv_exact(conn, size))
+                with self.lock:
+                    self.update(record, replicate=False)
+        except (OSError, ValueError):
+            pass
+        conn.close()
+        print(f"Replication from {addr} stopped")
+        with self.lock:
+            active = [user_id for user_id, record in self.users.items() if record["active"] and user_id not in self.connections]
+        self.expire_later(active)
+
     def accept_connections(self):
         """
         Accepts incoming connections and creates a new thread to handle each connection
         """
-        while True:
-            conn, addr = self.sock.accept()
+        while self.running:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                # The listening socket was closed
+                return
             threading.Thread(target=self.handle_connection, args=(conn, addr)).start()
 
-    def send_active_users(self, conn, usr_addr):
+    def close(self):
+        """
+        Stops the tracker. The users stay active in the log, so a restarted tracker hands them out
+        """
+        self.running = False
+        with self.lock:
+            connections = list(self.connections.values()) + list(self.replica_socks)
+        for sock in [self.sock] + ([self.replication_sock] if hasattr(self, "replication_sock") else []) + connections:
+            try:
+                # shutdown wakes up the thread blocked in accept
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+        if self.log:
+            with self.lock:
+                self.log.close()
+
+    @profiled("send_active_users")
+    def send_active_users(self, conn, user_id):
         """
         Sends the list of active users to the new user
         :param conn: The connection to the new user
-        :param usr_addr: The address of the new user (host, port)
+        :param user_id: The id of the new user, left out of the list
         """
         data = b""
         count = 0
-        for addr, user in self.users.items():
-            # skip the user itself and inactive users            
-            if addr == usr_addr or not user["active"]:
+        with self.lock:
+            users = list(self.users.values())
+        for user in users:
+            # skip the user itself and inactive users
+            if user["user_id"] == user_id or not user["active"]:
                 continue
             count += 1
-            ip, _ = addr
+            ip = user["host"]
             port = user["listen_port"]
-            user_id = user["user_id"]
-            username = user["username"]
-            data += struct.pack("!BBBBH32s32s", *map(int, ip.split(".")), port, user_id.encode(), username.encode())
+            data += struct.pack("!BBBBH32s32s", *map(int, ip.split(".")), port, user["user_id"].encode(), user["username"].encode())
         conn.sendall(
             struct.pack("!I", count) + data
         )
@@ -58,38 +312,58 @@ class Tracker:
         """
         Handles the connection from a new user
         """
-        
+
         print(f"New connection from {addr}")
+        user_id = None
         try:
-            if addr not in self.users:
+            with self.lock:
+                known = self.users.get(self.addresses.get(addr))
+            if known is None:
                 conn.sendall(struct.pack("!3s", "NEW".encode()))
             else:
-                conn.sendall(struct.pack("!32s32s", self.users[addr]["user_id"].encode(), self.users[addr]["username"].encode()))
+                conn.sendall(struct.pack("!32s32s", known["user_id"].encode(), known["username"].encode()))
 
-            res = conn.recv(66)
+            res = recv_exact(conn, 66)
             user_id, username, listen_port = struct.unpack("!32s32sH", res)
             user_id = user_id.decode()
             username = username.decode().strip("\x00")
-            self.users[addr] = {
-                "user_id": user_id,
-                "username": username,
-                "listen_port": listen_port,
-                "active": True
-            }
-            print(self.users[addr])
-            self.send_active_users(conn, addr)
-        
+            with self.lock:
+                self.connections[user_id] = conn
+                self.update({
+                    "user_id": user_id,
+                    "username": username,
+                    "host": addr[0],
+                    "listen_port": listen_port,
+                    "addr": list(addr),
+                    "active": True
+                })
+            print(self.users[user_id])
+            self.send_active_users(conn, user_id)
+
             while True:
                 res = conn.recv(1) # This is to keep checking if the connection is still alive
                 sleep(1)
                 if res == b'': # Empty byte means connection is closed
-                    self.users[addr]["active"] = False
-                    print(f"Connection from {addr} closed")
                     break
 
-        except (ConnectionAbortedError, ConnectionResetError):
-            self.users[addr]["active"] = False
-            print(f"Connection from {addr} closed")
+        except (ConnectionAbortedError, ConnectionResetError, OSError):
+            pass
+
+        print(f"Connection from {addr} closed")
+        with self.lock:
+            # The user may have reconnected on another connection in the meantime
+            if user_id is not None and self.connections.get(user_id) is conn:
+                del self.connections[user_id]
+                if self.running:
+                    self.update({**self.users[user_id], "active": False})
 
 if __name__ == "__main__":
-    tracker = Tracker("", int(sys.argv[-1]) if len(sys.argv) > 1 else 5000)
+    parser = ArgumentParser()
+    parser.add_argument("port", type=int, nargs="?", default=5000, help="Port to bind the tracker to")
+    parser.add_argument("--state", type=str, default="tracker.log", help="File the tracker state is logged to")
+    parser.add_argument("--replication-port", type=int, default=None, help="Port to receive the state of a primary tracker on")
+    parser.add_argument("--replica", type=str, action="append", default=[], help="host:port of a standby tracker's replication port, can be repeated")
+    parser.add_argument("--profile", type=str, default=None, help="Profile from the start and write the profile to this path prefix on SIGUSR1 and at exit")
+    args = parser.parse_args()
+    replicas = [(replica.rsplit(":", 1)[0], int(replica.rsplit(":", 1)[1])) for replica in args.replica]
+    tracker = Tracker("", args.port, args.state, args.replication_port, replicas, args.profile)